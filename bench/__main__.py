@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import logging
+import tempfile
+import argparse as ap
+
+from bench import suite, synthetic, xnat
+
+def add_standin_arguments(parser):
+    parser.add_argument('--subjects', help='experiments in the stand-in project', type=int,
+        default=4)
+    parser.add_argument('--files_per_scan', help='DICOM files in every scan', type=int,
+        default=40)
+    parser.add_argument('--file_kb', help='size of every DICOM file in KB', type=int,
+        default=128)
+    parser.add_argument('--latency', help='seconds before every response', type=float,
+        default=0.02)
+    parser.add_argument('--jitter', help='random extra latency, up to this many seconds',
+        type=float, default=0.01)
+    parser.add_argument('--bandwidth', help='total server bandwidth in MB/s', type=float)
+    parser.add_argument('--connection_bandwidth', help='bandwidth of each connection in MB/s',
+        type=float)
+    parser.add_argument('--error_rate', help='fraction of requests answered with a 503',
+        type=float, default=0.0)
+    parser.add_argument('--truncate_rate', help='fraction of file downloads cut off part way',
+        type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+
+def get_rate(mb_per_second):
+    return int(mb_per_second * 1024**2) if mb_per_second else None
+
+def get_standin_config(args):
+    return xnat.get_config(args.subjects, args.files_per_scan, args.file_kb * 1024,
+        args.latency, args.jitter, get_rate(args.bandwidth), get_rate(args.connection_bandwidth),
+        args.error_rate, args.truncate_rate, args.seed)
+
+def run_stages(args):
+    results = suite.run(args.work_dir, args.sizes, args.stages, args.repeat,
+        synthetic.FMRIPREP_VERSION, args.seed)
+
+    regressions = False
+    if args.save_baseline:
+        suite.save_baseline(args.baseline, results)
+        print('Saved baseline {}.'.format(args.baseline))
+    elif os.path.exists(args.baseline):
+        results = suite.compare(results, args.baseline, args.tolerance)
+        regressions = bool(results['regression'].any())
+    else:
+        print('No baseline at {}; run with --save_baseline to create one.'.format(args.baseline))
+
+    print(results.to_string(index=False, float_format='{:.3f}'.format))
+    if args.output:
+        results.to_csv(args.output, sep='\t', index=False)
+
+    if regressions:
+        print('Regressions beyond {:.0%} against {}.'.format(args.tolerance, args.baseline))
+        sys.exit(1)
+
+def run_fetch(args):
+    # fetch needs the XNAT and dcm2niix packages, so only this command imports it
+    from bench import throughput
+
+    compression = {'threads': args.compress_threads} if args.compress_threads else None
+    results, stats = throughput.run(get_standin_config(args), args.network_jobs,
+        args.scan_jobs, args.passes, args.work_dir, args.client == 'async', args.rate or None,
+        args.convert_jobs, int(args.scratch_mb * 1024**2) if args.scratch_mb else None,
+        compression)
+    print(results.to_string(index=False, float_format='{:.3f}'.format))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'results': results.to_dict('records'), 'server': stats}, f, indent=2)
+
+def run_slurm(args):
+    # sbatch, singularity and (where missing) rsync are stubbed, so this runs off the cluster
+    from bench import slurm
+
+    results = slurm.run(args.checks, args.work_dir)
+    for name, problems in results.items():
+        print('{}: {}'.format(name, '; '.join(problems) if problems else 'ok'))
+    if any(results.values()):
+        sys.exit(1)
+
+def run_serve(args):
+    server = xnat.start(get_standin_config(args), args.host, args.port)
+    print('XNAT stand-in listening on {} (user {}, password {}).'.format(server.url,
+        xnat.USERNAME, xnat.PASSWORD))
+    try:
+        server.thread.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(server.stats.to_dict(), indent=2))
+        xnat.stop(server)
+
+def main():
+    parser = ap.ArgumentParser(description='STAR pipeline benchmarks on synthetic data')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    stages = commands.add_parser('stages', help='time the pure-Python stages')
+    stages.add_argument('--sizes', help='numbers of subjects to benchmark', nargs='+', type=int,
+        default=suite.SIZES)
+    stages.add_argument('--stages', help='stages to benchmark', nargs='+',
+        choices=list(suite.STAGES), default=list(suite.STAGES))
+    stages.add_argument('--repeat', help='runs per stage; the median is reported', type=int,
+        default=3)
+    stages.add_argument('--work_dir', help='where the synthetic trees are generated and kept',
+        default=os.path.join(tempfile.gettempdir(), 'star-bench'))
+    stages.add_argument('--seed', type=int, default=0)
+    stages.add_argument('--output', help='write the results to this TSV file')
+    stages.add_argument('--baseline', help='baseline JSON to compare against or save to',
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json'))
+    stages.add_argument('--save_baseline', help='store these results as the new baseline',
+        action='store_true')
+    stages.add_argument('--tolerance', help='slowdown or RSS growth reported as a regression',
+        type=float, default=0.2)
+
+    fetch = commands.add_parser('fetch', help='time XNAT downloads against a local stand-in')
+    add_standin_arguments(fetch)
+    fetch.add_argument('--network_jobs', help='subjects downloaded at once', type=int,
+        default=4)
+    fetch.add_argument('--scan_jobs', help='scans downloaded at once per subject', type=int,
+        default=4)
+    fetch.add_argument('--passes', help='cold downloads into an empty directory, warm repeats '
+        'them over the existing files', nargs='+', choices=['cold', 'warm'],
+        default=['cold', 'warm'])
+    fetch.add_argument('--convert_jobs', help='concurrent conversions per subject', type=int,
+        default=2)
+    fetch.add_argument('--scratch_mb', help='DICOM scratch limit per subject in MB; converted '
+        'DICOMs are then deleted, so a warm pass downloads them again', type=float)
+    fetch.add_argument('--compress_threads', help='gzip converted images with this many threads '
+        'instead of in the converter', type=int, default=0)
+    fetch.add_argument('--client', help='XNAT client to benchmark', choices=['async', 'sync'],
+        default='async')
+    fetch.add_argument('--rate', help='XNAT requests started per second with the async client',
+        type=float, default=0)
+    fetch.add_argument('--work_dir', help='parent of the temporary download directory',
+        default=tempfile.gettempdir())
+    fetch.add_argument('--output', help='write the results and server counters to this JSON')
+
+    checks = commands.add_parser('slurm', help='run the generated Slurm scripts against stub '
+        'cluster tools')
+    checks.add_argument('--checks', help='checks to run', nargs='+', choices=['fmriprep_array',
+        'xcpengine_shard_array', 'dependency', 'staging_success', 'staging_failure',
+        'staging_usr1'])
+    checks.add_argument('--work_dir', help='parent of the temporary check directories',
+        default=tempfile.gettempdir())
+
+    serve = commands.add_parser('serve', help='run the XNAT stand-in until interrupted')
+    add_standin_arguments(serve)
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.ERROR)
+
+    {'stages': run_stages, 'fetch': run_fetch, 'slurm': run_slurm,
+        'serve': run_serve}[args.command](args)
+
+if __name__=='__main__':
+    main()
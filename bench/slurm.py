@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import time
+import shutil
+import signal
+import tempfile
+import subprocess
+import contextlib
+
+import preprocessing as p
+
+FMRIPREP_VERSION = '23.2.0'
+SUBJECTS = ['sub-0001', 'sub-0002', 'sub-0003']
+JOB_ID = '4242'
+
+# stand-ins for the cluster tools the generated scripts call; each logs its arguments under
+# $STUB_LOG so a check can see what a job would have run
+STUBS = {
+    'sbatch': '''#!/bin/bash
+echo "$@" >> "$STUB_LOG/sbatch"
+echo "{};cluster"
+'''.format(JOB_ID),
+    # fmriprep's work dir is bound to /work: the stub notes whether an earlier attempt's state
+    # was staged in, leaves progress of its own, then succeeds, fails or runs until killed
+    'singularity': '''#!/bin/bash
+echo "$@" >> "$STUB_LOG/singularity-${SLURM_ARRAY_TASK_ID:-0}"
+prev=
+for a in "$@"; do
+    if [ "$prev" = -B ] && [ "${a%:/work}" != "$a" ]; then work="${a%:/work}"; fi
+    prev="$a"
+done
+if [ -n "$work" ]; then
+    [ -f "$work/previous" ] && echo staged-in >> "$STUB_LOG/staging"
+    touch "$work/progress"
+fi
+case "$STUB_MODE" in
+    fail) exit 3 ;;
+    hang) touch "$STUB_LOG/started"; exec sleep 60 ;;
+esac
+''',
+    # only written where rsync is not installed; enough of rsync -a [--delete] SRC/ DST/
+    'rsync': '''#!/bin/bash
+for a in "$@"; do [ "$a" = --delete ] && delete=1; done
+src="${@: -2:1}"
+dst="${@: -1}"
+mkdir -p "$dst"
+[ -n "$delete" ] && find "$dst" -mindepth 1 -delete
+cp -a "$src"/. "$dst"/
+'''
+}
+
+@contextlib.contextmanager
+def stub_tools(work_dir, names):
+    # slurm.submit and the generated scripts find the stubs first on PATH
+    stub_dir = os.path.join(work_dir, 'bin')
+    log_dir = os.path.join(work_dir, 'log')
+    os.makedirs(stub_dir, exist_ok=True)
+    os.makedirs(log_dir, exist_ok=True)
+    for name in names:
+        path = os.path.join(stub_dir, name)
+        with open(path, 'w') as f:
+            f.write(STUBS[name])
+        os.chmod(path, 0o755)
+
+    env = dict(os.environ)
+    os.environ['PATH'] = stub_dir + os.pathsep + os.environ['PATH']
+    os.environ['STUB_LOG'] = log_dir
+    try:
+        yield log_dir
+    finally:
+        os.environ.clear()
+        os.environ.update(env)
+
+def read_lines(path):
+    try:
+        with open(path) as f:
+            return f.read().splitlines()
+    except FileNotFoundError:
+        return []
+
+def get_sbatch_call(log_dir):
+    # (--flag values, script path) of the last sbatch call
+    args = read_lines(os.path.join(log_dir, 'sbatch'))[-1].split()
+    flags = dict(a.split('=', 1) for a in args if a.startswith('--') and '=' in a)
+    return flags, args[-1]
+
+def get_option(log_dir, task, option):
+    args = ' '.join(read_lines(os.path.join(log_dir, 'singularity-{}'.format(task)))).split()
+    return args[args.index(option) + 1] if option in args else None
+
+def run_array(script_path, spec):
+    # every task of the array in turn, with the environment Slurm gives it
+    m = re.match(r'^(\d+)-(\d+)', spec)
+    for i in range(int(m.group(1)), int(m.group(2)) + 1):
+        subprocess.run(['bash', script_path], check=True, capture_output=True,
+            env=dict(os.environ, SLURM_ARRAY_JOB_ID=JOB_ID, SLURM_ARRAY_TASK_ID=str(i),
+            SLURM_JOB_ID=str(int(JOB_ID) + i + 1)))
+
+def check_fmriprep_array(work_dir):
+    # each task must run fmriprep for the subject on its line of the manifest
+    study_dir = os.path.join(work_dir, 'study')
+    with stub_tools(work_dir, ['sbatch', 'singularity']) as log_dir:
+        cmd = p.fmriprep.get_singularity_command(study_dir, p.slurm.ARRAY_SUBJECT,
+            FMRIPREP_VERSION, os.path.join(work_dir, 'fmriprep.sif'), '1', '1', '0.5',
+            os.path.join(work_dir, 'license.txt'), '91k', ['MNI152NLin2009cAsym'])
+        job_id = p.fmriprep.run_sbatch_array(study_dir, SUBJECTS, FMRIPREP_VERSION, cmd, 2)
+        flags, script_path = get_sbatch_call(log_dir)
+        run_array(script_path, flags['--array'])
+
+        problems = []
+        if job_id != JOB_ID:
+            problems.append('submit returned {!r}, not {}'.format(job_id, JOB_ID))
+        if flags['--array'] != '0-{}%2'.format(len(SUBJECTS) - 1):
+            problems.append('array spec {}'.format(flags['--array']))
+        for i, s in enumerate(SUBJECTS):
+            label = get_option(log_dir, i, '--participant-label')
+            if label != s:
+                problems.append('task {} ran {}, not {}'.format(i, label, s))
+        return problems
+
+def check_xcpengine_shard_array(work_dir):
+    # shard arrays resolve a cohort file per task instead of a subject
+    study_dir = os.path.join(work_dir, 'study')
+    cohort_files = [os.path.join(work_dir, 'shard-{}.csv'.format(i)) for i in range(3)]
+    with stub_tools(work_dir, ['sbatch', 'singularity']) as log_dir:
+        cmd = p.xcpengine.get_singularity_command(study_dir, None, 'xcpengine.sif',
+            FMRIPREP_VERSION, work_dir, p.xcpengine.ARRAY_COHORT)
+        p.xcpengine.run_sbatch_array(study_dir, cohort_files, FMRIPREP_VERSION, '/opt/ants',
+            cmd, None, None, 'COHORT')
+        flags, script_path = get_sbatch_call(log_dir)
+        run_array(script_path, flags['--array'])
+
+        problems = []
+        for i, c in enumerate(cohort_files):
+            cohort_file = get_option(log_dir, i, '-c')
+            if cohort_file != c:
+                problems.append('task {} ran cohort {}, not {}'.format(i, cohort_file, c))
+        return problems
+
+def check_dependency(work_dir):
+    script_path = os.path.join(work_dir, 'chained.sbatch')
+    p.slurm.write_script(script_path, [], ['true'])
+    with stub_tools(work_dir, ['sbatch']) as log_dir:
+        p.slurm.submit(script_path, dependency=['11', '12_3'], dependency_type='afterany')
+        flags, _ = get_sbatch_call(log_dir)
+
+    if flags.get('--dependency') != 'afterany:11:12_3':
+        return ['dependency {}'.format(flags.get('--dependency'))]
+    return []
+
+def run_staged(work_dir, mode):
+    # a staged fmriprep job whose work dir holds an earlier attempt's state; returns its exit
+    # status, the work dir and the scratch parent
+    study_dir = os.path.join(work_dir, 'study')
+    subject = SUBJECTS[0]
+    subject_work_dir = os.path.join(p.fmriprep.get_work_dir(study_dir, FMRIPREP_VERSION),
+        subject)
+    scratch_dir = os.path.join(work_dir, 'scratch')
+    os.makedirs(subject_work_dir)
+    os.makedirs(scratch_dir)
+    open(os.path.join(subject_work_dir, 'previous'), 'w').close()
+
+    cmd = p.fmriprep.get_singularity_command(study_dir, subject, FMRIPREP_VERSION,
+        os.path.join(work_dir, 'fmriprep.sif'), '1', '1', '0.5',
+        os.path.join(work_dir, 'license.txt'), '91k', ['MNI152NLin2009cAsym'],
+        p.fmriprep.SCRATCH_WORK_DIR)
+    script_path = os.path.join(work_dir, 'staged.sbatch')
+    p.slurm.write_script(script_path, [], p.fmriprep.get_script_lines(study_dir, subject,
+        FMRIPREP_VERSION, cmd, scratch_dir))
+
+    env = dict(os.environ, STUB_MODE=mode, SLURM_JOB_ID=JOB_ID)
+    job = subprocess.Popen(['bash', script_path], env=env, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    if mode == 'hang':
+        # Slurm signals the batch shell (--signal=B:USR1) ahead of the time limit
+        started = os.path.join(os.environ['STUB_LOG'], 'started')
+        deadline = time.monotonic() + 30
+        while not os.path.exists(started) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        job.send_signal(signal.SIGUSR1)
+    try:
+        status = job.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        job.kill()
+        raise
+    return status, subject_work_dir, scratch_dir
+
+def check_staging(work_dir, mode, expected_status, copied_back):
+    names = ['singularity'] + (['rsync'] if not shutil.which('rsync') else [])
+    with stub_tools(work_dir, names) as log_dir:
+        status, subject_work_dir, scratch_dir = run_staged(work_dir, mode)
+
+        problems = []
+        if status != expected_status:
+            problems.append('exit status {}, not {}'.format(status, expected_status))
+        if 'staged-in' not in read_lines(os.path.join(log_dir, 'staging')):
+            problems.append('the work dir was not copied to scratch')
+        if os.path.exists(os.path.join(subject_work_dir, 'progress')) != copied_back:
+            problems.append('scratch was {}copied back'.format('not ' if copied_back else ''))
+        if not os.path.exists(os.path.join(subject_work_dir, 'previous')):
+            problems.append('the earlier state was lost from the work dir')
+        if os.listdir(scratch_dir):
+            problems.append('scratch left behind: {}'.format(os.listdir(scratch_dir)))
+        return problems
+
+def check_staging_success(work_dir):
+    # outputs are already on the shared disk, so the work dir is left as it was
+    return check_staging(work_dir, 'ok', 0, False)
+
+def check_staging_failure(work_dir):
+    return check_staging(work_dir, 'fail', 3, True)
+
+def check_staging_usr1(work_dir):
+    return check_staging(work_dir, 'hang', 143, True)
+
+CHECKS = {
+    'fmriprep_array': check_fmriprep_array,
+    'xcpengine_shard_array': check_xcpengine_shard_array,
+    'dependency': check_dependency,
+    'staging_success': check_staging_success,
+    'staging_failure': check_staging_failure,
+    'staging_usr1': check_staging_usr1
+}
+
+def run(checks=None, work_dir=None):
+    # returns {check: problems}; every check gets its own scratch directory
+    results = {}
+    for name in checks or CHECKS:
+        check_dir = tempfile.mkdtemp(prefix='star-slurm-{}-'.format(name), dir=work_dir)
+        try:
+            results[name] = CHECKS[name](check_dir)
+        except Exception as e:
+            results[name] = [repr(e)]
+        finally:
+            shutil.rmtree(check_dir, ignore_errors=True)
+    return results
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+import os
+import glob
+import json
+import time
+import socket
+import platform
+import resource
+import statistics
+import multiprocessing as mp
+from datetime import datetime
+
+import pandas as pd
+
+import preprocessing as p
+from . import synthetic
+
+SIZES = [10, 100, 1000]
+
+# outputs removed before every repetition, so each one starts from the same tree; the
+# confounds parquet sidecars go too, so confounds are always timed on a cold parse
+OUTPUTS = {
+    'behavioral': [os.path.join('sourcedata', 'sub-*', 'behavioral_files', '*.txt')],
+    'confounds': [os.path.join('derivatives', 'fmriprep-*', 'fmriprep', 'sub-*', 'func',
+        pattern) for pattern in ['*desc-confounds_regressors-*.txt', '*outliers*.txt',
+        '*scrub_mask.txt', '.*.parquet']],
+    'fmap': [os.path.join('sub-*', 'fmap', '*')]
+}
+OUTPUTS['confounds_cohort'] = OUTPUTS['confounds'] + [os.path.join('derivatives',
+    'fmriprep-*', 'confounds_summary.tsv')]
+
+def get_size(patterns):
+    return sum(os.path.getsize(f) for pattern in patterns for f in glob.glob(pattern))
+
+def get_func_dir(study_dir, fmriprep_version, subject_bids_id):
+    return os.path.join(p.fmriprep.get_fmriprep_dir(study_dir, fmriprep_version), 'fmriprep',
+        subject_bids_id, 'func')
+
+def bench_behavioral(study_dir, subject_bids_ids, fmriprep_version):
+    for s in subject_bids_ids:
+        p.behavioral.process_onsets(study_dir, s)
+    return len(subject_bids_ids), get_size([os.path.join(study_dir, 'sourcedata', s,
+        'behavioral_files', '*_Run_?') for s in subject_bids_ids])
+
+def bench_confounds(study_dir, subject_bids_ids, fmriprep_version):
+    runs = 0
+    for s in subject_bids_ids:
+        runs += len(p.fmriprep.filter_confounds(study_dir, s, fmriprep_version, ['9p', '36p']))
+    return runs, get_size([os.path.join(get_func_dir(study_dir, fmriprep_version, s),
+        '*desc-confounds_regressors.tsv') for s in subject_bids_ids])
+
+def bench_confounds_cohort(study_dir, subject_bids_ids, fmriprep_version):
+    summary = p.fmriprep.filter_cohort_confounds(study_dir, fmriprep_version, subject_bids_ids,
+        strategies=['9p', '36p'])
+    return len(summary), get_size([os.path.join(get_func_dir(study_dir, fmriprep_version, s),
+        '*desc-confounds_regressors.tsv') for s in subject_bids_ids])
+
+def bench_nii_path(study_dir, subject_bids_ids, fmriprep_version):
+    # fetch needs the XNAT and dcm2niix packages, so only its own stages import it
+    import fetch
+
+    n = 0
+    for s in subject_bids_ids:
+        runs = {}
+        for description in synthetic.SCANS:
+            runs[description] = runs.get(description, 0) + 1
+            fetch.get_nii_path(study_dir, s, runs[description], description)
+            n += 1
+    return n, 0
+
+def bench_fmap(study_dir, subject_bids_ids, fmriprep_version):
+    import fetch
+
+    for s in subject_bids_ids:
+        fetch.save_fmap(study_dir, s)
+    return len(subject_bids_ids), get_size([os.path.join(study_dir, s, 'func', '*bold.nii.gz')
+        for s in subject_bids_ids])
+
+STAGES = {
+    'behavioral': bench_behavioral,
+    'confounds': bench_confounds,
+    'confounds_cohort': bench_confounds_cohort,
+    'nii_path': bench_nii_path,
+    'fmap': bench_fmap
+}
+
+def reset(study_dir, stage):
+    for pattern in OUTPUTS.get(stage, []):
+        for f in glob.glob(os.path.join(study_dir, pattern)):
+            os.remove(f)
+
+def get_peak_rss():
+    # MB; ru_maxrss is in kilobytes on Linux. Worker processes count through RUSAGE_CHILDREN.
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+def run_stage(stage, study_dir, subject_bids_ids, fmriprep_version, repeat, conn):
+    try:
+        times = []
+        for _ in range(repeat):
+            reset(study_dir, stage)
+            t = time.perf_counter()
+            items, n_bytes = STAGES[stage](study_dir, subject_bids_ids, fmriprep_version)
+            times.append(time.perf_counter() - t)
+        conn.send({'times': times, 'items': items, 'bytes': n_bytes,
+            'peak_rss_mb': get_peak_rss()})
+
+    except BaseException as e:
+        conn.send({'error': repr(e)})
+
+def measure(stage, study_dir, subject_bids_ids, fmriprep_version, repeat=3):
+    # every stage runs in a fresh interpreter so peak RSS is its own, not the generator's
+    ctx = mp.get_context('spawn')
+    parent, child = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=run_stage, args=(stage, study_dir, subject_bids_ids,
+        fmriprep_version, repeat, child))
+    process.start()
+    child.close()
+    try:
+        result = parent.recv()
+    except EOFError:
+        result = {'error': f'benchmark process exited with {process.exitcode}'}
+    process.join()
+
+    row = {'subjects': len(subject_bids_ids), 'stage': stage}
+    if 'error' in result:
+        return dict(row, error=result['error'])
+
+    seconds = statistics.median(result['times'])
+    return dict(row, seconds=seconds, best=min(result['times']), items=result['items'],
+        items_per_second=result['items'] / seconds if seconds else None,
+        mb_per_second=result['bytes'] / 1024**2 / seconds if seconds else None,
+        peak_rss_mb=result['peak_rss_mb'])
+
+def run(work_dir, sizes=SIZES, stages=None, repeat=3,
+        fmriprep_version=synthetic.FMRIPREP_VERSION, seed=0):
+    rows = []
+    for n in sizes:
+        study_dir = os.path.join(work_dir, 'star-{}'.format(n))
+        t = time.perf_counter()
+        subject_bids_ids = synthetic.generate(study_dir, n, fmriprep_version, seed)
+        print('Synthetic tree of {} subjects ready in {:.1f}s.'.format(n,
+            time.perf_counter() - t))
+
+        for stage in stages or STAGES:
+            row = measure(stage, study_dir, subject_bids_ids, fmriprep_version, repeat)
+            if 'error' in row:
+                print('{} at {} subjects failed: {}'.format(stage, n, row['error']))
+            else:
+                print('{} at {} subjects: {:.3f}s, {:.1f} MB peak RSS'.format(stage, n,
+                    row['seconds'], row['peak_rss_mb']))
+            rows.append(row)
+
+    return pd.DataFrame(rows)
+
+def save_baseline(path, results):
+    baseline = {
+        'created': datetime.now().isoformat(),
+        'host': socket.gethostname(),
+        'python': platform.python_version(),
+        'results': results.dropna(subset=['seconds']).to_dict('records')
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=2)
+
+def compare(results, baseline_path, tolerance=0.2):
+    with open(baseline_path) as f:
+        baseline = pd.DataFrame(json.load(f)['results'])
+
+    baseline = baseline[['subjects', 'stage', 'seconds', 'peak_rss_mb']]
+    merged = results.merge(baseline, on=['subjects', 'stage'], how='left',
+        suffixes=('', '_baseline'))
+    merged['time_change'] = merged['seconds'] / merged['seconds_baseline'] - 1
+    merged['rss_change'] = merged['peak_rss_mb'] / merged['peak_rss_mb_baseline'] - 1
+    merged['regression'] = (merged['time_change'] > tolerance) | \
+        (merged['rss_change'] > tolerance)
+    return merged
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+import nibabel as nib
+
+from util import catalog
+
+FMRIPREP_VERSION = '20.2.0'
+
+# series descriptions as XNAT lists them; runs are numbered per description, as in download
+SCANS = [
+    'rfMRI_REST_AP', 'rfMRI_REST_AP_SBRef', 'rfMRI_REST_PA', 'rfMRI_REST_PA_SBRef',
+    'tfMRI_EMOTION_PA', 'tfMRI_EMOTION_PA_SBRef',
+    'tfMRI_GUESSING_PA', 'tfMRI_GUESSING_PA_SBRef', 'tfMRI_GUESSING_AP',
+    'tfMRI_GUESSING_AP_SBRef',
+    'tfMRI_CARIT_PA', 'tfMRI_CARIT_PA_SBRef', 'tfMRI_CARIT_AP', 'tfMRI_CARIT_AP_SBRef',
+    'tfMRI_WM_AP', 'tfMRI_WM_AP_SBRef', 'tfMRI_WM_PA', 'tfMRI_WM_PA_SBRef',
+    'dMRI_dir98_AP', 'dMRI_dir98_AP_SBRef', 'dMRI_dir98_PA', 'dMRI_dir98_PA_SBRef'
+]
+
+BEHAVIORAL_RUNS = ['EMOTION_Run_1', 'GUESSING_Run_1', 'GUESSING_Run_2', 'CARIT_Run_1',
+    'CARIT_Run_2', 'WM_Run_1']
+
+PHASE_ENCODING = {'ap': 'j-', 'pa': 'j'}
+
+def get_subject_bids_ids(n):
+    return ['sub-{:04d}'.format(i + 1) for i in range(n)]
+
+def get_func_runs():
+    # (task, direction, run) of every BOLD series in SCANS
+    runs, counts = [], {}
+    for description in SCANS:
+        d = description.split('_')
+        if not d[0].endswith('fMRI') or d[-1] == 'SBRef':
+            continue
+        counts[description] = counts.get(description, 0) + 1
+        runs.append((d[-2].lower(), d[-1].lower(), counts[description]))
+    return runs
+
+def get_func_name(subject_bids_id, task, direction, run, suffix):
+    return '{}_task-{}_dir-{}_run-{}_{}'.format(subject_bids_id, task, direction, run, suffix)
+
+def psychopy_columns(rng, n):
+    # bookkeeping columns PsychoPy writes into every behavioral export
+    return {
+        'participant': np.full(n, 'STAR'),
+        'session': np.ones(n, dtype=int),
+        'date': np.full(n, '2019_Mar_04_1432'),
+        'expName': np.full(n, 'STAR'),
+        'psychopyVersion': np.full(n, '1.85.3'),
+        'frameRate': np.full(n, 59.95),
+        'trials.thisRepN': np.zeros(n, dtype=int),
+        'trials.thisTrialN': np.arange(n),
+        'trials.thisN': np.arange(n),
+        'trials.thisIndex': rng.permutation(n)
+    }
+
+def trial_times(rng, n, start=8.0, spacing=4.0, length=2.0):
+    onsets = start + np.arange(n) * spacing + rng.uniform(0, 0.5, n)
+    return onsets, onsets + length
+
+def emotion_data(rng, blocks=12, trials=6):
+    n = blocks * trials
+    condition = np.repeat(np.resize(['shape', 'face'], blocks), trials)
+    onsets, _ = trial_times(rng, n, spacing=3.0)
+    cue = np.where(np.arange(n) % trials == 0, onsets - 1.0, 0.0)
+    return dict(psychopy_columns(rng, n), trialCondition=condition, cueStartTime=cue,
+        trialStartTime=onsets, stimFile=rng.choice(['f01.jpg', 's01.jpg', 'f02.jpg'], n),
+        key_resp_corr=rng.integers(0, 2, n), key_resp_rt=rng.uniform(0.3, 1.5, n))
+
+def guessing_data(rng, n=40):
+    condition = rng.choice(['lowWin', 'lowLose', 'highWin', 'highLose'], n)
+    cue, cue_end = trial_times(rng, n, spacing=12.0, length=1.5)
+    guess, guess_end = cue_end + 1.0, cue_end + 4.0
+    feedback, feedback_end = guess_end + 1.0, guess_end + 2.0
+    return dict(psychopy_columns(rng, n), trialCondition=condition, cueStartTime=cue,
+        cueEndTime=cue_end, guessStartTime=guess, guessEndTime=guess_end,
+        feedbackStartTime=feedback, feedbackEndTime=feedback_end,
+        guess_resp_keys=rng.choice(['1', '2'], n), guess_resp_rt=rng.uniform(0.3, 2.5, n))
+
+def carit_data(rng, n=90):
+    answer = np.where(rng.random(n) < 0.75, 'go', 'nogo')
+    nogo = np.where(answer == 'nogo', rng.choice(['prevRewNogo', 'neutralNogo'], n), '')
+    message = rng.choice(['correct', 'incorrect'], n, p=[0.85, 0.15])
+    shape, shape_end = trial_times(rng, n, spacing=3.5, length=0.6)
+    return dict(psychopy_columns(rng, n), corrAns=answer, nogoCondition=nogo,
+        corrRespMsg=message, shapeStartTime=shape, shapeEndTime=shape_end,
+        shapeFile=rng.choice(['circle.png', 'square.png', 'triangle.png'], n),
+        resp_rt=rng.uniform(0.2, 0.6, n))
+
+def wm_data(rng, blocks=8, trials=10):
+    # trial rows of every block, the first one carrying the block cue, then one fixation row
+    rows = []
+    t = 8.0
+    levels = [(c, k) for c in ['0back', '2back'] for k in ['faces', 'objects']]
+    for b in range(blocks):
+        condition, category = levels[b % len(levels)]
+        cue = t
+        for i in range(trials):
+            rows.append({'condition': condition, 'category': category,
+                'blockCueStartTime': cue if i == 0 else np.nan,
+                'trialImageStartTime': cue + 2.5 + i * 2.5, 'blockFixStartTime': np.nan,
+                'target': rng.choice(['target', 'nonlure', 'lure'])})
+        t = cue + 2.5 + trials * 2.5
+        rows.append({'condition': condition, 'category': category, 'blockCueStartTime': np.nan,
+            'trialImageStartTime': np.nan, 'blockFixStartTime': t, 'target': ''})
+        t += 15.0
+
+    data = pd.DataFrame(rows)
+    return dict(psychopy_columns(rng, len(data)), **{c: data[c].to_numpy() for c in data})
+
+BEHAVIORAL_DATA = {
+    'EMOTION': emotion_data,
+    'GUESSING': guessing_data,
+    'CARIT': carit_data,
+    'WM': wm_data
+}
+
+def write_behavioral(source_path, rng):
+    behavioral_dir = os.path.join(source_path, 'behavioral_files')
+    os.makedirs(behavioral_dir, exist_ok=True)
+    for run in BEHAVIORAL_RUNS:
+        data = pd.DataFrame(BEHAVIORAL_DATA[run.split('_')[0]](rng))
+        data.to_csv(os.path.join(behavioral_dir, run), index=False)
+
+def get_confounds_columns(compcor=100, cosine=8, motion_outliers=4):
+    columns = []
+    for c in ['global_signal', 'csf', 'white_matter']:
+        columns += [c, c + '_derivative1', c + '_power2', c + '_derivative1_power2']
+    columns += ['csf_wm', 'tcompcor', 'std_dvars', 'dvars', 'framewise_displacement', 'rmsd']
+    columns += ['t_comp_cor_{:02d}'.format(i) for i in range(compcor // 10)]
+    columns += ['c_comp_cor_{:02d}'.format(i) for i in range(compcor // 4)]
+    columns += ['w_comp_cor_{:02d}'.format(i) for i in range(compcor // 4)]
+    columns += ['a_comp_cor_{:02d}'.format(i) for i in range(compcor)]
+    columns += ['cosine{:02d}'.format(i) for i in range(cosine)]
+    columns += ['non_steady_state_outlier00']
+    for m in ['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z']:
+        columns += [m, m + '_derivative1', m + '_power2', m + '_derivative1_power2']
+    columns += ['motion_outlier{:02d}'.format(i) for i in range(motion_outliers)]
+    return columns
+
+def confounds_data(rng, volumes=200, compcor=100):
+    columns = get_confounds_columns(compcor)
+    data = rng.normal(0, 1, (volumes, len(columns)))
+    data = pd.DataFrame(data, columns=columns)
+
+    # motion drifts slowly; FD and DVARS are positive with occasional spikes
+    motion = np.cumsum(rng.normal(0, 0.02, (volumes, 6)), axis=0)
+    data[['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z']] = motion
+    data['framewise_displacement'] = np.abs(rng.normal(0.15, 0.1, volumes)) + \
+        (rng.random(volumes) < 0.03) * rng.uniform(0.5, 2.0, volumes)
+    data['dvars'] = np.abs(rng.normal(25, 3, volumes)) + \
+        (rng.random(volumes) < 0.03) * rng.uniform(10, 30, volumes)
+
+    # fmriprep leaves derivative-based regressors undefined on the first volume
+    first = [c for c in columns if 'derivative1' in c or c in ['std_dvars', 'dvars',
+        'framewise_displacement']]
+    data = data.astype(object)
+    data.loc[0, first] = 'n/a'
+    return data
+
+def bold_image(rng, shape=(16, 16, 8), volumes=20):
+    data = rng.integers(0, 1000, shape + (volumes,), dtype=np.int16)
+    img = nib.Nifti1Image(data, np.diag([3.0, 3.0, 3.0, 1.0]))
+    img.header.set_xyzt_units('mm', 'sec')
+    img.header['pixdim'][4] = 0.8
+    return img
+
+def get_sidecar(task, direction):
+    return {
+        'RepetitionTime': 0.8,
+        'TaskName': task,
+        'PhaseEncodingDirection': PHASE_ENCODING[direction],
+        'EffectiveEchoSpacing': 0.00058,
+        'MultibandAccelerationFactor': 8,
+        'ConversionSoftware': 'dcm2niix'
+    }
+
+def write_templates(template_dir, rng, templates, volumes, compcor, bold_volumes):
+    # the tree reuses a pool of generated files through hard links so 1000 subjects fit on disk
+    os.makedirs(template_dir, exist_ok=True)
+    paths = {'confounds': [], 'bold': []}
+    for i in range(templates):
+        confounds_path = os.path.join(template_dir, 'confounds-{}.tsv'.format(i))
+        confounds_data(rng, volumes, compcor).to_csv(confounds_path, sep='\t', index=False)
+        paths['confounds'].append(confounds_path)
+
+        bold_path = os.path.join(template_dir, 'bold-{}.nii.gz'.format(i))
+        nib.save(bold_image(rng, volumes=bold_volumes), bold_path)
+        paths['bold'].append(bold_path)
+    return paths
+
+def link(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+def write_subject(study_dir, subject_bids_id, fmriprep_version, templates, seed):
+    rng = np.random.default_rng(seed)
+    source_path = os.path.join(study_dir, 'sourcedata', subject_bids_id)
+    func_dir = os.path.join(study_dir, subject_bids_id, 'func')
+    confounds_dir = os.path.join(study_dir, 'derivatives', 'fmriprep-{}'.format(fmriprep_version),
+        'fmriprep', subject_bids_id, 'func')
+    for d in [source_path, func_dir, confounds_dir]:
+        os.makedirs(d, exist_ok=True)
+
+    scans = pd.DataFrame({'id': [str(i + 1) for i in range(len(SCANS))],
+        'series_description': SCANS, 'type': SCANS})
+    scans.to_csv(os.path.join(source_path, subject_bids_id + '.csv'), index=False)
+
+    write_behavioral(source_path, rng)
+
+    for task, direction, run in get_func_runs():
+        name = get_func_name(subject_bids_id, task, direction, run, 'bold')
+        link(rng.choice(templates['bold']), os.path.join(func_dir, name + '.nii.gz'))
+        with open(os.path.join(func_dir, name + '.json'), 'w') as f:
+            json.dump(get_sidecar(task, direction), f, indent=2)
+
+        confounds_name = get_func_name(subject_bids_id, task, direction, run,
+            'desc-confounds_regressors.tsv')
+        link(rng.choice(templates['confounds']), os.path.join(confounds_dir, confounds_name))
+
+def get_stamp_path(study_dir):
+    return os.path.join(study_dir, '.synthetic.json')
+
+def generate(study_dir, n, fmriprep_version=FMRIPREP_VERSION, seed=0, templates=16, volumes=200,
+        compcor=100, bold_volumes=20):
+    params = {'n': n, 'fmriprep_version': fmriprep_version, 'seed': seed,
+        'templates': templates, 'volumes': volumes, 'compcor': compcor,
+        'bold_volumes': bold_volumes}
+    subject_bids_ids = get_subject_bids_ids(n)
+
+    # an existing tree built with the same parameters is reused
+    try:
+        with open(get_stamp_path(study_dir)) as f:
+            if json.load(f) == params:
+                return subject_bids_ids
+    except (FileNotFoundError, ValueError):
+        pass
+
+    if os.path.exists(study_dir):
+        shutil.rmtree(study_dir)
+
+    rng = np.random.default_rng(seed)
+    paths = write_templates(os.path.join(study_dir, '.templates'), rng, templates, volumes,
+        compcor, bold_volumes)
+    for i, subject_bids_id in enumerate(subject_bids_ids):
+        write_subject(study_dir, subject_bids_id, fmriprep_version, paths, seed + i + 1)
+
+    catalog.rebuild(study_dir)
+
+    with open(get_stamp_path(study_dir), 'w') as f:
+        json.dump(params, f)
+    return subject_bids_ids
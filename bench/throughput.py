@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import gzip
+import shutil
+import types
+import logging
+import tempfile
+import collections
+import concurrent.futures as cf
+
+import numpy as np
+import pandas as pd
+
+import fetch
+from fetch import xnat
+from util import catalog
+from . import synthetic, xnat as standin
+
+logger = logging.getLogger(__name__)
+
+Auth = collections.namedtuple('Auth', ['url', 'username', 'password'])
+
+def get_nii_bytes():
+    # one small image stands in for every converted scan
+    img = synthetic.bold_image(np.random.default_rng(0), volumes=12)
+    return img.to_bytes()
+
+NII = get_nii_bytes()
+
+class Dcm2niix:
+    # the nipype interface fetch.convert_dcm_to_nii drives, without the dcm2niix binary; it
+    # writes an image and a sidecar where dcm2niix would, so gzip, the catalog and save_fmap run
+    # as they do in production
+    def __init__(self):
+        self.inputs = types.SimpleNamespace()
+
+    @property
+    def cmdline(self):
+        return 'dcm2niix {}'.format(self.inputs.source_dir)
+
+    def run(self):
+        name = os.path.join(self.inputs.output_dir, self.inputs.out_filename)
+        os.makedirs(self.inputs.output_dir, exist_ok=True)
+        if self.inputs.compress == 'n':
+            with open(name + '.nii', 'wb') as f:
+                f.write(NII)
+        else:
+            with gzip.open(name + '.nii.gz', 'wb', compresslevel=1) as f:
+                f.write(NII)
+
+        direction = name.split('_dir-')[1].split('_')[0] if '_dir-' in name else 'ap'
+        with open(name + '.json', 'w') as f:
+            json.dump({'PhaseEncodingDirection': synthetic.PHASE_ENCODING[direction]}, f)
+
+def get_subject_bids_id(label):
+    # stand-in labels are YYMMDD_STARnnnn
+    return 'sub-' + label.split('_')[-1]
+
+def fetch_subject(sess, label, study_dir, scan_jobs, convert_jobs, scratch_bytes=None,
+        compression=None, ttl=None):
+    # the XNAT side of run.download, through the same fetch functions: cached listings,
+    # behavioral files, then the scan download and conversion pipeline
+    subject_bids_id = get_subject_bids_id(label)
+    metadata = fetch.get_scan_metadata(sess, label, study_dir, ttl)
+    metadata = fetch.save_scan_metadata(study_dir, subject_bids_id, metadata)
+
+    behavioral_data = fetch.get_behavioral_data(sess, label, study_dir, ttl)
+    fetch.save_behavioral_data(sess, study_dir, subject_bids_id, behavioral_data)
+
+    fetch.get_scan_data(sess, label, subject_bids_id, metadata.to_dict('records'), study_dir,
+        scan_jobs, convert_jobs, scratch_bytes, compression)
+
+def run_pass(sess, labels, study_dir, network_jobs, scan_jobs, convert_jobs, scratch_bytes=None,
+        compression=None, ttl=None):
+    failed_subjects = 0
+    t = time.perf_counter()
+    with cf.ThreadPoolExecutor(max_workers=network_jobs) as executor:
+        futures = {executor.submit(fetch_subject, sess, label, study_dir, scan_jobs,
+            convert_jobs, scratch_bytes, compression, ttl): label for label in labels}
+        for fut in cf.as_completed(futures):
+            try:
+                fut.result()
+            except Exception as e:
+                logger.error(f'Subject {futures[fut]} failed: {e!r}')
+                failed_subjects += 1
+
+    return time.perf_counter() - t, failed_subjects
+
+def summarize(name, seconds, failed_subjects, stats):
+    requests = stats['requests']
+    n = stats['bytes'].get('dicom', 0) + stats['bytes'].get('behavioral', 0)
+    return {
+        'pass': name,
+        'seconds': seconds,
+        'mb': n / 1024**2,
+        'mb_per_second': n / 1024**2 / seconds if seconds else None,
+        'failed_subjects': failed_subjects,
+        'requests': sum(requests.values()),
+        'listing_requests': sum(v for k, v in requests.items() if k not in ('dicom',
+            'behavioral')),
+        'file_requests': requests.get('dicom', 0) + requests.get('behavioral', 0),
+        'injected_errors': stats['injected'].get('error', 0),
+        'injected_truncations': stats['injected'].get('truncate', 0),
+        'range_requests': stats['range_requests'],
+        'peak_connections': stats['peak_connections']
+    }
+
+def run(config, network_jobs=4, scan_jobs=4, passes=('cold', 'warm'), work_dir=None,
+        asynchronous=True, rate=None, convert_jobs=2, scratch_bytes=None, compression=None,
+        ttl=3600):
+    # a cold pass downloads everything into an empty study dir; a warm pass runs again over it,
+    # which exercises the metadata cache and the verify-and-skip path (DICOMs are only kept
+    # for it without a scratch limit)
+    server = standin.start(config)
+    study_dir = tempfile.mkdtemp(prefix='star-fetch-', dir=work_dir)
+    converter = fetch.Dcm2niix
+    fetch.Dcm2niix = Dcm2niix
+    rows, stats = [], {}
+    try:
+        auth = Auth(server.url, standin.USERNAME, standin.PASSWORD)
+        sess = xnat.connect(auth, network_jobs * scan_jobs, asynchronous, rate)
+        try:
+            labels = [e['label'] for e in xnat.list_experiments(sess, config.project)]
+            for name in passes:
+                server.stats = standin.Stats()
+                result = run_pass(sess, labels, study_dir, network_jobs, scan_jobs,
+                    convert_jobs, scratch_bytes, compression, ttl)
+                stats[name] = server.stats.to_dict()
+                rows.append(summarize(name, *result, stats[name]))
+                print('{} pass: {:.1f} MB in {:.2f}s, {} requests'.format(name, rows[-1]['mb'],
+                    rows[-1]['seconds'], rows[-1]['requests']))
+        finally:
+            xnat.close(sess)
+
+    finally:
+        fetch.Dcm2niix = converter
+        standin.stop(server)
+        shutil.rmtree(study_dir, ignore_errors=True)
+        if os.path.exists(catalog.get_catalog_path(study_dir)):
+            os.remove(catalog.get_catalog_path(study_dir))
+
+    return pd.DataFrame(rows), stats
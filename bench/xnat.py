@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+
+import io
+import re
+import base64
+import json
+import time
+import uuid
+import random
+import hashlib
+import zipfile
+import threading
+import collections
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+from . import synthetic
+
+USERNAME = 'bench'
+PASSWORD = 'bench'
+
+# behavioral uploads as they are named on CBSCentral, see fetch.convert_basename_behavioral
+BEHAVIORAL_FILES = {
+    'EMOTION': 'EMOTION_Run_1',
+    'GUESSING_RUN1': 'GUESSING_Run_1',
+    'GUESSING_RUN2': 'GUESSING_Run_2',
+    'CARIT_RUN1': 'CARIT_Run_1',
+    'CARIT_RUN2': 'CARIT_Run_2',
+    'WORKING_MEMORY': 'WM_Run_1'
+}
+
+Config = collections.namedtuple('Config', ['subjects', 'files_per_scan', 'file_size',
+    'latency', 'jitter', 'bandwidth', 'connection_bandwidth', 'error_rate', 'truncate_rate',
+    'seed', 'project'])
+
+def get_config(subjects=4, files_per_scan=40, file_size=128 * 1024, latency=0.02, jitter=0.01,
+        bandwidth=None, connection_bandwidth=None, error_rate=0.0, truncate_rate=0.0, seed=0,
+        project='STAR_Study'):
+    # bandwidths are bytes per second, None for unlimited; rates are per-request probabilities
+    return Config(subjects, files_per_scan, file_size, latency, jitter, bandwidth,
+        connection_bandwidth, error_rate, truncate_rate, seed, project)
+
+class TokenBucket:
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, n):
+        # blocks until n bytes fit under the rate; one second of burst is allowed
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= n or self.tokens >= self.rate:
+                    self.tokens -= n
+                    return
+                wait = (n - self.tokens) / self.rate
+            time.sleep(wait)
+
+class Archive:
+    # the synthetic project: every subject has the same scan list and behavioral uploads
+    def __init__(self, config):
+        self.config = config
+        rng = np.random.default_rng(config.seed)
+        self.block = rng.integers(0, 256, config.file_size, dtype=np.uint8).tobytes()
+        self.experiments = []
+        for i in range(config.subjects):
+            label = '{:06d}_STAR{:04d}'.format(190101 + i, i + 1)
+            self.experiments.append({'ID': 'CBSCentral_E{:05d}'.format(i + 1), 'label': label,
+                'project': config.project, 'subject_label': 'STAR{:04d}'.format(i + 1),
+                'insert_date': '2019-01-01 00:00:{:02d}.{:06d}'.format(i // 1000000 % 60,
+                i % 1000000)})
+        self.by_id = {e['ID']: e for e in self.experiments}
+        self.behavioral = {}
+        self.digests = {}
+        self.lock = threading.Lock()
+
+    def get_scans(self, experiment_id):
+        return [{'ID': str(i + 1), 'id': str(i + 1), 'type': d, 'series_description': d,
+            'quality': 'usable', 'note': '', 'frames': str(self.config.files_per_scan),
+            'xsiType': 'xnat:mrScanData'} for i, d in enumerate(synthetic.SCANS)]
+
+    def get_dicom(self, experiment_id, scan_id, name):
+        # a DICOM preamble and prefix naming the instance, padded from a shared random block
+        prefix = b'\0' * 128 + b'DICM' + '{}/{}/{}'.format(experiment_id, scan_id,
+            name).encode()
+        return prefix + self.block[len(prefix):]
+
+    def get_behavioral(self, experiment_id, name):
+        with self.lock:
+            if (experiment_id, name) not in self.behavioral:
+                run = BEHAVIORAL_FILES[name]
+                key = '{}/{}'.format(experiment_id, name).encode()
+                rng = np.random.default_rng(int(hashlib.md5(key).hexdigest()[:8], 16))
+                data = pd.DataFrame(synthetic.BEHAVIORAL_DATA[run.split('_')[0]](rng))
+                self.behavioral[(experiment_id, name)] = data.to_csv(index=False).encode()
+            return self.behavioral[(experiment_id, name)]
+
+    def get_digest(self, key, data):
+        with self.lock:
+            if key not in self.digests:
+                self.digests[key] = hashlib.md5(data).hexdigest()
+            return self.digests[key]
+
+    def get_scan_files(self, experiment_id, scan_id):
+        files = []
+        for i in range(self.config.files_per_scan):
+            name = '{}.{}.MR.dcm'.format(scan_id, i + 1)
+            uri = '/data/experiments/{}/scans/{}/resources/DICOM/files/{}'.format(experiment_id,
+                scan_id, name)
+            data = self.get_dicom(experiment_id, scan_id, name)
+            files.append({'Name': name, 'URI': uri, 'Size': str(len(data)),
+                'collection': 'DICOM', 'file_format': 'DICOM',
+                'digest': self.get_digest(uri, data)})
+        return files
+
+    def get_experiment_files(self, experiment_id):
+        files = []
+        for name in BEHAVIORAL_FILES:
+            uri = '/data/experiments/{}/resources/behavioral_task_data/files/{}'.format(
+                experiment_id, name)
+            data = self.get_behavioral(experiment_id, name)
+            files.append({'Name': name, 'URI': uri, 'Size': str(len(data)),
+                'collection': 'behavioral_task_data', 'file_format': 'CSV',
+                'digest': self.get_digest(uri, data)})
+        return files
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = collections.Counter()
+        self.statuses = collections.Counter()
+        self.bytes = collections.Counter()
+        self.injected = collections.Counter()
+        self.ranges = 0
+        self.active = 0
+        self.peak_active = 0
+
+    def open(self):
+        with self.lock:
+            self.active += 1
+            self.peak_active = max(self.peak_active, self.active)
+
+    def close(self, endpoint, status, n):
+        with self.lock:
+            self.active -= 1
+            self.requests[endpoint] += 1
+            self.statuses[status] += 1
+            self.bytes[endpoint] += n
+
+    def inject(self, kind):
+        with self.lock:
+            self.injected[kind] += 1
+
+    def range_request(self):
+        with self.lock:
+            self.ranges += 1
+
+    def to_dict(self):
+        with self.lock:
+            return {'requests': dict(self.requests), 'statuses': dict(self.statuses),
+                'bytes': dict(self.bytes), 'injected': dict(self.injected),
+                'range_requests': self.ranges, 'peak_connections': self.peak_active}
+
+ROUTES = [
+    ('auth', re.compile(r'^/data/JSESSION$')),
+    ('project_experiments', re.compile(r'^/data/projects/(?P<project>[^/]+)/experiments$')),
+    ('experiments', re.compile(r'^/data/experiments$')),
+    ('scans', re.compile(r'^/data/experiments/(?P<experiment>[^/]+)/scans$')),
+    ('scan_files', re.compile(r'^/data/experiments/(?P<experiment>[^/]+)/scans/(?P<scan>[^/]+)'
+        r'/resources/DICOM/files$')),
+    ('dicom', re.compile(r'^/data/experiments/(?P<experiment>[^/]+)/scans/(?P<scan>[^/]+)'
+        r'/resources/DICOM/files/(?P<name>[^/]+)$')),
+    ('experiment_files', re.compile(r'^/data/experiments/(?P<experiment>[^/]+)/files$')),
+    ('behavioral', re.compile(r'^/data/experiments/(?P<experiment>[^/]+)/resources/'
+        r'behavioral_task_data/files/(?P<name>[^/]+)$')),
+    ('stats', re.compile(r'^/bench/stats$'))
+]
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def handle_request(self, method):
+        server = self.server
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        endpoint, match = 'unknown', None
+        for name, pattern in ROUTES:
+            match = pattern.match(url.path)
+            if match:
+                endpoint = name
+                break
+
+        server.stats.open()
+        self.sent = 0
+        status = 500
+        try:
+            if server.config.latency or server.config.jitter:
+                time.sleep(server.config.latency + random.uniform(0, server.config.jitter))
+
+            if endpoint not in ('stats', 'auth') and not self.is_authenticated():
+                status = self.send_body(401, b'Unauthorized', 'text/plain')
+            elif endpoint not in ('stats', 'auth') and random.random() < server.config.error_rate:
+                server.stats.inject('error')
+                status = self.send_body(503, b'Service Unavailable', 'text/plain')
+            elif match is None:
+                status = self.send_body(404, b'Not Found', 'text/plain')
+            else:
+                status = getattr(self, 'get_' + endpoint)(method, params, **match.groupdict())
+
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+        except KeyError:
+            status = self.send_body(404, b'Not Found', 'text/plain')
+        finally:
+            server.stats.close(endpoint, status, self.sent)
+
+    def is_authenticated(self):
+        cookie = self.headers.get('Cookie', '')
+        if any(c.strip() == 'JSESSIONID=' + s for c in cookie.split(';')
+                for s in self.server.sessions):
+            return True
+        return self.headers.get('Authorization') == self.server.basic_auth
+
+    def send_body(self, status, body, content_type, headers=None, throttle=False):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+
+        # a truncated response promises the whole body and hangs up part way through it
+        end = len(body)
+        if throttle and body and random.random() < self.server.config.truncate_rate:
+            self.server.stats.inject('truncate')
+            end = random.randrange(len(body))
+            self.close_connection = True
+
+        bucket = self.server.bucket
+        rate = self.server.config.connection_bandwidth
+        t = time.monotonic()
+        for i in range(0, end, 1 << 16):
+            chunk = body[i:min(i + (1 << 16), end)]
+            if throttle and bucket is not None:
+                bucket.consume(len(chunk))
+            self.wfile.write(chunk)
+            self.sent += len(chunk)
+            if throttle and rate:
+                delay = self.sent / rate - (time.monotonic() - t)
+                if delay > 0:
+                    time.sleep(delay)
+        return status
+
+    def send_json(self, result):
+        body = json.dumps({'ResultSet': {'Result': result, 'totalRecords': str(len(result))}})
+        return self.send_body(200, body.encode(), 'application/json')
+
+    def send_file(self, data, content_type='application/octet-stream'):
+        header = self.headers.get('Range')
+        m = re.match(r'^bytes=(\d+)-(\d*)$', header or '')
+        if not m:
+            return self.send_body(200, data, content_type, {'Accept-Ranges': 'bytes'}, True)
+
+        self.server.stats.range_request()
+        start = int(m.group(1))
+        end = min(int(m.group(2)) if m.group(2) else len(data) - 1, len(data) - 1)
+        if start >= len(data):
+            return self.send_body(416, b'', content_type,
+                {'Content-Range': 'bytes */{}'.format(len(data))})
+        return self.send_body(206, data[start:end + 1], content_type,
+            {'Content-Range': 'bytes {}-{}/{}'.format(start, end, len(data))}, True)
+
+    def get_auth(self, method, params):
+        if method == 'DELETE':
+            return self.send_body(200, b'', 'text/plain')
+        if self.headers.get('Authorization') != self.server.basic_auth:
+            return self.send_body(401, b'Unauthorized', 'text/plain')
+        session = uuid.uuid4().hex
+        self.server.sessions.add(session)
+        return self.send_body(200, session.encode(), 'text/plain',
+            {'Set-Cookie': 'JSESSIONID={}; Path=/'.format(session)})
+
+    def get_stats(self, method, params):
+        return self.send_body(200, json.dumps(self.server.stats.to_dict()).encode(),
+            'application/json')
+
+    def get_project_experiments(self, method, params, project):
+        archive = self.server.archive
+        experiments = [e for e in archive.experiments if e['project'] == project]
+        if params.get('sortBy') == 'insert_date':
+            experiments.sort(key=lambda e: e['insert_date'],
+                reverse=params.get('sortOrder', '').upper() == 'DESC')
+        offset = int(params.get('offset', 0))
+        limit = int(params['limit']) if 'limit' in params else len(experiments)
+        return self.send_json(experiments[offset:offset + limit])
+
+    def get_experiments(self, method, params):
+        # label lookups return sessions; scan queries (yaxil asks for xnat:mrscandata/...
+        # columns) return one row per scan with whichever columns were requested
+        archive = self.server.archive
+        experiments = archive.experiments
+        for key in ['label', 'ID', 'project']:
+            if key in params:
+                experiments = [e for e in experiments if e[key] == params[key]]
+
+        columns = [c for c in params.get('columns', '').split(',') if c]
+        if not any('scandata/' in c.lower() for c in columns):
+            return self.send_json(experiments)
+
+        rows = []
+        for e in experiments:
+            session = dict(e, session_label=e['label'], session_id=e['ID'])
+            for s in archive.get_scans(e['ID']):
+                rows.append({c: s.get(c.split('/')[-1].lower(), '') if 'scandata/' in c.lower()
+                    else session.get(c.split('/')[-1], '') for c in columns})
+        return self.send_json(rows)
+
+    # unknown experiments raise KeyError, which handle_request answers with a 404
+    def get_scans(self, method, params, experiment):
+        archive = self.server.archive
+        return self.send_json(archive.get_scans(archive.by_id[experiment]['ID']))
+
+    def get_scan_files(self, method, params, experiment, scan):
+        archive = self.server.archive
+        files = archive.get_scan_files(archive.by_id[experiment]['ID'], scan)
+        if params.get('format') != 'zip':
+            return self.send_json(files)
+
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as z:
+            for f in files:
+                z.writestr('{}/scans/{}/resources/DICOM/files/{}'.format(experiment, scan,
+                    f['Name']), archive.get_dicom(experiment, scan, f['Name']))
+        return self.send_file(buffer.getvalue(), 'application/zip')
+
+    def get_dicom(self, method, params, experiment, scan, name):
+        archive = self.server.archive
+        return self.send_file(archive.get_dicom(archive.by_id[experiment]['ID'], scan, name))
+
+    def get_experiment_files(self, method, params, experiment):
+        archive = self.server.archive
+        return self.send_json(archive.get_experiment_files(archive.by_id[experiment]['ID']))
+
+    def get_behavioral(self, method, params, experiment, name):
+        archive = self.server.archive
+        return self.send_file(archive.get_behavioral(archive.by_id[experiment]['ID'], name),
+            'text/csv')
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, config):
+        super().__init__(address, Handler)
+        self.config = config
+        self.archive = Archive(config)
+        self.stats = Stats()
+        self.sessions = set()
+        self.bucket = TokenBucket(config.bandwidth) if config.bandwidth else None
+        self.basic_auth = 'Basic ' + base64.b64encode('{}:{}'.format(USERNAME,
+            PASSWORD).encode()).decode()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+def start(config, host='127.0.0.1', port=0):
+    server = Server((host, port), config)
+    server.thread = threading.Thread(target=server.serve_forever, name='xnat-standin',
+        daemon=True)
+    server.thread.start()
+    return server
+
+def stop(server):
+    server.shutdown()
+    server.server_close()
@@ -1,13 +1,21 @@
 #!/usr/bin/env python3
 
 import os
+import glob
 import pandas as pd
 import yaxil
 import collections
 import json
 import logging
+import queue
+import itertools
+import shutil
+import threading
+import concurrent.futures as cf
 from nipype.interfaces.dcm2nii import Dcm2niix
-from nipype.interfaces.fsl import ExtractROI
+
+from . import xnat, nifti, compress, cache
+from util import catalog, metrics
 
 logger = logging.getLogger(__name__)
 
@@ -15,16 +23,74 @@ def authenticate():
     auth = yaxil.auth(alias='cbscentral', cfg='~/.cbsauth')
     return auth
 
-def get_scan_metadata(auth, subject_cbs_id):
-    data = []
+def discover_experiments(sess, study_dir, project, ttl=24 * 3600, refresh=False):
+    path = cache.get_cache_path(study_dir, 'projects', project, 'experiments')
+    experiments, fresh = (None, False) if refresh else cache.load(path, ttl)
+
+    if experiments is not None and fresh:
+        logger.info(f'Using the cached listing of {len(experiments)} {project} experiments.')
+        return sorted(e['label'] for e in experiments.values())
+
+    # a stale listing is only topped up with experiments inserted since; refresh lists it all
+    known = experiments or {}
+    try:
+        listing = xnat.list_experiments(sess, project, known)
+    except Exception as e:
+        logger.exception(e)
+        if experiments is None:
+            logger.critical(f'Could not list the experiments of {project}.')
+            raise
+        logger.warning(f'Could not refresh the {project} listing. Using the cached listing.')
+        listing = []
+
+    added = [e for e in listing if e['ID'] not in known]
+    experiments = dict(known, **{e['ID']: e for e in listing})
+    cache.save(path, experiments)
+    logger.info(f'Listed {len(experiments)} {project} experiments ({len(added)} new).')
+
+    return sorted(e['label'] for e in experiments.values())
+
+def get_experiment_cache_path(study_dir, subject_cbs_id, name):
+    return cache.get_cache_path(study_dir, 'experiments', subject_cbs_id, name)
+
+def invalidate_experiment(study_dir, subject_cbs_id):
+    for name in ['id', 'scans', 'files']:
+        cache.invalidate(get_experiment_cache_path(study_dir, subject_cbs_id, name))
+
+def get_experiment_id(sess, subject_cbs_id, study_dir=None):
+    # experiment IDs never change, so they are cached without a TTL
+    path = study_dir and get_experiment_cache_path(study_dir, subject_cbs_id, 'id')
+    experiment_id, _ = cache.load(path) if path else (None, False)
+
+    if experiment_id is None:
+        experiment_id = xnat.get_experiment_id(sess, subject_cbs_id)
+        if path:
+            cache.save(path, experiment_id)
+
+    return experiment_id
+
+def get_scan_metadata(sess, subject_cbs_id, study_dir=None, ttl=None, refresh=False):
+    path = study_dir and get_experiment_cache_path(study_dir, subject_cbs_id, 'scans')
+    if path and not refresh:
+        data, fresh = cache.load(path, ttl)
+        if data and fresh:
+            logger.info(f'Using cached scan metadata for {subject_cbs_id}.')
+            return data
+
+    # listed through the shared session, so the request is retried like any other; keys are
+    # lower-cased to the column names the scan CSV has always had (id, series_description)
     try:
-        with yaxil.session(auth) as sess:
-            for e in sess.experiments(label=subject_cbs_id):
-                for s in sess.scans(experiment=e):
-                    data += [pd.DataFrame.from_dict(s, orient='index')]       
+        experiment_id = get_experiment_id(sess, subject_cbs_id, study_dir)
+        data = [{k.lower(): v for k, v in s.items()} for s in xnat.get_scans(sess,
+            experiment_id)]
 
     except Exception as e:
         logger.exception(e)
+        logger.error(f'Could not list the scans of {subject_cbs_id}.')
+        raise
+
+    if path and data:
+        cache.save(path, data)
 
     return data
 
@@ -32,9 +98,10 @@ def save_scan_metadata(study_dir, subject_bids_id, data):
     source_path = get_source_path(study_dir, subject_bids_id)
     p = os.path.join(source_path, subject_bids_id + '.csv')
     try:
-        data = pd.concat(data, axis=1).T
-        data['scan_num'] = pd.to_numeric(df['id'])
-        data.sort_values('scan_num')
+        os.makedirs(source_path, exist_ok=True)
+        data = pd.DataFrame.from_records(data)
+        data['scan_num'] = pd.to_numeric(data['id'])
+        data = data.sort_values('scan_num')
         data.to_csv(p, header=True, index=False, sep=',')
 
     except Exception as e:
@@ -44,45 +111,52 @@ def save_scan_metadata(study_dir, subject_bids_id, data):
  
     return data
 
-def get_behavioral_data(auth, subject_cbs_id):
+def get_experiment_files(sess, subject_cbs_id, study_dir=None, ttl=None, refresh=False):
+    path = study_dir and get_experiment_cache_path(study_dir, subject_cbs_id, 'files')
+    if path and not refresh:
+        result, fresh = cache.load(path, ttl)
+        if result is not None and fresh:
+            return result
+
+    experiment_id = get_experiment_id(sess, subject_cbs_id, study_dir)
+    result = xnat.get_experiment_files(sess, experiment_id)
+    # an empty listing may be an upload still in progress, so it is fetched again next time
+    if path and result:
+        cache.save(path, result)
+    return result
+
+def get_behavioral_data(sess, subject_cbs_id, study_dir=None, ttl=None, refresh=False):
+    behavioral_data = []
     try:
-        with yaxil.session(auth) as sess:
-            for e in sess.experiments(label=subject_cbs_id):
-                behavioral_data = []
-                try:
-                    _, res = yaxil._get(sess._auth, experiment.uri + '/files', yaxil.Format.JSON)
-                    result = res['ResultSet']['Result']
-                    behavioral_data = [r for r in result if r['collection'] == 'behavioral_task_data']
-                except Exception as e:
-                    logger.exception(e)
-                finally:
-                    yield behavioral_data
+        result = get_experiment_files(sess, subject_cbs_id, study_dir, ttl, refresh)
+        behavioral_data = [r for r in result if r['collection'] == 'behavioral_task_data']
 
     except Exception as e:
         logger.exception(e)
 
-def save_behavioral_data(auth, study_dir, subject_bids_id, data):
-    try:
-        with yaxil.session(auth) as sess:
-            for d in data:
-                res = bytes('', 'utf8')
-                uri = d['URI']
-                source_path = get_source_path(study_dir, subject_bids_id)
-                file_path = get_file_name(uri, source_path, 'behavioral')
+    return behavioral_data
 
-                try:
-                    _, res = yaxil._get(sess._auth, uri, yaxil.Format.JSON, autobox=False)
+@metrics.instrument('save_behavioral_data', subject='subject_bids_id')
+def save_behavioral_data(sess, study_dir, subject_bids_id, data):
+    source_path = get_source_path(study_dir, subject_bids_id)
+    os.makedirs(os.path.join(source_path, 'behavioral_files'), exist_ok=True)
+    failed = []
 
-                except Exception as e:
-                    logger.exception(e)
+    for d in data:
+        uri = d['URI']
+        file_path = get_file_name(uri, source_path, 'behavioral')
 
-                finally:
-                    with open(file_path, 'wb') as f:
-                        logger.info(f'Writing {file_path}')
-                        f.write(res)
+        try:
+            logger.info(f'Writing {file_path}')
+            xnat.download_file(sess, uri, file_path, d.get('Size'), d.get('digest'))
 
-    except Exception as e:
-        logger.exception(e)
+        except Exception as e:
+            logger.exception(e)
+            failed.append(uri)
+
+    if failed:
+        logger.error(f'Could not save behavioral data for {subject_bids_id}: {failed}')
+        raise
 
 def get_file_name(uri, source_path, file_type):
     basename = uri.split('files/')[-1]
@@ -113,16 +187,106 @@ def convert_basename_behavioral(basename):
         logger.error('Cannot convert the behavioral filename. Please update the reference.')
         raise
 
-def get_scan_data(auth, subject_cbs_id, subject_bids_id, metadata, study_dir):
+class ScratchBudget:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, n):
+        with self.cond:
+            if n > self.max_bytes:
+                logger.warning(f'Scan of {n} bytes exceeds the scratch limit. Running it alone.')
+            self.cond.wait_for(lambda: self.used == 0 or self.used + n <= self.max_bytes)
+            self.used += n
+
+    def release(self, n):
+        with self.cond:
+            self.used -= n
+            self.cond.notify_all()
+
+@metrics.instrument('get_scan_data', subject='subject_bids_id')
+def get_scan_data(sess, subject_cbs_id, subject_bids_id, metadata, study_dir, max_workers=4,
+        convert_workers=2, max_scratch_bytes=None, compression=None):
+    experiment_id = get_experiment_id(sess, subject_cbs_id, study_dir)
     runs = collections.defaultdict(int)
+    scans = []
 
     for row in metadata:
         scan_id = row['id']
         description = row['series_description']
         runs[description] += 1
         run = runs[description]
-        save_scan_data(auth, subject_cbs_id, subject_bids_id, scan_id, study_dir, description, run)
-        save_fmap(study_dir, subject_bids_id)
+        scans.append((scan_id, description, run))
+
+    catalog.record_subject(study_dir, subject_bids_id, subject_cbs_id, experiment_id)
+    catalog.record_scans(study_dir, subject_bids_id, scans)
+
+    n = len(scans)
+    budget = ScratchBudget(max_scratch_bytes) if max_scratch_bytes else None
+    conversions = queue.Queue()
+    progress = itertools.count(1)
+    failed = []
+
+    converters = [threading.Thread(target=convert_scan_data, name=f'convert-{i}',
+        args=(conversions, budget, subject_bids_id, n, progress, failed, compression, study_dir))
+        for i in range(convert_workers)]
+    for t in converters:
+        t.start()
+
+    try:
+        with cf.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            for scan_id, description, run in scans:
+                fut = executor.submit(save_scan_data, sess, experiment_id, subject_bids_id,
+                    scan_id, study_dir, description, run, conversions, budget)
+                futures[fut] = scan_id
+
+            for fut in cf.as_completed(futures):
+                scan_id = futures[fut]
+                try:
+                    fut.result()
+                except Exception:
+                    logger.error(f'Could not download scan {scan_id} for {subject_bids_id}')
+                    failed.append(scan_id)
+
+    finally:
+        for t in converters:
+            conversions.put(None)
+        for t in converters:
+            t.join()
+
+    if failed:
+        logger.error(f'{len(failed)} of {n} scans failed for {subject_bids_id}: {failed}')
+        raise
+
+    save_fmap(study_dir, subject_bids_id)
+
+def convert_scan_data(conversions, budget, subject_bids_id, n, progress, failed,
+        compression=None, study_dir=None):
+    while True:
+        item = conversions.get()
+        if item is None:
+            return
+
+        scan_id, scan_dir, nii_path, size = item
+        try:
+            with metrics.span('convert_dcm_to_nii', subject=subject_bids_id, scan=scan_id):
+                convert_dcm_to_nii(scan_dir, nii_path, compression)
+                metrics.add(bytes=os.path.getsize(nii_path), files=1)
+            if study_dir:
+                catalog.record_files(study_dir, [nii_path, nii_path.replace('.nii.gz', '.json')])
+            logger.info(f'[{next(progress)}/{n}] Saved scan {scan_id} for {subject_bids_id}')
+
+        except Exception as e:
+            logger.exception(e)
+            failed.append(scan_id)
+
+        finally:
+            # converted DICOMs only occupy scratch space when the budget is bounded
+            if budget is not None:
+                shutil.rmtree(scan_dir, ignore_errors=True)
+                budget.release(size)
 
 def get_opp_direction(direction):
     if direction == 'ap':
@@ -145,9 +309,12 @@ def get_direction(nii_path):
         logger.error(f'Could not parse direction from {nii_path}.')
         raise
 
-def get_phase_encoding_direction(nii_path):
+def get_phase_encoding_direction(nii_path, study_dir=None):
     b = nii_path.replace('.nii.gz', '.json')
     try:
+        # the catalog keeps each image's sidecar, so the JSON is only read when it is missing
+        if study_dir:
+            return catalog.get_metadata(study_dir, nii_path)['PhaseEncodingDirection']
         with open(b) as f:
             return json.load(f)['PhaseEncodingDirection']
     except Exception as e:
@@ -172,61 +339,125 @@ def save_phase_encoding_direction(output_json, nii_path, phase_encoding_directio
         logger.error(f'Could not save phase encoding direction metadata {output_json}.')
         raise
 
-def save_fmap(study_dir, subject_bids_id):
+@metrics.instrument('save_fmap', subject='subject_bids_id')
+def save_fmap(study_dir, subject_bids_id, max_workers=4, fmap_volumes=10):
     subject_dir = os.path.join(study_dir, subject_bids_id)
     fmap_dir = os.path.join(subject_dir, 'fmap')
     func_dir = os.path.join(subject_dir, 'func')
-    bolds = glob.glob(os.path.join(func_dir, '*bold.nii.gz'))
+    bolds = catalog.find_files(study_dir, os.path.join(func_dir, '*bold.nii.gz'))
 
+    pairs = []
     for b in bolds:
         direction = get_direction(b)
         opposite_direction = get_opp_direction(direction)
         opposite_func = b.replace(direction, opposite_direction)
 
-        if not os.path.exists(opposite_func):
-            continue
+        if os.path.exists(opposite_func):
+            pairs.append((b, opposite_func))
 
-        epi_nii = b.replace('bold', 'epi').replace('func', 'fmap')
-        epi_json = epi_nii.replace('.nii.gz', '.json')
-        ExtractROI(in_file=b, roi_file=epi_nii, t_min=0, t_size=10, output_type='NIFTI_GZ')
-        
-        phase_encoding_direction = get_phase_encoding_direction(b)
-        save_phase_encoding_direction(epi_json, opposite_func, phase_encoding_direction)
+    if not pairs:
+        return
+
+    os.makedirs(fmap_dir, exist_ok=True)
+    with cf.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(save_fmap_run, b, opposite_func, fmap_volumes, study_dir): b
+            for b, opposite_func in pairs}
+
+        failed, saved = [], []
+        for fut in cf.as_completed(futures):
+            try:
+                saved += fut.result()
+            except Exception as e:
+                logger.exception(e)
+                logger.error(f'Could not save the fieldmap for {futures[fut]}')
+                failed.append(futures[fut])
+
+    catalog.record_files(study_dir, saved)
+    metrics.add(bytes=sum(os.path.getsize(f) for f in saved), files=len(saved))
+
+    if failed:
+        logger.error(f'{len(failed)} fieldmaps failed for {subject_bids_id}: {failed}')
+        raise
 
-def save_scan_data(auth, subject_cbs_id, subject_bids_id, scan_id, study_dir, description, run):
+def save_fmap_run(bold, opposite_func, fmap_volumes=10, study_dir=None):
+    epi_nii = bold.replace('bold', 'epi').replace('func', 'fmap')
+    epi_json = epi_nii.replace('.nii.gz', '.json')
+    tmp = epi_nii.replace('.nii.gz', '.part.nii.gz')
+
+    # same volumes as fslroi <bold> <epi> 0 10, without decompressing the whole run
+    nifti.extract_volumes(bold, tmp, fmap_volumes)
+    os.replace(tmp, epi_nii)
+
+    phase_encoding_direction = get_phase_encoding_direction(bold, study_dir)
+    save_phase_encoding_direction(epi_json, opposite_func, phase_encoding_direction)
+    return [epi_nii, epi_json]
+
+def save_scan_data(sess, experiment_id, subject_bids_id, scan_id, study_dir, description, run,
+        conversions, budget=None):
+    size = 0
     try:
         source_path = get_source_path(study_dir, subject_bids_id)
         dcm_dir = os.path.join(source_path, 'dicom')
         scan_dir = os.path.join(dcm_dir, scan_id)
+        nii_path = get_nii_path(study_dir, subject_bids_id, run, description)
         os.makedirs(scan_dir, exist_ok=True)
 
-        with yaxil.session(auth) as sess:
-            sess.download(subject_cbs_id, scan_ids=[scan_id], out_dir=scan_dir, progress=True)
-        
-        nii_path = get_nii_path(study_dir, subject_bids_id, run, description)
-        convert_dcm_to_nii(scan_dir, nii_path)
+        files = xnat.get_scan_files(sess, experiment_id, scan_id)
+        if budget is not None:
+            size = sum(int(f['Size']) for f in files)
+            budget.acquire(size)
+
+        # the span starts after the scratch budget is granted so waiting is not counted
+        with metrics.span('download_scan', subject=subject_bids_id, scan=scan_id):
+            n = xnat.download_scan(sess, experiment_id, scan_id, scan_dir, files)
+        logger.info(f'Downloaded scan {scan_id} ({n} bytes)')
+        conversions.put((scan_id, scan_dir, nii_path, size))
 
     except Exception as e:
         logger.exception(e)
         logger.error('Could not save scan data.')
+        if budget is not None and size:
+            budget.release(size)
         raise
  
-def convert_dcm_to_nii(scan_dir, nii_path):
+def convert_dcm_to_nii(scan_dir, nii_path, compression=None):
+    # with compression ({'threads': n, 'level': l}) dcm2niix writes .nii and the output is
+    # gzipped block-parallel afterwards instead of by dcm2niix's single-threaded gzip
+    out_dir = os.path.dirname(nii_path)
+    out_filename = os.path.basename(nii_path).replace('.nii.gz', '')
     try:
         converter = Dcm2niix()
         converter.inputs.source_dir = scan_dir
-        converter.inputs.out_filename = os.path.basename(nii_path)
-        converter.inputs.output_dir = os.path.dirname(nii_path)
+        converter.inputs.out_filename = out_filename
+        converter.inputs.output_dir = out_dir
         converter.inputs.single_file = True
         converter.inputs.bids_format = True
-        converter.inputs.compress = 'y'
+        converter.inputs.compress = 'n' if compression else 'y'
         logger.info(converter.cmdline)
         converter.run()
 
     except Exception as e:
         logger.exception(e)
+        logger.error(f'Could not convert {scan_dir} to {nii_path}.')
+        raise
+
+    # a failed gzip fails the scan too: the .nii it leaves behind is invisible to the
+    # *.nii.gz globs downstream
+    if compression:
+        for f in glob.glob(os.path.join(out_dir, glob.escape(out_filename) + '*.nii')):
+            try:
+                compress.gzip_file(f, compression.get('level', 6), compression.get('threads'))
+            except Exception as e:
+                logger.exception(e)
+                logger.error(f'Could not gzip {f}.')
+                raise
+
+    # dcm2niix can exit cleanly without writing anything, e.g. for a scan with no images
+    if not os.path.exists(nii_path):
+        logger.error(f'dcm2niix did not write {nii_path}.')
+        raise
 
-def get_fmri_filepath(study_dir, subject_bids_id, task, direction, run, scan_type)
+def get_fmri_filepath(study_dir, subject_bids_id, task, direction, run, scan_type):
     nii_filename = '{s}_task-{t}_dir-{d}_run-{r}_{st}.nii.gz'.format(s=subject_bids_id,
         t=task, d=direction, r=run, st=scan_type)
     return os.path.join(study_dir, subject_bids_id, 'func', nii_filename)
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+
+import os
+import random
+import asyncio
+import logging
+import threading
+import collections
+import urllib.parse
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from . import xnat
+
+logger = logging.getLogger(__name__)
+
+ATTEMPTS = 5
+BACKOFF = 0.5
+BACKOFF_MAX = 30
+
+# a request may wait on a slow XNAT for a long time, but not on a dead connection
+CONNECT_TIMEOUT = 30
+READ_TIMEOUT = 300
+
+# chunks of one file read ahead of the disk before reading waits for a write
+MAX_PENDING_WRITES = 8
+
+Session = collections.namedtuple('Session', ['url', 'auth', 'loop', 'thread', 'http',
+    'semaphore', 'limiters', 'rate'])
+
+class RetryableError(Exception):
+    pass
+
+def is_available():
+    return aiohttp is not None
+
+class RateLimiter:
+    # spaces request starts 1/rate seconds apart; only touched from the session's event loop
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next = 0
+
+    async def wait(self):
+        now = asyncio.get_running_loop().time()
+        start = max(now, self.next)
+        self.next = start + self.interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+def get_limiter(sess, url):
+    if not sess.rate:
+        return None
+    host = urllib.parse.urlsplit(url).netloc
+    if host not in sess.limiters:
+        sess.limiters[host] = RateLimiter(sess.rate)
+    return sess.limiters[host]
+
+def get_backoff(attempt):
+    # full jitter: anywhere up to the exponential bound, so retrying clients spread out
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF * 2 ** (attempt - 1)))
+
+def is_retryable(e):
+    if isinstance(e, aiohttp.ClientResponseError):
+        return e.status >= 500 or e.status == 429
+    return isinstance(e, (RetryableError, aiohttp.ClientConnectionError,
+        aiohttp.ClientPayloadError, asyncio.TimeoutError))
+
+async def login(sess):
+    auth = aiohttp.BasicAuth(sess.auth.username, sess.auth.password)
+    async with sess.http.post(sess.url + '/data/JSESSION', auth=auth) as r:
+        r.raise_for_status()
+
+async def call(sess, url, func, attempts=ATTEMPTS):
+    # func(url) does one request; it is retried with backoff on 5xx, 429, timeouts and broken
+    # connections, and once after logging in again if the session expired
+    relogged = False
+    for attempt in range(1, attempts + 1):
+        try:
+            async with sess.semaphore:
+                limiter = get_limiter(sess, url)
+                if limiter:
+                    await limiter.wait()
+                return await func(url)
+
+        except Exception as e:
+            if isinstance(e, aiohttp.ClientResponseError) and e.status == 401 and not relogged:
+                logger.warning('XNAT session expired. Logging in again.')
+                await login(sess)
+                relogged = True
+                continue
+            if not is_retryable(e) or attempt == attempts:
+                raise
+
+            delay = get_backoff(attempt)
+            logger.warning(f'{url} failed (attempt {attempt}/{attempts}): {e!r}. Retrying in '
+                f'{delay:.1f}s.')
+            await asyncio.sleep(delay)
+
+async def open_session(url, auth, max_connections, rate):
+    connector = aiohttp.TCPConnector(limit=max_connections, limit_per_host=max_connections)
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=CONNECT_TIMEOUT,
+        sock_read=READ_TIMEOUT)
+    # unsafe lets the JSESSIONID cookie stick to hosts given by IP address
+    http = aiohttp.ClientSession(connector=connector, timeout=timeout,
+        cookie_jar=aiohttp.CookieJar(unsafe=True), raise_for_status=False)
+    sess = Session(url, auth, asyncio.get_running_loop(), threading.current_thread(), http,
+        asyncio.Semaphore(max_connections), {}, rate)
+    try:
+        await call(sess, url + '/data/JSESSION', lambda u: login(sess))
+    except Exception:
+        await http.close()
+        raise
+    return sess
+
+def connect(auth, max_connections=8, rate=None):
+    # the event loop runs in its own thread, so synchronous callers on any thread can share
+    # one connection pool and one concurrency limit
+    url = auth.url.rstrip('/')
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, name='xnat-aio', daemon=True)
+    thread.start()
+
+    try:
+        sess = asyncio.run_coroutine_threadsafe(open_session(url, auth, max_connections, rate),
+            loop).result()
+    except Exception as e:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+        logger.exception(e)
+        logger.critical(f'Could not authenticate with {url}.')
+        raise
+
+    logger.info(f'Opened asynchronous XNAT session with {url} ({max_connections} requests in '
+        f'flight{f", {rate} requests/s" if rate else ""}).')
+    return sess
+
+def run(sess, coro):
+    return asyncio.run_coroutine_threadsafe(coro, sess.loop).result()
+
+async def logout(sess):
+    try:
+        async with sess.http.delete(sess.url + '/data/JSESSION'):
+            pass
+    except Exception as e:
+        logger.exception(e)
+    finally:
+        await sess.http.close()
+
+def close(sess):
+    try:
+        run(sess, logout(sess))
+    finally:
+        sess.loop.call_soon_threadsafe(sess.loop.stop)
+        sess.thread.join()
+        sess.loop.close()
+
+async def get_json(sess, path, params=None):
+    params = dict(params or {})
+    params['format'] = 'json'
+
+    async def request(url):
+        async with sess.http.get(url, params=params) as r:
+            r.raise_for_status()
+            return (await r.json(content_type=None))['ResultSet']['Result']
+
+    return await call(sess, xnat.get_url(sess, path), request)
+
+async def get_scan_files(sess, experiment_id, scan_id):
+    path = f'/data/experiments/{experiment_id}/scans/{scan_id}/resources/DICOM/files'
+    return await get_json(sess, path)
+
+async def write_after(previous, opening, chunk):
+    # chained so the chunks of one file are written in order
+    await previous
+    f = await opening
+    await asyncio.get_running_loop().run_in_executor(None, f.write, chunk)
+
+def get_size(path):
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+async def download_file(sess, uri, file_path, size=None, digest=None, chunk_size=1 << 20):
+    # returns the bytes downloaded, 0 when the file was already there; checksums run off the
+    # event loop so they do not stall other transfers
+    loop = asyncio.get_running_loop()
+    if os.path.exists(file_path) and await loop.run_in_executor(None, xnat.verify_file, file_path,
+            size, digest):
+        logger.info(f'{file_path} is already downloaded.')
+        return 0
+
+    # stream into a partial file and resume it with a range request after an interruption
+    part = file_path + '.part'
+
+    async def request(url):
+        offset = await loop.run_in_executor(None, get_size, part)
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+
+        async with sess.http.get(url, headers=headers) as r:
+            # 416 means the partial file already holds every byte
+            if r.status != 416:
+                r.raise_for_status()
+                if offset and r.status != 206:
+                    offset = 0
+
+                # the file is opened and written in the default executor, since disk I/O can
+                # block for long on NFS. Reading runs ahead of the writes, as aiohttp drops
+                # buffered bytes once a cut-off response raises, but only by a few chunks so a
+                # slow disk does not pull the whole file into memory; a connection cut while
+                # reading waits loses at most aiohttp's buffer, which the resume reads again
+                opening = loop.run_in_executor(None, open, part, 'ab' if offset else 'wb')
+                writes = opening
+                pending = collections.deque()
+                try:
+                    async for chunk in r.content.iter_chunked(chunk_size):
+                        if len(pending) == MAX_PENDING_WRITES:
+                            await pending.popleft()
+                        writes = asyncio.ensure_future(write_after(writes, opening, chunk))
+                        pending.append(writes)
+                finally:
+                    try:
+                        await writes
+                    finally:
+                        await loop.run_in_executor(None, (await opening).close)
+
+        if not await loop.run_in_executor(None, xnat.verify_file, part, size, digest):
+            await loop.run_in_executor(None, os.remove, part)
+            raise RetryableError(f'{file_path} does not match the size or checksum reported by '
+                'XNAT.')
+
+    await call(sess, xnat.get_url(sess, uri), request)
+    await loop.run_in_executor(None, os.replace, part, file_path)
+    return await loop.run_in_executor(None, get_size, file_path)
+
+async def download_files(sess, files):
+    # files are (uri, file_path, size, digest); all of them are requested at once and the
+    # session semaphore decides how many are actually in flight
+    results = await asyncio.gather(*[download_file(sess, *f) for f in files],
+        return_exceptions=True)
+    for r in results:
+        if isinstance(r, BaseException):
+            raise r
+    return results
+
+async def download_scan(sess, experiment_id, scan_id, out_dir, files=None):
+    if files is None:
+        files = await get_scan_files(sess, experiment_id, scan_id)
+
+    return await download_files(sess, [(f['URI'], os.path.join(out_dir,
+        os.path.basename(f['Name'])), f.get('Size'), f.get('digest')) for f in files])
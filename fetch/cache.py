@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+def get_cache_dir(study_dir):
+    return os.path.join(study_dir, 'derivatives', 'xnat-cache')
+
+def get_cache_path(study_dir, *names):
+    return os.path.join(get_cache_dir(study_dir), *names) + '.json'
+
+def load(path, ttl=None):
+    # returns (data, fresh); data is None when there is no usable cache entry
+    try:
+        with open(path) as f:
+            entry = json.load(f)
+    except FileNotFoundError:
+        return None, False
+    except Exception as e:
+        logger.exception(e)
+        logger.warning(f'Ignoring unreadable XNAT cache {path}.')
+        return None, False
+
+    fresh = ttl is None or time.time() - entry['updated'] < ttl
+    return entry['data'], fresh
+
+def save(path, data):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'updated': time.time(), 'data': data}, f, default=str)
+        os.replace(tmp, path)
+
+    except Exception as e:
+        logger.exception(e)
+        logger.warning(f'Could not write XNAT cache {path}.')
+
+def invalidate(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
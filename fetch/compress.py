@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+import os
+import zlib
+import struct
+import shutil
+import subprocess
+import concurrent.futures as cf
+
+BLOCK_SIZE = 1 << 17
+DICT_SIZE = 1 << 15
+
+def get_threads(threads=None):
+    return threads or os.cpu_count() or 1
+
+def compress_block(block, dictionary, level, last):
+    # raw deflate primed with the previous block's tail, as pigz does; a sync flush ends every
+    # block on a byte boundary so the pieces concatenate into one deflate stream
+    c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, 9, zlib.Z_DEFAULT_STRATEGY,
+        *([dictionary] if dictionary else []))
+    return c.compress(block) + c.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+def read_blocks(f, block_size):
+    block = f.read(block_size)
+    while block:
+        following = f.read(block_size)
+        yield block, not following
+        block = following
+
+def gzip_header(mtime):
+    return b'\x1f\x8b\x08\x00' + struct.pack('<I', mtime & 0xffffffff) + b'\x00\x03'
+
+def parallel_gzip(in_path, out_path, level=6, threads=None, block_size=BLOCK_SIZE):
+    threads = get_threads(threads)
+    crc, size, tail = 0, 0, b''
+
+    with open(in_path, 'rb') as f, open(out_path, 'wb') as out, \
+            cf.ThreadPoolExecutor(max_workers=threads) as executor:
+        out.write(gzip_header(int(os.stat(in_path).st_mtime)))
+
+        # keep a bounded window of blocks in flight and write them back in order
+        pending = []
+        for block, last in read_blocks(f, block_size):
+            pending.append(executor.submit(compress_block, block, tail, level, last))
+            tail = block[-DICT_SIZE:]
+            crc = zlib.crc32(block, crc)
+            size += len(block)
+
+            if len(pending) >= threads * 4:
+                out.write(pending.pop(0).result())
+
+        for fut in pending:
+            out.write(fut.result())
+
+        # an empty input still needs one final deflate block
+        if not size:
+            out.write(compress_block(b'', b'', level, True))
+
+        out.write(struct.pack('<II', crc & 0xffffffff, size & 0xffffffff))
+
+def gzip_file(path, level=6, threads=None):
+    # compress path to path.gz and remove path, like gzip/pigz
+    gz_path = path + '.gz'
+    tmp = gz_path + '.part'
+
+    try:
+        pigz = shutil.which('pigz')
+        if pigz:
+            with open(tmp, 'wb') as out:
+                subprocess.run([pigz, '-c', '-{}'.format(level), '-p', str(get_threads(threads)),
+                    path], stdout=out, check=True)
+        else:
+            parallel_gzip(path, tmp, level, threads)
+
+        shutil.copystat(path, tmp)
+        os.replace(tmp, gz_path)
+        os.remove(path)
+
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    return gz_path
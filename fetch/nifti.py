@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+import gzip
+import numpy as np
+import nibabel as nib
+
+HEADER_SIZE = 348
+
+def read_exact(f, n):
+    data = f.read(n)
+    if len(data) != n:
+        raise EOFError('Expected {} bytes, read {}'.format(n, len(data)))
+    return data
+
+def extract_volumes(in_file, out_file, t_size, t_min=0, compresslevel=6, chunk_size=1 << 22):
+    # only the header and the requested volumes are decompressed; the rest of the run is never read
+    with gzip.open(in_file, 'rb') as f:
+        header = nib.Nifti1Header(read_exact(f, HEADER_SIZE), check=False)
+        vox_offset = int(header['vox_offset'])
+        extensions = read_exact(f, vox_offset - HEADER_SIZE)
+
+        dim = header['dim'].copy()
+        if dim[0] < 4 or any(d > 1 for d in dim[5:dim[0] + 1]):
+            raise ValueError('{} is not a 4D image'.format(in_file))
+
+        volume_bytes = int(np.prod(dim[1:4])) * header.get_data_dtype().itemsize
+        t_size = max(0, min(t_size, int(dim[4]) - t_min))
+
+        header['dim'][4] = t_size
+        with gzip.open(out_file, 'wb', compresslevel=compresslevel) as out:
+            out.write(header.binaryblock)
+            out.write(extensions)
+
+            f.seek(vox_offset + t_min * volume_bytes)
+            remaining = t_size * volume_bytes
+            while remaining:
+                chunk = read_exact(f, min(chunk_size, remaining))
+                out.write(chunk)
+                remaining -= len(chunk)
+
+    return t_size
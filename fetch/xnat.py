@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import hashlib
+import logging
+import collections
+import requests
+from requests.adapters import HTTPAdapter
+
+from util import metrics
+from . import aioxnat
+
+logger = logging.getLogger(__name__)
+
+Session = collections.namedtuple('Session', ['url', 'http'])
+
+# (connect, read) seconds, so a stalled connection fails and is retried instead of hanging its
+# worker; the asyncio client uses the same limits
+TIMEOUT = (aioxnat.CONNECT_TIMEOUT, aioxnat.READ_TIMEOUT)
+
+RESUME_CHUNK = 1 << 16
+
+def connect(auth, max_connections=8, asynchronous=False, rate=None):
+    # the asyncio client needs aiohttp; without it every call goes through requests
+    if asynchronous and aioxnat.is_available():
+        return aioxnat.connect(auth, max_connections, rate)
+    if asynchronous:
+        logger.warning('aiohttp is not installed. Using the synchronous XNAT client.')
+
+    url = auth.url.rstrip('/')
+    http = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+    http.mount('https://', adapter)
+    http.mount('http://', adapter)
+
+    # authenticate once; later requests reuse the JSESSIONID cookie
+    try:
+        r = http.post(url + '/data/JSESSION', auth=(auth.username, auth.password),
+            timeout=TIMEOUT)
+        r.raise_for_status()
+    except Exception as e:
+        logger.exception(e)
+        logger.critical(f'Could not authenticate with {url}.')
+        raise
+
+    logger.info(f'Opened XNAT session with {url} ({max_connections} connections).')
+    return Session(url, http)
+
+def is_async(sess):
+    return isinstance(sess, aioxnat.Session)
+
+def close(sess):
+    if is_async(sess):
+        aioxnat.close(sess)
+        return
+
+    try:
+        sess.http.delete(sess.url + '/data/JSESSION', timeout=TIMEOUT)
+    except Exception as e:
+        logger.exception(e)
+    finally:
+        sess.http.close()
+
+def get_url(sess, path):
+    return path if path.startswith('http') else sess.url + path
+
+def is_retryable(e):
+    # the same failures the asyncio client retries: 5xx, 429, timeouts and broken connections
+    if isinstance(e, requests.HTTPError):
+        return e.response is not None and (e.response.status_code >= 500 or
+            e.response.status_code == 429)
+    return isinstance(e, (requests.Timeout, requests.ConnectionError,
+        requests.exceptions.ChunkedEncodingError))
+
+def get(sess, path, params=None, attempts=aioxnat.ATTEMPTS, **kwargs):
+    for attempt in range(1, attempts + 1):
+        try:
+            r = sess.http.get(get_url(sess, path), params=params, timeout=TIMEOUT, **kwargs)
+            r.raise_for_status()
+            return r
+        except requests.RequestException as e:
+            if not is_retryable(e) or attempt == attempts:
+                raise
+            delay = aioxnat.get_backoff(attempt)
+            logger.warning(f'{path} failed (attempt {attempt}/{attempts}): {e!r}. Retrying in '
+                f'{delay:.1f}s.')
+            time.sleep(delay)
+
+def get_json(sess, path, params=None):
+    # asynchronous sessions run the request on their event loop with retries and backoff
+    if is_async(sess):
+        return aioxnat.run(sess, aioxnat.get_json(sess, path, params))
+
+    params = dict(params or {})
+    params['format'] = 'json'
+    return get(sess, path, params).json()['ResultSet']['Result']
+
+def get_experiment_id(sess, label):
+    result = get_json(sess, '/data/experiments', {'label': label, 'columns': 'ID,label,project'})
+    if not result:
+        logger.error(f'Experiment {label} not found.')
+        raise
+    return result[0]['ID']
+
+def list_experiments(sess, project, known=None, page_size=500):
+    # newest first, so a delta refresh can stop at the first page with nothing new; servers that
+    # ignore paging return everything in the first response
+    params = {'columns': 'ID,label,insert_date', 'sortBy': 'insert_date', 'sortOrder': 'DESC',
+        'limit': page_size}
+    known = set(known or [])
+    experiments = {}
+    offset = 0
+
+    while True:
+        page = get_json(sess, f'/data/projects/{project}/experiments',
+            dict(params, offset=offset))
+        new = [e for e in page if e['ID'] not in experiments]
+        experiments.update((e['ID'], e) for e in new)
+
+        if len(page) != page_size or not new or any(e['ID'] in known for e in page):
+            break
+        offset += page_size
+
+    return list(experiments.values())
+
+def get_scans(sess, experiment_id):
+    return get_json(sess, f'/data/experiments/{experiment_id}/scans')
+
+def get_experiment_files(sess, experiment_id):
+    return get_json(sess, f'/data/experiments/{experiment_id}/files')
+
+def get_scan_files(sess, experiment_id, scan_id):
+    path = f'/data/experiments/{experiment_id}/scans/{scan_id}/resources/DICOM/files'
+    return get_json(sess, path)
+
+def download_scan(sess, experiment_id, scan_id, out_dir, files=None):
+    if files is None:
+        files = get_scan_files(sess, experiment_id, scan_id)
+
+    # every file of the scan is requested at once; the session limits how many are in flight
+    if is_async(sess):
+        sizes = aioxnat.run(sess, aioxnat.download_scan(sess, experiment_id, scan_id, out_dir,
+            files))
+        metrics.add(bytes=sum(sizes), files=sum(1 for n in sizes if n))
+        return sum(sizes)
+
+    n = 0
+    for f in files:
+        file_path = os.path.join(out_dir, os.path.basename(f['Name']))
+        n += download_file(sess, f['URI'], file_path, f.get('Size'), f.get('digest'))
+
+    return n
+
+def md5sum(path, chunk_size=1 << 20):
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def verify_file(path, size=None, digest=None):
+    if size not in (None, '') and os.path.getsize(path) != int(size):
+        return False
+    if digest and md5sum(path) != digest:
+        return False
+    return True
+
+def download_file(sess, uri, file_path, size=None, digest=None, chunk_size=1 << 20,
+        attempts=aioxnat.ATTEMPTS):
+    if is_async(sess):
+        n = aioxnat.run(sess, aioxnat.download_file(sess, uri, file_path, size, digest,
+            chunk_size))
+        if n:
+            metrics.add(bytes=n, files=1)
+        return n
+
+    if os.path.exists(file_path) and verify_file(file_path, size, digest):
+        logger.info(f'{file_path} is already downloaded.')
+        return 0
+
+    # stream into a partial file and resume it with a range request after an interruption;
+    # requests drops the chunk it is reading when the connection breaks, so chunks are kept small
+    part = file_path + '.part'
+    for attempt in range(1, attempts + 1):
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+
+        try:
+            with sess.http.get(get_url(sess, uri), headers=headers, stream=True,
+                    timeout=TIMEOUT) as r:
+                # 416 means the partial file already holds every byte
+                if r.status_code != 416:
+                    r.raise_for_status()
+                    if offset and r.status_code != 206:
+                        offset = 0
+                    with open(part, 'ab' if offset else 'wb') as f:
+                        for chunk in r.iter_content(min(chunk_size, RESUME_CHUNK)):
+                            f.write(chunk)
+
+        # timeouts land here too, so a stalled transfer resumes from its partial file
+        except requests.RequestException as e:
+            if not is_retryable(e):
+                raise
+            logger.warning(f'Download of {uri} interrupted (attempt {attempt}/{attempts}): {e}')
+            if attempt < attempts:
+                time.sleep(aioxnat.get_backoff(attempt))
+            continue
+
+        if verify_file(part, size, digest):
+            os.replace(part, file_path)
+            n = os.path.getsize(file_path)
+            metrics.add(bytes=n, files=1)
+            return n
+
+        logger.warning(f'{file_path} does not match the size or checksum reported by XNAT.')
+        os.remove(part)
+
+    logger.error(f'Could not download {uri} after {attempts} attempts.')
+    raise
@@ -0,0 +1 @@
+from . import slurm, profiles, fmriprep, behavioral, xcpengine
@@ -3,6 +3,60 @@
 import os
 import pandas as pd
 
+from util import metrics
+
+# Each task lists its run files and the events taken from every run. An event gives
+# the onset column, a duration rule (a constant, or an end-time column subtracted
+# from the onset), the columns that split it into output files and the expected
+# levels of those columns. Every level gets a file, empty levels get -EMPTY files.
+TASKS = {
+    'EMOTION': {
+        'runs': ['EMOTION_Run_1'],
+        'events': [
+            {'where': 'cueStartTime > 0', 'onset': 'trialStartTime', 'duration': 18,
+                'split': ['trialCondition'],
+                'levels': [('shape',), ('face',)]}
+        ]
+    },
+    'GUESSING': {
+        'runs': ['GUESSING_Run_1', 'GUESSING_Run_2'],
+        'events': [
+            {'name': 'cue', 'onset': 'cueStartTime', 'duration': 'cueEndTime',
+                'split': ['trialCondition'], 'match': {'trialCondition': r'(low|high)'},
+                'levels': [('low',), ('high',)]},
+            {'name': 'guess', 'onset': 'guessStartTime', 'duration': 'guessEndTime'},
+            {'name': 'feedback', 'onset': 'feedbackStartTime', 'duration': 'feedbackEndTime',
+                'split': ['trialCondition'],
+                'match': {'trialCondition': r'(lowWin|lowLose|highWin|highLose)'},
+                'levels': [('lowWin',), ('lowLose',), ('highWin',), ('highLose',)]}
+        ]
+    },
+    'CARIT': {
+        'runs': ['CARIT_Run_1', 'CARIT_Run_2'],
+        'events': [
+            {'where': 'corrAns == "go"', 'onset': 'shapeStartTime', 'duration': 'shapeEndTime',
+                'split': ['corrAns', 'corrRespMsg'],
+                'levels': [('go', 'correct'), ('go', 'incorrect')]},
+            {'where': 'corrAns == "nogo"', 'onset': 'shapeStartTime', 'duration': 'shapeEndTime',
+                'split': ['nogoCondition', 'corrRespMsg'],
+                'levels': [('prevRewNogo', 'correct'), ('prevRewNogo', 'incorrect'),
+                    ('neutralNogo', 'correct'), ('neutralNogo', 'incorrect')]}
+        ]
+    },
+    'WM': {
+        'runs': ['WM_Run_1'],
+        'events': [
+            # block ends come from the fixation rows, paired with block starts by position
+            {'where': 'trialImageStartTime > 0 and blockCueStartTime > 0',
+                'onset': 'blockCueStartTime', 'duration': 'blockFixStartTime',
+                'end_where': 'blockFixStartTime > 0',
+                'split': ['condition', 'category'],
+                'levels': [('0back', 'faces'), ('2back', 'faces'),
+                    ('0back', 'objects'), ('2back', 'objects')]}
+        ]
+    }
+}
+
 def get_source_path(study_dir, subject_bids_id):
     return os.path.join(study_dir, 'sourcedata', subject_bids_id)
 
@@ -14,16 +68,10 @@ def get_behavioral_data(file_path):
         print('Could not read behavioral data {}'.format(file_path))
         raise
 
-def get_output_headers(output_path):
-    if 'WM_RUN_1' in os.path.basename(output_path):
-        return ['blockCueStartTime', 'duration', 'amplitude']
-    else:
-        return ['onset', 'duration', 'amplitude']
-
 def save_onsets(output_path, subset):
     try:
         if len(subset) > 0:
-            headers = get_output_headers(output_path)
+            headers = ['onset', 'duration', 'amplitude']
             subset[headers].to_csv(output_path, sep=' ', header=None, index=None)
         else:
             output_path = output_path.replace('.txt', '-EMPTY.txt')
@@ -33,129 +81,63 @@ def save_onsets(output_path, subset):
         print('Could not save {}'.format(output_path))
         raise
 
-def emotion_onsets(study_dir, subject_bids_id):
-    source_path = get_source_path(study_dir, subject_bids_id)
-    behavioral_file = os.path.join(source_path, 'behavioral_files', 'EMOTION_RUN_1')
+def get_output_path(behavioral_file, name, level):
+    parts = [behavioral_file] + ([name] if name else []) + list(level)
+    return '_'.join(parts) + '.txt'
 
-    b = get_behavioral_data(behavioral_file)
-    data = []
+def get_events(b, event):
+    rows = b.query(event['where']) if 'where' in event else b
+    split = event.get('split', [])
 
-    for n, row in b[b['cueStartTime'] > 0].iterrows():
-        data.append((row['trialCondition'], row['trialStartTime'], '18', '1'))
-    
-    data = pd.DataFrame.from_records(data).dropna(axis=0)
-    data.columns = ['cond', 'onset', 'duration', 'amplitude']
+    data = pd.DataFrame({c: rows[c].to_numpy() for c in split})
+    data['onset'] = rows[event['onset']].to_numpy()
 
-    for cond in ['shape', 'face']:
-        output_path = behavioral_file + '_' + cond + '.txt'
-        subset = data[(data['cond'] == cond)]
-        save_onsets(output_path, subset)
-
-def guessing_onsets(study_dir, subject_bids_id):
-    source_path = get_source_path(study_dir, subject_bids_id)
-    behavioral_file = os.path.join(source_path, 'behavioral_files', 'GUESSING_Run_')
-    runs = ['1','2']
-    phases = ['cue', 'guess', 'feedback']
-
-    for r in runs:
-        f = behavioral_file + str(r)
-        b = get_behavioral_data(f)
-
-        data = []
-        for n, row in b.iterrows():
-            cond = row['trialCondition']
-            for p in phases:
-                start = row[p + 'StartTime']
-                end = row[p + 'EndTime']
-                duration = end - start
-                
-                d = (p, cond, start, duration, 1)
-                data.append(d)
-
-        data = pd.DataFrame.from_records(data).dropna(axis = 0)
-        data.columns = ['phase', 'cond', 'onset', 'duration', 'amplitude']
-    
-        for p in phases:
-            save_guessing_onsets(f, p, data)
-
-def save_guessing_onsets(output_path, phase, data):
-    if phase == 'guess':
-        o = output_path + '_' + phase + '.txt'
-        subset = data[(data['phase'] == phase)]
-        save_onsets(o, subset)
+    duration = event['duration']
+    if isinstance(duration, str):
+        end = b.query(event['end_where']) if 'end_where' in event else rows
+        end = end[duration].reset_index(drop=True).reindex(range(len(rows)))
+        data['duration'] = end.to_numpy() - data['onset'].to_numpy()
     else:
-        if phase = 'cue':
-            conditions = ['low', 'high']
-        elif phase = 'feedback':
-            conditions = ['lowWin', 'lowLose', 'highWin', 'highLose']
-        else:
-            print('Conditions for guessing onsets unclear.')
-            raise
+        data['duration'] = duration
 
-        for cond in conditions:
-            o = output_path + '_' + phase + '_' + cond + '.txt'
-            subset = data[(data['phase'] == phase) & (data['cond'].str.contains(cond))]
-            save_onsets(o, subset)
+    data['amplitude'] = 1
 
-def get_carrit_row(acc, cond, data):
-    d = data[(data['corrRespMsg'] == acc) & (data['corrAns'] == cond)]
-    rows = []
+    for c, pattern in event.get('match', {}).items():
+        data[c] = data[c].astype(str).str.extract(pattern, expand=False)
 
-    for n, row in d.iterrows():
-        start = row['shapeStartTime']
-        end = row['shapeEndTime']
-        duration = end - start
-        trial_outcome = row['trialOutcome']
-        nogo_cond = row['nogoCondition'] if cond == 'nogo' else ''
-        rows.append((cond, trial_outcome, nogo_cond, acc, start, duration, '1'))
+    return data.dropna(axis=0)
 
-    return rows
+def save_event_onsets(behavioral_file, event, data):
+    name = event.get('name')
+    split = event.get('split', [])
 
-def carrit_onsets(study_dir, subject_bids_id):
-    source_path = get_source_path(study_dir, subject_bids_id)
-    behavioral_file = os.path.join(source_path, 'behavioral_files', 'CARIT_Run_')
-    runs = ['1','2']
-
-    for r in runs:
-        f = behavioral_file + str(r)
-        b = get_behavioral_data(f)
-
-        data = []
-        data.extend(get_carrit_row('correct', 'go', b))
-        data.extend(get_carrit_row('correct', 'nogo', b))
-        data.extend(get_carrit_row('incorrect', 'go', b))
-        data.extend(get_carrit_row('incorrect', 'nogo', b))
-
-        data = pd.DataFrame.from_records(data).dropna(axis=0)
-        data.colums = ['cond', 'trial_outcome', 'nogo_cond', 'acc', 'onset', 'duration', 'amplitude']
-
-        for acc in ['correct', 'incorrect']:
-            save_carrit_onsets(f, data, acc, 'go')
-            save_carrit_onsets(f, data, acc, 'prevRewNogo')
-            save_carrit_onsets(f, data, acc, 'neutralNogo')
-
-def save_carrit_onsets(output_path, data, acc, cond):
-    o = output_path + '_' + cond + '_' + acc + '.txt'
-    key = 'cond' if cond == 'go' else 'nogo_cond'
-    subset = data[(data['acc'] == acc) & (data[key] == cond)]
-    save_onsets(o, subset)
-
-def wm_onsets(study_dir, subject_bids_id):
+    if not split:
+        save_onsets(get_output_path(behavioral_file, name, ()), data)
+        return
+
+    groups = {}
+    for key, subset in data.groupby(split, sort=False):
+        groups[key if isinstance(key, tuple) else (key,)] = subset
+
+    for level in event['levels']:
+        subset = groups.get(tuple(level), data.iloc[0:0])
+        save_onsets(get_output_path(behavioral_file, name, level), subset)
+
+@metrics.instrument('task_onsets', subject='subject_bids_id', task='task')
+def task_onsets(study_dir, subject_bids_id, task):
     source_path = get_source_path(study_dir, subject_bids_id)
-    behavioral_file = os.path.join(source_path, 'behavioral_files', 'WM_Run_1')
-    b = get_behavioral_data(behavioral_file)
-    categories = ['faces', 'objects']
-
-    start = b[(b['trialImageStartTime'] > 0) & (b['blockCueStartTime'] > 0)][['blockCueStartTime', 
-        'condition', 'category']].reset_index(drop = True)
-    end = b[b['blockFixStartTime'] > 0][['blockFixStartTime']].reset_index(drop = True)
-
-    data = pd.concat([start, end], axis = 1)
-    data['duration'] = data.apply(lambda x: x['blockFixStartTime'] - x['blockCueStartTime'], axis = 1)
-    data['amplitude'] = data.apply(lambda x: 1, axis = 1)
-
-    for c in categories:
-        for cond in ['0back', '2back']:
-            o = behavioral_file + '_' + cond + '_' + p + '.txt'
-            subset = data[(data['category'] == c) & (data['condition'] == cond)]
-            save_onsets(o, subset)
+    spec = TASKS[task]
+
+    for run in spec['runs']:
+        behavioral_file = os.path.join(source_path, 'behavioral_files', run)
+        b = get_behavioral_data(behavioral_file)
+        metrics.add(bytes=os.path.getsize(behavioral_file), files=1)
+
+        for event in spec['events']:
+            data = get_events(b, event)
+            save_event_onsets(behavioral_file, event, data)
+
+@metrics.instrument('process_onsets', subject='subject_bids_id')
+def process_onsets(study_dir, subject_bids_id, tasks=None):
+    for task in tasks or TASKS:
+        task_onsets(study_dir, subject_bids_id, task)
@@ -2,8 +2,24 @@
 
 import os
 import glob
+import itertools
 import pandas as pd
 import numpy as np
+import concurrent.futures as cf
+
+from util import catalog, metrics
+
+from . import confounds, freesurfer
+from .. import slurm
+from .. import profiles
+
+FD_THRESHOLD = 0.5
+STRATEGIES = ['9p']
+
+RESOURCES = {'time': '02-00:30:30', 'cpus': 8, 'mem_per_cpu': '4G', 'partition': 'ncf'}
+
+# staged jobs bind this node-local copy of the work dir instead of the shared one
+SCRATCH_WORK_DIR = '${SCRATCH_DIR}'
 
 def get_fmriprep_dir(study_dir, fmriprep_version):
     return os.path.join(study_dir, 'derivatives', 'fmriprep-{}'.format(fmriprep_version))
@@ -18,11 +34,12 @@ def get_sbatch_dir(study_dir, fmriprep_version):
     return os.path.join(study_dir, 'derivatives', 'fmriprep-sbatch-{}'.format(fmriprep_version))
 
 def get_singularity_command(study_dir, subject_bids_id, fmriprep_version, container_dir, 
-        omp_threads_num, threads_num, fd_spike_threshold, fs_license_path, cifti, output_spaces):
+        omp_threads_num, threads_num, fd_spike_threshold, fs_license_path, cifti, output_spaces,
+        subject_work_dir=None):
 
     fmriprep_dir = get_fmriprep_dir(study_dir, fmriprep_version)
     work_dir = get_work_dir(study_dir, fmriprep_version)
-    subject_work_dir = os.path.join(work_dir, subject_bids_id)
+    subject_work_dir = subject_work_dir or os.path.join(work_dir, subject_bids_id)
     
     cmd = ['singularity', 'run', '--cleanenv',
             '-B', '{}:/work'.format(subject_work_dir),
@@ -34,71 +51,153 @@ def get_singularity_command(study_dir, subject_bids_id, fmriprep_version, contai
             '-w', '/work', '--return-all-components',
             '--fd-spike-threshold', fd_spike_threshold,
             '--fs-license-file', fs_license_path,
+            '--fs-subjects-dir', freesurfer.get_subjects_dir(fmriprep_dir),
             '--cifti-output', cifti,
             '--output-spaces', ' '.join(output_spaces),
             '--skip-bids-validation', study_dir, fmriprep_dir, 'participant']
 
     return ' '.join(cmd)
 
-def run_sbatch(study_dir, subject_bids_id, fmriprep_version, cmd):
+def get_sbatch_directives(sbatch_dir, array=False, resources=None, staged=False):
+    log = '%x_%A_%a' if array else '%x_%j'
+    directives = ['--job-name=fmriprep',
+        '--output={}/{}.out'.format(sbatch_dir, log),
+        '--error={}/{}.err'.format(sbatch_dir, log)] + \
+        profiles.get_directives(resources or RESOURCES)
+
+    # leave time to copy the work dir back before the time limit kills the job
+    if staged:
+        directives.append('--signal=B:USR1@900')
+    return directives
+
+def get_script_lines(study_dir, subject_bids_id, fmriprep_version, cmd, scratch_dir=None):
+    if not scratch_dir:
+        return [cmd]
+
+    subject_work_dir = os.path.join(get_work_dir(study_dir, fmriprep_version), subject_bids_id)
+    subject_scratch_dir = os.path.join(scratch_dir,
+        'fmriprep-work-{}-${{SLURM_JOB_ID:-$$}}'.format(subject_bids_id))
+    return slurm.get_staging_lines(subject_work_dir, subject_scratch_dir, cmd)
+
+@metrics.instrument('fmriprep.run_sbatch', subject='subject_bids_id')
+def run_sbatch(study_dir, subject_bids_id, fmriprep_version, cmd, resources=None,
+        scratch_dir=None):
+    sbatch_dir = get_sbatch_dir(study_dir, fmriprep_version)
+    sbatch_file_path = os.path.join(sbatch_dir, subject_bids_id + '.sbatch')
+
+    slurm.write_script(sbatch_file_path, get_sbatch_directives(sbatch_dir, False, resources,
+        bool(scratch_dir)), get_script_lines(study_dir, subject_bids_id, fmriprep_version, cmd,
+        scratch_dir))
+    return slurm.submit(sbatch_file_path)
+
+@metrics.instrument('fmriprep.run_sbatch_array')
+def run_sbatch_array(study_dir, subject_bids_ids, fmriprep_version, cmd, max_concurrent=None,
+        resources=None, scratch_dir=None):
+    # cmd is built for slurm.ARRAY_SUBJECT; each task resolves it from the manifest
+    sbatch_dir = get_sbatch_dir(study_dir, fmriprep_version)
+    name = slurm.get_array_name()
+    manifest_path = os.path.join(sbatch_dir, name + '.txt')
+    sbatch_file_path = os.path.join(sbatch_dir, name + '.sbatch')
+
+    slurm.write_manifest(manifest_path, subject_bids_ids)
+    slurm.write_script(sbatch_file_path, get_sbatch_directives(sbatch_dir, True, resources,
+        bool(scratch_dir)), slurm.get_array_lines(manifest_path) + get_script_lines(study_dir,
+        slurm.ARRAY_SUBJECT, fmriprep_version, cmd, scratch_dir))
+    return slurm.submit(sbatch_file_path, slurm.get_array_spec(len(subject_bids_ids),
+        max_concurrent))
+
+def get_confounds_files(study_dir, fmriprep_version, subject_bids_ids=None):
+    fmriprep_dir = get_fmriprep_dir(study_dir, fmriprep_version)
+    files = []
+
+    # fmriprep writes these from Slurm, so a cohort-wide search goes to the filesystem; per
+    # subject they are catalogued by the confounds stage before it runs
+    if subject_bids_ids is None:
+        pattern = os.path.join(fmriprep_dir, 'fmriprep', 'sub-*', 'func',
+            '*task*desc-confounds_regressors.tsv')
+        return sorted(glob.glob(pattern))
+
+    for s in subject_bids_ids:
+        pattern = os.path.join(fmriprep_dir, 'fmriprep', s, 'func',
+            '*task*desc-confounds_regressors.tsv')
+        files.extend(catalog.find_files(study_dir, pattern))
+
+    return sorted(files)
+
+def filter_confounds_file(c, strategies=STRATEGIES, fd_threshold=FD_THRESHOLD):
     try:
-        sbatch_dir = get_sbatch_dir(study_dir, 'derivatives', 'sbatch', 'fmriprep')
-        sbatch_file_path = os.path.join(sbatch_dir, subject_bids_id + '.sbatch')
-
-        with open(sbatch_file_path) as f:
-            f.writelines('#!/bin/bash\n')
-            f.writelines('#SBATCH --job-name=fmriprep\n')
-            f.writelines('#SBATCH --output={}/%x_%j.out\n'.format(sbatch_dir))
-            f.writelines('#SBATCH --error={}/%x_%j.err\n'.format(sbatch_dir))
-            f.writelines('#SBATCH --time=02-00:30:30\n')
-            f.writelines('#SBATCH -n 1\n')
-            f.writelines('#SBATCH --cpus-per-task=8\n')
-            f.writelines('#SBATCH --mem-per-cpu=4G\n')
-            f.writelines('#SBATCH --partition=ncf\n')
-            f.writelines(cmd)
-    
-        os.system('sbatch {}'.format(sbatch_file_path))
+        columns = confounds.get_strategy_columns(strategies)
+        df = confounds.read_confounds(c, columns + ['framewise_displacement', 'dvars'])
+
+        #Get framewise displacement > 0.5 and dvars outliers (> 75th percentile + (1.5 * IQR))
+        fd, dvars = confounds.get_outlier_mask(df, fd_threshold)
+        fd_outliers = np.flatnonzero(fd)
+        dvars_outliers = np.flatnonzero(dvars)
+        scrub_mask = ~(fd | dvars)
+
+        o = c.replace('confounds_regressors.tsv','fd_outliers_0pt5.txt')
+        np.savetxt(o, fd_outliers, fmt = '%d')
+        d = c.replace('confounds_regressors.tsv','dvars_outliers.txt')
+        np.savetxt(d, dvars_outliers, fmt = '%d')
+        m = c.replace('confounds_regressors.tsv','scrub_mask.txt')
+        np.savetxt(m, scrub_mask, fmt = '%d')
+
+        for s in strategies:
+            x = confounds.expand_regressors(df, s, scrub_mask)
+            pd.DataFrame(x).to_csv(c.replace('.tsv', '-{}.txt'.format(s)), header = None,
+                index = None, sep = ' ')
 
     except Exception as e:
         print(e)
-        print('Could not run sbatch.')
+        print('Could not filter confounds {}.'.format(c))
         raise
 
-def filter_confounds(study_dir, subject_bids_id, fmriprep_version):
-    fmriprep_dir = get_fmriprep_dir(study_dir, fmriprep_version)
-    subject_fmriprep_dir = os.path.join(fmriprep_dir, 'fmriprep', subject_bids_id)
+    basename = os.path.basename(c)
+    return {
+        'subject': basename.split('_')[0],
+        'run': basename.replace('_desc-confounds_regressors.tsv', ''),
+        'volumes': len(df),
+        'fd_outliers': len(fd_outliers),
+        'dvars_outliers': len(dvars_outliers),
+        'scrubbed': int((~scrub_mask).sum())
+    }
 
-    confounds = os.path.join(subject_fmriprep_dir, 'func', '*task*desc-confounds_regressors.tsv')
-    subject_confounds = glob.glob(confounds)
+@metrics.instrument('filter_confounds', subject='subject_bids_id')
+def filter_confounds(study_dir, subject_bids_id, fmriprep_version, strategies=STRATEGIES):
+    subject_confounds = get_confounds_files(study_dir, fmriprep_version, [subject_bids_id])
 
     if not subject_confounds:
         print('fmriprep confounds not found for subject {}.'.format(subject_bids_id))
         raise
-    
-    try:
-        for c in subject_confounds:
-            df = pd.read_csv(c, sep = '\t')
-            df.reset_index(inplace = True)
-            params = ['trans_x', 'trans_y', 'trans_z', 
-                'rot_x', 'rot_y', 'rot_z', 'csf', 'white_matter', 'global_signal']
-            df[params].to_csv(c.replace('.tsv', '-9p.txt'), header = None, index = None, sep = ' ')
-
-            #Get framewise displacement > 0.5
-            fd_outliers = df[df['framewise_displacement'] > 0.5][['index','framewise_displacement']]
-            o = c.replace('confounds_regressors.tsv','fd_outliers_0pt5.txt')
-            fd_outliers[['index']].to_csv(o, index = False, header = False)
-
-            #Get dvars outliers (> 75th percentile + (1.5 * IQR))
-            dvars = [float(x) for x in df['dvars'].values[1:]]
-            q25, q75 = np.percentile(dvars, 25), np.percentile(dvars, 75)
-            iqr = q75 - q25
-            cut_off = iqr * 1.5
-            lower, upper = q25 - cut_off, q75 + cut_off
-            dvars_outliers = df[df['dvars'] > upper][['dvars','index']]
-            d = c.replace('confounds_regressors.tsv','dvars_outliers.txt')
-            dvars_outliers[['index']].to_csv(d, index = False, header = False)
 
-    except Exception as e:
-        print(e)
-        print('Could not filter confounds.')
+    metrics.add(bytes=sum(os.path.getsize(c) for c in subject_confounds),
+        files=len(subject_confounds))
+    return [filter_confounds_file(c, strategies) for c in subject_confounds]
+
+def get_confounds_summary_path(study_dir, fmriprep_version):
+    fmriprep_dir = get_fmriprep_dir(study_dir, fmriprep_version)
+    return os.path.join(fmriprep_dir, 'confounds_summary.tsv')
+
+def filter_cohort_confounds(study_dir, fmriprep_version, subject_bids_ids=None, max_workers=None,
+        strategies=STRATEGIES, fd_threshold=FD_THRESHOLD):
+    files = get_confounds_files(study_dir, fmriprep_version, subject_bids_ids)
+
+    if not files:
+        print('fmriprep confounds not found in {}.'.format(get_fmriprep_dir(study_dir,
+            fmriprep_version)))
         raise
+
+    workers = max_workers or os.cpu_count() or 1
+    chunksize = max(1, len(files) // (workers * 4))
+
+    with cf.ProcessPoolExecutor(max_workers=workers) as executor:
+        summary = list(executor.map(filter_confounds_file, files, itertools.repeat(strategies),
+            itertools.repeat(fd_threshold), chunksize=chunksize))
+
+    summary = pd.DataFrame.from_records(summary)
+    summary.to_csv(get_confounds_summary_path(study_dir, fmriprep_version), sep='\t',
+        index=False)
+    print('Filtered confounds for {} runs of {} subjects.'.format(len(summary),
+        summary['subject'].nunique()))
+
+    return summary
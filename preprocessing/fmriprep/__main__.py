@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+
+import argparse as ap
+
+from preprocessing import fmriprep
+
+def main():
+    parser = ap.ArgumentParser(description='Filter fMRIprep confounds for the whole cohort')
+    parser.add_argument('--bids_dir', help='BIDS directory path',
+        default='/mnt/stressdevlab/STAR')
+    parser.add_argument('--fmriprep_ver', help='fMRIprep version', required=True)
+    parser.add_argument('--subjects', nargs='+',
+        help='subject BIDS IDs or globs. If unspecified, all subjects will be processed.')
+    parser.add_argument('--strategies', help='confound strategies to write', nargs='+',
+        choices=list(fmriprep.confounds.STRATEGIES), default=fmriprep.STRATEGIES)
+    parser.add_argument('--jobs', help='worker processes', type=int)
+    args = parser.parse_args()
+
+    fmriprep.filter_cohort_confounds(args.bids_dir, args.fmriprep_ver, args.subjects, args.jobs,
+        args.strategies)
+
+if __name__=='__main__':
+    main()
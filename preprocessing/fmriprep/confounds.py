@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+import os
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+MOTION_PARAMS = ['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z']
+TISSUE_PARAMS = ['csf', 'white_matter', 'global_signal']
+
+# derivatives are backward differences (first volume 0); quadratics square every
+# column present after the derivative step; scrub appends one spike regressor per
+# volume flagged by the FD/DVARS mask
+STRATEGIES = {
+    '6p': {'params': MOTION_PARAMS},
+    '9p': {'params': MOTION_PARAMS + TISSUE_PARAMS},
+    '24p': {'params': MOTION_PARAMS, 'derivatives': True, 'quadratics': True},
+    '36p': {'params': MOTION_PARAMS + TISSUE_PARAMS, 'derivatives': True, 'quadratics': True},
+    '36p_scrub': {'params': MOTION_PARAMS + TISSUE_PARAMS, 'derivatives': True,
+        'quadratics': True, 'scrub': True}
+}
+
+def get_strategy_columns(strategies):
+    columns = []
+    for name in strategies:
+        columns.extend(STRATEGIES[name]['params'])
+    return list(dict.fromkeys(columns))
+
+def get_outlier_mask(df, fd_threshold):
+    fd = df['framewise_displacement'].to_numpy(dtype=float)
+    fd_outliers = fd > fd_threshold
+
+    # dvars outliers are > 75th percentile + (1.5 * IQR)
+    dvars = df['dvars'].to_numpy(dtype=float)
+    q25, q75 = np.nanpercentile(dvars[1:], [25, 75])
+    dvars_outliers = dvars > q75 + (q75 - q25) * 1.5
+
+    return fd_outliers, dvars_outliers
+
+def expand_regressors(df, strategy, scrub_mask=None):
+    spec = STRATEGIES[strategy]
+    x = df[spec['params']].to_numpy()
+
+    if spec.get('derivatives'):
+        d = np.zeros_like(x)
+        d[1:] = np.diff(x, axis=0)
+        x = np.hstack([x, d])
+
+    if spec.get('quadratics'):
+        x = np.hstack([x, x ** 2])
+
+    if spec.get('scrub') and scrub_mask is not None:
+        spikes = np.flatnonzero(~scrub_mask)
+        s = np.zeros((len(x), len(spikes)), dtype=x.dtype)
+        s[spikes, np.arange(len(spikes))] = 1
+        x = np.hstack([x, s])
+
+    return x
+
+def get_sidecar_path(tsv_path):
+    d, basename = os.path.split(tsv_path)
+    return os.path.join(d, '.' + basename.replace('.tsv', '.parquet'))
+
+def get_cache_key(tsv_path):
+    st = os.stat(tsv_path)
+    return '{}:{}'.format(st.st_size, st.st_mtime_ns)
+
+def get_sidecar_columns(sidecar, key):
+    if pq is None or not os.path.exists(sidecar):
+        return []
+
+    try:
+        schema = pq.read_schema(sidecar)
+        metadata = schema.metadata or {}
+        if metadata.get(b'source_key', b'').decode() != key:
+            return []
+        return list(schema.names)
+
+    except Exception as e:
+        print(e)
+        print('Ignoring unreadable confounds cache {}'.format(sidecar))
+        return []
+
+def write_sidecar(sidecar, key, df):
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        metadata = dict(table.schema.metadata or {})
+        metadata[b'source_key'] = key.encode()
+        table = table.replace_schema_metadata(metadata)
+
+        tmp = '{}.{}.tmp'.format(sidecar, os.getpid())
+        pq.write_table(table, tmp)
+        os.replace(tmp, sidecar)
+
+    except Exception as e:
+        print(e)
+        print('Could not cache confounds {}'.format(sidecar))
+
+def read_confounds(tsv_path, columns, dtype='float32', cache=True):
+    columns = list(columns)
+    key = get_cache_key(tsv_path)
+    sidecar = get_sidecar_path(tsv_path)
+
+    cached = get_sidecar_columns(sidecar, key) if cache else []
+    if cached and set(columns) <= set(cached):
+        return pq.read_table(sidecar, columns=columns).to_pandas()
+
+    # parse the columns already cached as well so the sidecar only ever grows
+    usecols = list(dict.fromkeys(columns + cached))
+    try:
+        df = pd.read_csv(tsv_path, sep='\t', usecols=usecols, na_values='n/a',
+            dtype={c: dtype for c in usecols})
+    except Exception as e:
+        print(e)
+        print('Could not read confounds {}'.format(tsv_path))
+        raise
+
+    if cache and pq is not None:
+        write_sidecar(sidecar, key, df)
+
+    return df[columns]
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+import os
+import glob
+import shutil
+
+# files fmriprep needs from a finished recon-all before it will skip surface reconstruction
+RECON_FILES = [
+    'mri/orig.mgz', 'mri/T1.mgz', 'mri/brainmask.mgz', 'mri/aseg.mgz', 'mri/aparc+aseg.mgz'
+] + ['surf/{}.{}'.format(h, s) for h in ['lh', 'rh']
+    for s in ['white', 'pial', 'inflated', 'sphere', 'sphere.reg', 'thickness']
+] + ['label/{}.aparc.annot'.format(h) for h in ['lh', 'rh']]
+
+def get_subjects_dir(fmriprep_dir):
+    return os.path.join(fmriprep_dir, 'freesurfer')
+
+def check_recon(subject_dir):
+    scripts = os.path.join(subject_dir, 'scripts')
+
+    if not os.path.exists(os.path.join(scripts, 'recon-all.done')):
+        return 'recon-all.done not found'
+    if os.path.exists(os.path.join(scripts, 'recon-all.error')):
+        return 'recon-all.error found'
+    if glob.glob(os.path.join(scripts, 'IsRunning.*')):
+        return 'recon-all is still running'
+
+    for f in RECON_FILES:
+        path = os.path.join(subject_dir, f)
+        if not os.path.isfile(path) or not os.path.getsize(path):
+            return '{} is missing'.format(f)
+
+def get_recon_candidates(derivatives_dir, subject_bids_id):
+    # recons left by any fmriprep version (both subjects dir layouts), then the morphometrics
+    # copies made by util.morphometrics
+    candidates = []
+    for layout in ['freesurfer', os.path.join('sourcedata', 'freesurfer')]:
+        pattern = os.path.join(derivatives_dir, 'fmriprep-*', layout, subject_bids_id)
+        candidates += [c for c in glob.glob(pattern) if not os.path.islink(c)]
+
+    pattern = os.path.join(derivatives_dir, 'fmriprep-*', 'freesurfer', subject_bids_id,
+        'morphometrics')
+    morphometrics = glob.glob(pattern) + glob.glob(os.path.join(pattern, '*'))
+
+    # prefer the most recently finished reconstruction
+    def finished(c):
+        return os.path.getmtime(os.path.join(c, 'scripts', 'recon-all.done'))
+
+    candidates = sorted([c for c in candidates if not check_recon(c)], key=finished, reverse=True)
+    return candidates + sorted([c for c in morphometrics if os.path.isdir(c) and
+        not check_recon(c)], key=finished, reverse=True)
+
+def copy_recon(source_dir, subject_dir):
+    # copied rather than linked, since recon-all writes scripts/, touch/ and logs into the
+    # subject dir and must not touch the other version's recon; the subject dir may already
+    # hold this version's morphometrics copy, so the recon's directories go in beside it
+    os.makedirs(subject_dir, exist_ok=True)
+
+    # symlinks left by earlier runs point into another version's recon
+    for name in os.listdir(subject_dir):
+        if os.path.islink(os.path.join(subject_dir, name)):
+            os.remove(os.path.join(subject_dir, name))
+
+    tmp = subject_dir + '.reuse'
+    shutil.rmtree(tmp, ignore_errors=True)
+    try:
+        for name in os.listdir(source_dir):
+            source = os.path.join(source_dir, name)
+            if os.path.isdir(source) and not os.path.exists(os.path.join(subject_dir, name)):
+                shutil.copytree(source, os.path.join(tmp, name), symlinks=True)
+
+        # directories only appear in the subject dir once the whole copy has succeeded
+        for name in os.listdir(tmp) if os.path.isdir(tmp) else []:
+            os.replace(os.path.join(tmp, name), os.path.join(subject_dir, name))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def reuse_recon(fmriprep_dir, subject_bids_id):
+    subject_dir = os.path.join(get_subjects_dir(fmriprep_dir), subject_bids_id)
+
+    problem = check_recon(subject_dir)
+    if not problem:
+        return 'complete', subject_dir
+
+    # leave a partial recon-all of this version for fmriprep to resume
+    if os.path.isdir(subject_dir):
+        partial = [n for n in os.listdir(subject_dir) if n != 'morphometrics' and
+            not os.path.islink(os.path.join(subject_dir, n))]
+        if partial:
+            return 'partial', problem
+
+    derivatives_dir = os.path.dirname(os.path.abspath(fmriprep_dir))
+    candidates = get_recon_candidates(derivatives_dir, subject_bids_id)
+    if not candidates:
+        return 'none', problem
+
+    try:
+        copy_recon(candidates[0], subject_dir)
+    except Exception as e:
+        print(e)
+        print('Could not copy FreeSurfer reconstruction {}.'.format(candidates[0]))
+        raise
+
+    return 'copied', candidates[0]
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import json
+import math
+import subprocess
+import numpy as np
+
+SACCT_FIELDS = ['JobID', 'JobName', 'State', 'AllocCPUS', 'MaxRSS', 'Elapsed', 'TotalCPU']
+
+# jobs killed at their limit only show that they needed more than they got, so they bound the
+# recommendation from below instead of entering the percentiles
+CENSORED_STATES = ['TIMEOUT', 'OUT_OF_MEMORY']
+
+def get_profile_path(study_dir, stage):
+    return os.path.join(study_dir, 'derivatives', 'slurm-profiles', '{}.json'.format(stage))
+
+def parse_memory(value):
+    # sacct memory values look like 123456K, 1.5G or a bare byte count
+    m = re.match(r'^([\d.]+)([KMGT]?)', value or '')
+    if not m:
+        return None
+    scale = {'': 1 / 1024 ** 2, 'K': 1 / 1024, 'M': 1, 'G': 1024, 'T': 1024 ** 2}
+    return float(m.group(1)) * scale[m.group(2)]
+
+def parse_duration(value):
+    # [D-]HH:MM:SS, MM:SS(.mmm) or HH:MM:SS(.mmm)
+    if not value:
+        return None
+    days, _, clock = value.rpartition('-')
+    seconds = 0.0
+    for part in clock.split(':'):
+        seconds = seconds * 60 + float(part)
+    return seconds + int(days or 0) * 86400
+
+def format_duration(seconds):
+    seconds = int(math.ceil(seconds))
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return '{:02d}-{:02d}:{:02d}:{:02d}'.format(days, hours, minutes, seconds)
+
+def parse_accounting(output):
+    jobs = {}
+    for line in output.splitlines():
+        row = dict(zip(SACCT_FIELDS, line.split('|')))
+        if len(row) != len(SACCT_FIELDS):
+            continue
+
+        # allocation lines carry state, cpus and elapsed; step lines (.batch, .0) carry MaxRSS
+        job_id, _, step = row['JobID'].partition('.')
+        job = jobs.setdefault(job_id, {'job_id': job_id, 'max_rss_mb': 0.0})
+        rss = parse_memory(row['MaxRSS'])
+        if rss:
+            job['max_rss_mb'] = max(job['max_rss_mb'], rss)
+
+        if not step:
+            job['state'] = row['State'].split()[0]
+            job['cpus'] = int(row['AllocCPUS'] or 0)
+            job['elapsed_s'] = parse_duration(row['Elapsed'])
+            job['total_cpu_s'] = parse_duration(row['TotalCPU'])
+
+    return [j for j in jobs.values() if j.get('state') in ['COMPLETED'] + CENSORED_STATES and
+        j['elapsed_s']]
+
+def load_profile(study_dir, stage):
+    try:
+        with open(get_profile_path(study_dir, stage)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def update_profile(study_dir, stage, job_name=None, since='now-180days'):
+    cmd = ['sacct', '-n', '-P', '-S', since, '--name', job_name or stage,
+        '-o', ','.join(SACCT_FIELDS)]
+
+    try:
+        res = subprocess.run(cmd, check=True, capture_output=True, text=True)
+    except Exception as e:
+        print(e)
+        print('Could not read Slurm accounting for {}.'.format(stage))
+        return load_profile(study_dir, stage)
+
+    # accounting is purged over time, so keep every job seen so far
+    profile = load_profile(study_dir, stage)
+    for job in parse_accounting(res.stdout):
+        profile[job['job_id']] = job
+
+    path = get_profile_path(study_dir, stage)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(profile, f, indent=2)
+    os.replace(tmp, path)
+
+    return profile
+
+def get_scaled_elapsed(job, cpus):
+    # a job given fewer cpus than it ran with is assumed to slow down in proportion
+    return job['elapsed_s'] * max(1.0, job['cpus'] / cpus if job.get('cpus') else 1.0)
+
+def recommend(profile, defaults, percentile=95, margin=1.25, min_jobs=5, overrides=None):
+    resources = dict(defaults)
+    jobs = [j for j in profile.values() if j.get('state', 'COMPLETED') == 'COMPLETED']
+    timeouts = [j for j in profile.values() if j.get('state') == 'TIMEOUT']
+    oom = [j for j in profile.values() if j.get('state') == 'OUT_OF_MEMORY']
+
+    if len(jobs) >= min_jobs:
+        cores = np.array([j['total_cpu_s'] / j['elapsed_s'] for j in jobs])
+        rss = np.array([j['max_rss_mb'] for j in jobs])
+
+        cpus = max(1, int(math.ceil(np.percentile(cores, percentile) * margin)))
+        resources['cpus'] = min(cpus, defaults['cpus'])
+
+        elapsed = np.array([get_scaled_elapsed(j, resources['cpus']) for j in jobs])
+        time = max([np.percentile(elapsed, percentile)] +
+            [get_scaled_elapsed(j, resources['cpus']) for j in timeouts]) * margin
+        memory = max([np.percentile(rss, percentile)] + [j['max_rss_mb'] for j in oom]) * margin
+        resources['mem_per_cpu'] = '{}M'.format(int(math.ceil(memory / resources['cpus'])))
+        resources['time'] = format_duration(time)
+
+    resources.update(overrides or {})
+    return resources
+
+def get_directives(resources):
+    return ['--time={}'.format(resources['time']),
+        '-n 1',
+        '--cpus-per-task={}'.format(resources['cpus']),
+        '--mem-per-cpu={}'.format(resources['mem_per_cpu']),
+        '--partition={}'.format(resources['partition'])]
+
+def parse_overrides(values):
+    # stage.key=value, e.g. fmriprep.cpus=4 xcpengine.mem_per_cpu=16G
+    overrides = {}
+    for v in values or []:
+        key, _, value = v.partition('=')
+        stage, _, name = key.partition('.')
+        overrides.setdefault(stage, {})[name] = int(value) if name == 'cpus' else value
+    return overrides
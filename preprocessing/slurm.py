@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import json
+import time
+import fcntl
+import getpass
+import contextlib
+import subprocess
+from datetime import datetime
+
+from util import catalog
+
+# array scripts are generated for this subject id, which each task reads from the manifest
+ARRAY_SUBJECT = '${SUBJECT}'
+
+# UNKNOWN is set by poll for a job neither squeue nor sacct reports yet, e.g. while sacct lags
+# behind a job that just left the queue; it stays active so the job is polled again, but only
+# for UNKNOWN_GRACE seconds after submission. A job still unreported then (purged from
+# accounting, or submitted on another cluster) is LOST and counts as failed.
+ACTIVE_STATES = ['PENDING', 'CONFIGURING', 'RUNNING', 'COMPLETING', 'REQUEUED', 'RESIZING',
+    'SUSPENDED', 'UNKNOWN']
+UNKNOWN_GRACE = 900
+
+def get_array_name():
+    return 'array-{}'.format(datetime.now().strftime('%Y%m%d-%H%M%S-%f'))
+
+def get_array_spec(n, max_concurrent=None):
+    spec = '0-{}'.format(n - 1)
+    if max_concurrent:
+        spec += '%{}'.format(max_concurrent)
+    return spec
+
+def get_array_lines(manifest_path, variable='SUBJECT'):
+    return ['{}=$(sed -n "$((SLURM_ARRAY_TASK_ID + 1))p" {})'.format(variable, manifest_path)]
+
+def get_staging_lines(work_dir, scratch_dir, cmd):
+    # copy a previous work dir in for resumption and copy it back only if the command fails,
+    # is cancelled or runs out of time; successful outputs are already on the shared disk
+    return ['WORK_DIR="{}"'.format(work_dir),
+        'SCRATCH_DIR="{}"'.format(scratch_dir),
+        'mkdir -p "$WORK_DIR" "$SCRATCH_DIR"',
+        'rsync -a "$WORK_DIR"/ "$SCRATCH_DIR"/ || { rm -rf "$SCRATCH_DIR"; exit 1; }',
+        'stage_out() {',
+        '    STATUS=$?',
+        '    trap - EXIT TERM USR1',
+        '    if [ -n "$PID" ]; then kill "$PID" 2>/dev/null; wait "$PID"; fi',
+        '    if [ "$STATUS" -ne 0 ]; then rsync -a --delete "$SCRATCH_DIR"/ "$WORK_DIR"/; fi',
+        '    rm -rf "$SCRATCH_DIR"',
+        '    exit "$STATUS"',
+        '}',
+        'trap stage_out EXIT',
+        "trap 'exit 143' TERM USR1",
+        cmd + ' &',
+        'PID=$!',
+        'wait "$PID"',
+        'STATUS=$?',
+        'PID=',
+        'exit "$STATUS"']
+
+def write_script(script_path, directives, lines):
+    try:
+        os.makedirs(os.path.dirname(script_path), exist_ok=True)
+
+        with open(script_path, 'w') as f:
+            f.writelines('#!/bin/bash\n')
+            for d in directives:
+                f.writelines('#SBATCH {}\n'.format(d))
+            for l in lines:
+                f.writelines(l + '\n')
+
+    except Exception as e:
+        print(e)
+        print('Could not write {}.'.format(script_path))
+        raise
+
+def write_manifest(manifest_path, subject_bids_ids):
+    try:
+        os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+
+        with open(manifest_path, 'w') as f:
+            for s in subject_bids_ids:
+                f.writelines(s + '\n')
+
+    except Exception as e:
+        print(e)
+        print('Could not write {}.'.format(manifest_path))
+        raise
+
+def submit(script_path, array=None, dependency=None, dependency_type='afterok'):
+    cmd = ['sbatch', '--parsable']
+    if array:
+        cmd.append('--array={}'.format(array))
+    if dependency:
+        cmd.append('--dependency={}:{}'.format(dependency_type, ':'.join(dependency)))
+    cmd.append(script_path)
+
+    try:
+        res = subprocess.run(cmd, check=True, capture_output=True, text=True)
+
+    except Exception as e:
+        print(e)
+        print('Could not run sbatch.')
+        raise
+
+    # --parsable prints "jobid" or "jobid;cluster"
+    return res.stdout.strip().split(';')[0]
+
+def get_jobs_path(study_dir):
+    return os.path.join(study_dir, 'derivatives', 'slurm-jobs.json')
+
+@contextlib.contextmanager
+def open_jobs(study_dir):
+    # job records are shared by every stage process, so updates hold a file lock
+    path = get_jobs_path(study_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(path) as f:
+                jobs = json.load(f)
+        except FileNotFoundError:
+            jobs = {}
+
+        yield jobs
+
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(jobs, f, indent=2)
+        os.replace(tmp, path)
+
+def record_job(study_dir, subject_bids_id, stage, job_id):
+    now = datetime.now().isoformat()
+    with open_jobs(study_dir) as jobs:
+        jobs[job_id] = {'subject': subject_bids_id, 'stage': stage, 'state': 'PENDING',
+            'submitted': now, 'updated': now, 'polled': time.time()}
+
+def expand_job_ids(job_id):
+    # squeue reports pending array tasks as 123_[4-9%2]
+    m = re.match(r'^(\d+)_\[(.*)\]$', job_id)
+    if not m:
+        return [job_id]
+
+    ids = []
+    for r in m.group(2).split('%')[0].split(','):
+        start, _, end = r.partition('-')
+        for i in range(int(start), int(end or start) + 1):
+            ids.append('{}_{}'.format(m.group(1), i))
+    return ids
+
+def poll(job_ids):
+    states = {}
+    if not job_ids:
+        return states
+
+    # one squeue call for everything still queued, one sacct call for the rest
+    try:
+        res = subprocess.run(['squeue', '-h', '-u', getpass.getuser(), '-o', '%i %T'],
+            check=True, capture_output=True, text=True)
+        queued = {}
+        for line in res.stdout.splitlines():
+            parts = line.split()
+            if len(parts) == 2:
+                for i in expand_job_ids(parts[0]):
+                    queued[i] = parts[1]
+
+        for j in job_ids:
+            tasks = [v for k, v in queued.items() if k == j or k.startswith(j + '_')]
+            if tasks:
+                states[j] = next((t for t in tasks if t == 'RUNNING'), tasks[0])
+
+        finished = [j for j in job_ids if j not in states]
+        if finished:
+            res = subprocess.run(['sacct', '-n', '-P', '-X', '-j', ','.join(finished),
+                '-o', 'JobID,State'], check=True, capture_output=True, text=True)
+            accounted = {}
+            for line in res.stdout.splitlines():
+                job_id, _, state = line.partition('|')
+                if state:
+                    accounted[job_id] = state.split()[0]
+
+            # an array job only counts as completed when every task completed
+            for j in finished:
+                tasks = [v for k, v in accounted.items() if k == j or k.startswith(j + '_')]
+                failed = [t for t in tasks if t != 'COMPLETED']
+                states[j] = failed[0] if failed else 'COMPLETED' if tasks else 'UNKNOWN'
+
+    except Exception as e:
+        print(e)
+        print('Could not poll Slurm job states.')
+
+    return states
+
+def update_jobs(study_dir, subject_bids_ids=None, max_age=30):
+    with open_jobs(study_dir) as jobs:
+        pending = [j for j, r in jobs.items() if r['state'] in ACTIVE_STATES and
+            (subject_bids_ids is None or r['subject'] in subject_bids_ids)]
+
+        # states polled by another stage moments ago are reused rather than re-polled
+        stale = [j for j in pending if time.time() - jobs[j].get('polled', 0) > max_age]
+        now = datetime.now().isoformat()
+
+        for j, state in poll(stale).items():
+            jobs[j]['polled'] = time.time()
+            submitted = datetime.fromisoformat(jobs[j]['submitted'])
+            if state == 'UNKNOWN' and (datetime.now() - submitted).total_seconds() > \
+                    UNKNOWN_GRACE:
+                state = 'LOST'
+            if jobs[j]['state'] != state:
+                jobs[j]['state'] = state
+                jobs[j]['updated'] = now
+
+                if state not in ACTIVE_STATES and jobs[j]['subject'] != 'cohort':
+                    catalog.record_stage(study_dir, jobs[j]['subject'], jobs[j]['stage'],
+                        'done' if state == 'COMPLETED' else 'failed', '{} {}'.format(j, state))
+
+        return {j: dict(jobs[j]) for j in pending}
+
+def get_job_status(study_dir, job_id):
+    # 'active', 'completed' or 'failed' for a recorded job, None for an unknown one; a chained
+    # stage runs inside the job it was submitted as, so that job does not count as active
+    if job_id == os.environ.get('SLURM_JOB_ID'):
+        return None
+
+    with open_jobs(study_dir) as jobs:
+        record = dict(jobs.get(job_id) or {})
+    if not record:
+        return None
+
+    if record['state'] in ACTIVE_STATES:
+        record = update_jobs(study_dir, [record['subject']]).get(job_id, record)
+
+    if record['state'] in ACTIVE_STATES:
+        return 'active'
+    return 'completed' if record['state'] == 'COMPLETED' else 'failed'
+
+def get_active_jobs(study_dir, subject_bids_id, stages):
+    jobs = update_jobs(study_dir, [subject_bids_id])
+    return sorted(j for j, r in jobs.items() if r['stage'] in stages and
+        r['state'] in ACTIVE_STATES)
+
+def track(study_dir, subject_bids_ids=None, interval=300):
+    while True:
+        jobs = update_jobs(study_dir, subject_bids_ids, max_age=0)
+        active = [j for j, r in jobs.items() if r['state'] in ACTIVE_STATES]
+        print('{} Slurm jobs still active.'.format(len(active)))
+        if not active:
+            return jobs
+        time.sleep(interval)
@@ -1,6 +1,20 @@
 #!/usr/bin/env python
 
+import os
+
 import preprocessing as p
+from preprocessing import slurm, profiles
+from util import metrics
+
+RESOURCES = {'time': '10:00:00', 'cpus': 1, 'mem_per_cpu': '20G', 'partition': 'ncf'}
+
+# the one-subject time limit (RESOURCES, an override or an autotuned value) covers this many
+# runs; shard jobs run their cohort rows one after another, so their limit scales with run count
+SUBJECT_RUNS = 2
+SHARD_SIZE = 8
+
+# array tasks read their shard's cohort file from the manifest
+ARRAY_COHORT = '${COHORT}'
 
 def get_scan_files(subject_fmriprep_dir, subject_bids_id):
     scan_files = []
@@ -22,47 +36,100 @@ def get_scan_files(subject_fmriprep_dir, subject_bids_id):
 
     return scan_files   
 
+def get_cohort_rows(study_dir, subject_bids_id, fmriprep_version):
+    fmriprep_dir = p.fmriprep.get_fmriprep_dir(study_dir, fmriprep_version)
+    subject_fmriprep_dir = os.path.join(fmriprep_dir, 'fmriprep', subject_bids_id)
+
+    # id1 keeps each run's outputs apart under the subject's output directory
+    rows = []
+    for s in get_scan_files(subject_fmriprep_dir, subject_bids_id):
+        run = os.path.basename(s).split('_space-')[0].replace(subject_bids_id + '_', '')
+        rows.append((subject_bids_id, run, s))
+    return rows
+
 def get_cohort_file(study_dir, subject_bids_id):
     return os.path.join(study_dir, 'derivatives', 
         'ind_cohort_files', '{}.csv'.format(subject_bids_id))
 
-def prepare_cohort_file(study_dir, subject_bids_id, fmriprep_version):
-    fmriprep_dir = p.fmriprep.get_fmriprep_dir(study_dir, fmriprep_version)
-    subject_fmriprep_dir = os.path.join(fmriprep_dir, 'fmriprep', subject_bids_id)
-    
-    scan_files = get_scan_files(subject_fmriprep_dir, subject_bids_id)
-    if not scan_files:
-        print('Compatible cohort files not found.')
-        raise
-
+def write_cohort_file(cohort_file, rows):
     try:
-        cohort_file = get_cohort_file(study_dir, subject_bids_id)
+        os.makedirs(os.path.dirname(cohort_file), exist_ok=True)
 
-        with open(cohort_file) as f:
-            f.writelines('id0,img\n')
-        
-            for s in scan_files:
-                f.writelines(s + '\n')
+        with open(cohort_file, 'w') as f:
+            f.writelines('id0,id1,img\n')
+
+            for r in rows:
+                f.writelines(','.join(r) + '\n')
 
     except Exception as e:
         print(e)
         print('Could not create a cohort file.')
         raise 
 
+def prepare_cohort_file(study_dir, subject_bids_id, fmriprep_version):
+    rows = get_cohort_rows(study_dir, subject_bids_id, fmriprep_version)
+    if not rows:
+        print('Compatible cohort files not found.')
+        raise
+
+    write_cohort_file(get_cohort_file(study_dir, subject_bids_id), rows)
+
+def is_finished(xcpengine_dir, row):
+    # xcpengine writes the quality summary once a row's pipeline has finished
+    id0, id1, _ = row
+    return os.path.exists(os.path.join(xcpengine_dir, id0, id1,
+        '{}_{}_quality.csv'.format(id0, id1)))
+
+def get_shard_dir(study_dir, fmriprep_version):
+    return os.path.join(study_dir, 'derivatives', 'xcpengine-cohorts-{}'.format(fmriprep_version))
+
+def prepare_cohort_shards(study_dir, subject_bids_ids, fmriprep_version, shard_size=SHARD_SIZE,
+        force=False):
+    xcpengine_dir = get_xcpengine_dir(study_dir, fmriprep_version)
+    rows = []
+
+    for s in subject_bids_ids:
+        subject_rows = get_cohort_rows(study_dir, s, fmriprep_version)
+        if not subject_rows:
+            print('Compatible cohort files not found for {}.'.format(s))
+        rows += [r for r in subject_rows if force or not is_finished(xcpengine_dir, r)]
+
+    name = slurm.get_array_name()
+    shard_dir = get_shard_dir(study_dir, fmriprep_version)
+    shards = []
+
+    for i in range(0, len(rows), shard_size):
+        cohort_file = os.path.join(shard_dir, '{}-{:04d}.csv'.format(name, i // shard_size))
+        write_cohort_file(cohort_file, rows[i:i + shard_size])
+        shards.append({'cohort_file': cohort_file, 'rows': rows[i:i + shard_size]})
+
+    return shards
+
+def get_shard_resources(resources, runs, overrides=None):
+    # a time given explicitly for xcpengine is the shard's limit as is
+    resources = resources or RESOURCES
+    run_time = profiles.parse_duration(resources['time']) / SUBJECT_RUNS
+    shard_resources = dict(resources, time=profiles.format_duration(run_time * runs))
+    shard_resources.update(overrides or {})
+    return shard_resources
+
 def get_dsn_path(study_dir):
     return os.path.join(study_dir, 'derivatives', 'fc-36p.dsn')
 
 def get_derivatives_dir(study_dir):
     return os.path.join(study_dir, 'derivatives')
 
+def get_sbatch_dir(study_dir, fmriprep_version):
+    return os.path.join(study_dir, 'derivatives', 'xcpengine-sbatch-{}'.format(fmriprep_version))
+
 def get_xcpengine_dir(study_dir, fmriprep_version):
     fmriprep_dir = p.fmriprep.get_fmriprep_dir(study_dir, fmriprep_version)
     return os.path.join(fmriprep_dir, 'xcpengine')
 
 def get_singularity_command(study_dir, subject_bids_id, 
-        xcpengine_version, fmriprep_version, container_dir):
+        xcpengine_version, fmriprep_version, container_dir, cohort_file=None):
 
-    cohort_file = get_cohort_file(study_dir, subject_bids_id)
+    cohort_file = cohort_file or get_cohort_file(study_dir, subject_bids_id)
     dsn = get_dsn_path(study_dir)
     xcpengine_dir = get_xcpengine_dir(study_dir, fmriprep_version)
     derivatives_dir = get_derivatives_dir(study_dir)
@@ -78,27 +145,34 @@ def get_singularity_command(study_dir, subject_bids_id,
 
     return ' '.join(cmd) 
 
-def run_sbatch(study_dir, subject_bids_id, fmriprep_version, ANTS_path, cmd):
-    try:
-        sbatch_dir = get_sbatch_dir(study_dir, 'derivatives', 'sbatch', 'xcpengine')
-        sbatch_file_path = os.path.join(sbatch_dir, subject_bids_id + '.sbatch')
-
-        with open(sbatch_file_path) as f:
-            f.writelines('#!/bin/bash\n')
-            f.writelines('#SBATCH --job-name=xcpengine\n')
-            f.writelines('#SBATCH --output={}/%x-%A-%a.out\n'.format(sbatch_dir))
-            f.writelines('#SBATCH --error={}/%x-%A-%a.err\n'.format(sbatch_dir))
-            f.writelines('#SBATCH --time=10:00:00\n')
-            f.writelines('#SBATCH -n 1\n')
-            f.writelines('#SBATCH --cpus-per-task=1\n')
-            f.writelines('#SBATCH --mem-per-cpu=20G\n')
-            f.writelines('#SBATCH --partition=ncf\n')
-            f.writelines('export ANTSPATH={}\n'.format(ANTS_path))
-            f.writelines(cmd)
-
-        os.system('sbatch {}'.format(sbatch_file_path))
-
-    except Exception as e:
-        print(e)
-        print('Could not run sbatch.')
-        raise
+def get_sbatch_directives(sbatch_dir, resources=None):
+    return ['--job-name=xcpengine',
+        '--output={}/%x-%A-%a.out'.format(sbatch_dir),
+        '--error={}/%x-%A-%a.err'.format(sbatch_dir)] + \
+        profiles.get_directives(resources or RESOURCES)
+
+@metrics.instrument('xcpengine.run_sbatch', subject='subject_bids_id')
+def run_sbatch(study_dir, subject_bids_id, fmriprep_version, ANTS_path, cmd, resources=None):
+    sbatch_dir = get_sbatch_dir(study_dir, fmriprep_version)
+    sbatch_file_path = os.path.join(sbatch_dir, subject_bids_id + '.sbatch')
+
+    slurm.write_script(sbatch_file_path, get_sbatch_directives(sbatch_dir, resources),
+        ['export ANTSPATH={}'.format(ANTS_path), cmd])
+    return slurm.submit(sbatch_file_path)
+
+@metrics.instrument('xcpengine.run_sbatch_array')
+def run_sbatch_array(study_dir, subject_bids_ids, fmriprep_version, ANTS_path, cmd,
+        max_concurrent=None, resources=None, variable='SUBJECT'):
+    # cmd is built for slurm.ARRAY_SUBJECT (or ARRAY_COHORT with variable='COHORT'); each task
+    # resolves it from the manifest
+    sbatch_dir = get_sbatch_dir(study_dir, fmriprep_version)
+    name = slurm.get_array_name()
+    manifest_path = os.path.join(sbatch_dir, name + '.txt')
+    sbatch_file_path = os.path.join(sbatch_dir, name + '.sbatch')
+
+    slurm.write_manifest(manifest_path, subject_bids_ids)
+    slurm.write_script(sbatch_file_path, get_sbatch_directives(sbatch_dir, resources),
+        slurm.get_array_lines(manifest_path, variable) +
+        ['export ANTSPATH={}'.format(ANTS_path), cmd])
+    return slurm.submit(sbatch_file_path, slurm.get_array_spec(len(subject_bids_ids),
+        max_concurrent))
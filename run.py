@@ -1,16 +1,18 @@
 #!/usr/bin/env python3
 
 import os
+import sys
+import shlex
 import logging
 import argparse as ap
 from datetime import datetime
+from functools import partial
 
 import fetch as f
 import preprocessing as p
 import util as u
+from util import scheduler, cache, catalog
 
-log_file = f'STAR-{t}.log'
-logging.basicConfig(filename=log_file, format='%(asctime)s %(message)s', filemode='w')
 logger = logging.getLogger('star_logger')
 
 def main():
@@ -19,68 +21,297 @@ def main():
         default='/mnt/stressdevlab/STAR')
     parser.add_argument('--cbs_ids', nargs='+',
         help='subject CBS ID on XNAT. If unspecified, all subjects will be processed.')
+    parser.add_argument('--xnat_project', help='XNAT project listed when --cbs_ids is omitted',
+        default='STAR_Study')
+    parser.add_argument('--subjects_ttl', help='hours before the cached XNAT subject listing is '
+        'topped up with new experiments', type=float, default=24)
+    parser.add_argument('--refresh_subjects', help='list every XNAT experiment again instead of '
+        'only the ones added since the cached listing', action='store_true')
+    parser.add_argument('--metadata_ttl', help='hours a cached XNAT scan list and file listing '
+        'is reused', type=float, default=24 * 7)
+    parser.add_argument('--refresh_metadata', help='drop the cached XNAT metadata of the '
+        'selected subjects and query it again', action='store_true')
     parser.add_argument('--container_dir', help='container directory',
         default='/mnt/stressdevlab/scripts/Containers')
     parser.add_argument('--fmriprep_ver', help='fMRIprep container version', required=True)
     parser.add_argument('--xcpengine_ver', help='xcpengine container version', required=True)
     parser.add_argument('--ants_path', help='ANTS path', required=True)
+    parser.add_argument('--fs_license', help='FreeSurfer license file',
+        default='/mnt/stressdevlab/scripts/Containers/license.txt')
+    parser.add_argument('--nthreads', help='fMRIprep --nthreads. Defaults to the CPUs requested '
+        'for the fmriprep job.')
+    parser.add_argument('--omp_nthreads', help='fMRIprep --omp-nthreads. Defaults to the CPUs '
+        'requested for the fmriprep job.')
+    parser.add_argument('--fd_spike_threshold', help='fMRIprep --fd-spike-threshold',
+        default='0.5')
+    parser.add_argument('--cifti', help='fMRIprep --cifti-output', default='91k')
+    parser.add_argument('--output_spaces', help='fMRIprep --output-spaces', nargs='+',
+        default=['MNI152NLin2009cAsym'])
+    parser.add_argument('--confound_strategies', help='confound regressor sets to write',
+        nargs='+', default=p.fmriprep.STRATEGIES, choices=list(p.fmriprep.confounds.STRATEGIES))
     parser.add_argument('--run', help='modules to run', nargs='+', 
         choices=['download', 'fmriprep', 'confounds', 'behavioral', 'xcpengine', 'model'],
         default=['download', 'fmriprep', 'confounds', 'behavioral', 'xcpengine', 'model']
     )
+    parser.add_argument('--force', help='rerun these modules even if their inputs are unchanged',
+        nargs='+', default=[],
+        choices=['download', 'fmriprep', 'confounds', 'behavioral', 'xcpengine', 'all'])
+    parser.add_argument('--hash_inputs', help='fingerprint inputs by content instead of size and '
+        'mtime', action='store_true')
+    parser.add_argument('--catalog_dir', help='directory of the pipeline catalog database, shared '
+        'by every node that runs stages. Defaults to the study\'s derivatives directory.')
+    jobs = scheduler.get_default_jobs()
+    parser.add_argument('--network_jobs', help='concurrent download stages', type=int,
+        default=jobs['network'])
+    parser.add_argument('--cpu_jobs', help='concurrent confounds/behavioral stages', type=int,
+        default=jobs['cpu'])
+    parser.add_argument('--scan_jobs', help='concurrent scan downloads per subject', type=int,
+        default=4)
+    parser.add_argument('--xnat_rate', help='XNAT requests started per second (0 for no limit)',
+        type=float, default=0)
+    parser.add_argument('--sync_xnat', help='use the requests-based XNAT client instead of the '
+        'asyncio one', action='store_true')
+    parser.add_argument('--convert_jobs', help='concurrent dcm2niix conversions per subject',
+        type=int, default=2)
+    parser.add_argument('--compress_threads', help='write dcm2niix output uncompressed and gzip '
+        'it with this many threads (pigz when installed). 0 keeps dcm2niix\'s own gzip.',
+        type=int, default=0)
+    parser.add_argument('--compress_level', help='gzip level with --compress_threads', type=int,
+        default=6, choices=range(1, 10))
+    parser.add_argument('--scratch_gb', help='limit on DICOM scratch space per subject (GB). '
+        'Converted DICOMs are removed when set.', type=float)
+    parser.add_argument('--morphometrics_link', help='link morphometrics files instead of '
+        'copying them when the NRG share and the study share a filesystem',
+        choices=['hardlink', 'reflink'])
+    parser.add_argument('--array', help='submit fmriprep and xcpengine as one Slurm array job '
+        'each instead of one job per subject', action='store_true')
+    parser.add_argument('--array_max', help='maximum concurrently running array tasks', type=int)
+    parser.add_argument('--xcp_shard_size', help='run xcpengine on cohorts of up to this many '
+        'runs instead of one subject per job, skipping runs that already finished', type=int)
+    parser.add_argument('--submit_jobs', help='concurrent fmriprep/xcpengine submissions',
+        type=int, default=jobs['submit'])
+    parser.add_argument('--no_chain', help='run confounds, behavioral and xcpengine locally even '
+        'when their upstream Slurm jobs are still queued or running', action='store_true')
+    parser.add_argument('--wait', help='poll Slurm until every submitted job has finished',
+        action='store_true')
+    parser.add_argument('--poll_interval', help='seconds between Slurm polls with --wait',
+        type=int, default=300)
+    parser.add_argument('--no_fs_reuse', help='do not copy finished FreeSurfer reconstructions '
+        'from other fMRIprep versions or the morphometrics copy', action='store_true')
+    parser.add_argument('--local_work_dir', help='run fmriprep with its work directory on '
+        'node-local scratch under this path ($TMPDIR if given without a path). The shared work '
+        'directory is copied in first and updated only when a job fails.', nargs='?',
+        const='${TMPDIR:-/tmp}')
+    parser.add_argument('--autotune', help='size fmriprep and xcpengine jobs from their Slurm '
+        'accounting history: log the recommendation or apply it', default='off',
+        choices=['off', 'recommend', 'apply'])
+    parser.add_argument('--autotune_percentile', help='percentile of past usage to request',
+        type=float, default=95)
+    parser.add_argument('--autotune_margin', help='safety factor applied to past usage',
+        type=float, default=1.25)
+    parser.add_argument('--resources', help='per-stage sbatch overrides, e.g. fmriprep.cpus=4 '
+        'xcpengine.mem_per_cpu=16G fmriprep.time=1-00:00:00', nargs='+', default=[])
     args = parser.parse_args()
 
     t = datetime.now()
     log_file = f'STAR-{t}.log'
+    logging.basicConfig(filename=log_file, format='%(asctime)s %(message)s', filemode='w',
+        level=logging.INFO)
     logger.info('Preprocessing has begun. Parsing arguments.')
 
     # get arguments
     study_dir = get_study_dir(args.bids_dir)
-    cbs_ids = get_subject_cbs_id(args.cbs_ids)
+    modules = list(args.run)
+    catalog.configure(args.catalog_dir)
+
+    auth, sess = None, None
+    if 'download' in modules or not args.cbs_ids:
+        auth = f.authenticate()
+        sess = f.xnat.connect(auth, args.network_jobs * args.scan_jobs, not args.sync_xnat,
+            args.xnat_rate or None)
+
+    # every experiment in the project when no subjects are given
+    cbs_ids = args.cbs_ids
+    if not cbs_ids:
+        cbs_ids = f.discover_experiments(sess, study_dir, args.xnat_project,
+            args.subjects_ttl * 3600, args.refresh_subjects)
+    cbs_ids = get_subject_cbs_id(cbs_ids)
     container_dir = get_container_dir(args.container_dir)
     fmriprep_version = get_fmriprep_ver(container_dir, args.fmriprep_ver)
     xcpengine_version = get_xcpengine_ver(container_dir, args.xcpengine_ver)
     ants_path = get_ants_path(args.ants_path)
-    modules = list(args.run)
 
     n = len(cbs_ids)
 
     if not n:
         logger.critical('Subjects not found.')
+        if sess is not None:
+            f.xnat.close(sess)
         return
 
     logger.info('Parsing arguments complete. Processing {} subjects.'.format(n))
 
+    # stage spans from every thread and worker process are appended to one trace per run
+    trace_path = u.metrics.get_trace_path(study_dir, 'STAR-{:%Y%m%d-%H%M%S}'.format(t))
+    u.metrics.configure(trace_path, {'fmriprep_version': fmriprep_version,
+        'xcpengine_version': xcpengine_version})
+
+    scratch_bytes = int(args.scratch_gb * 1024**3) if args.scratch_gb else None
+    compression = None
+    if args.compress_threads:
+        compression = {'threads': args.compress_threads, 'level': args.compress_level}
+
+    resources = get_stage_resources(study_dir, args)
+    nthreads = args.nthreads or str(resources['fmriprep']['cpus'])
+    omp_nthreads = args.omp_nthreads or str(resources['fmriprep']['cpus'])
+
+    stage_params = {
+        'download': {},
+        'fmriprep': {'fmriprep_version': fmriprep_version, 'nthreads': nthreads,
+            'omp_nthreads': omp_nthreads, 'fd_spike_threshold': args.fd_spike_threshold,
+            'cifti': args.cifti, 'output_spaces': args.output_spaces},
+        'confounds': {'fmriprep_version': fmriprep_version, 'fd_threshold': 0.5,
+            'strategies': args.confound_strategies},
+        'behavioral': {},
+        'xcpengine': {'fmriprep_version': fmriprep_version,
+            'xcpengine_version': xcpengine_version}
+    }
+
+    tasks = {}
     for subject_cbs_id in cbs_ids:
-
-        logger.info(f'Preprocessing subject {subject_cbs_id}')
+        subject_bids_id = get_subject_bids_id(subject_cbs_id)
+        stages = {}
 
         # download fmri and behavioral data
-        if 'download' in modules:
-            logger.info(f'Downloading data for subject {subject_cbs_id}')
-            download(study_dir, subject_cbs_id)
+        stages['download'] = partial(download, sess, study_dir,
+            subject_cbs_id, fmriprep_version, args.scan_jobs, args.convert_jobs, scratch_bytes,
+            args.morphometrics_link, args.hash_inputs, compression, args.metadata_ttl * 3600)
 
         # fmriprep
-        if 'fmriprep' in modules:
-            logger.info(f'Running fMRIprep for subject {subject_cbs_id}')
-            run_fmriprep(study_dir, subject_cbs_id, fmriprep_version, container_dir, omp_threads_num,
-                threads_num, fd_spike_threshold, fs_license_path, cifti, output_spaces)
+        stages['fmriprep'] = partial(run_fmriprep, study_dir, subject_cbs_id,
+            fmriprep_version, container_dir, omp_nthreads, nthreads,
+            args.fd_spike_threshold, args.fs_license, args.cifti, args.output_spaces,
+            resources['fmriprep'], args.local_work_dir, not args.no_fs_reuse)
 
         # filter confounds
-        if 'confounds' in modules:
-            logger.info(f'Processing confounds for subject {subject_cbs_id}')
-            process_fmriprep_confounds(study_dir, subject_cbs_id, fmriprep_version)
+        stages['confounds'] = partial(process_fmriprep_confounds, study_dir,
+            subject_cbs_id, fmriprep_version, args.confound_strategies)
 
         # preprocess behavioral
-        if 'behavioral' in modules:
-            logger.info(f'Processing behavioral data for subject {subject_cbs_id}')
-            process_onsets(study_dir, subject_cbs_id)
+        stages['behavioral'] = partial(process_onsets, study_dir,
+            subject_cbs_id)
 
         # xcpengine
-        if 'xcpengine' in modules:
-            logger.info(f'Running xcpengine for subject {subject_cbs_id}')
-            run_xcpengine(study_dir, subject_cbs_id, fmriprep_version, xcpengine_version, 
-                container_dir, ANTS_path)
+        stages['xcpengine'] = partial(run_xcpengine, study_dir,
+            subject_cbs_id, fmriprep_version, xcpengine_version, container_dir, ants_path,
+            resources['xcpengine'])
+
+        # submit downstream stages as dependent jobs while upstream jobs are still queued
+        if not args.no_chain:
+            for stage in ['confounds', 'behavioral', 'xcpengine']:
+                stages[stage] = partial(run_or_chain, study_dir, subject_cbs_id, stage,
+                    stages[stage], args)
+
+        # skip stages whose inputs, parameters and outputs are unchanged since the last run
+        for stage, func in stages.items():
+            inputs, outputs = get_stage_files(study_dir, subject_bids_id, stage, fmriprep_version)
+            params = dict(stage_params[stage], subject=subject_cbs_id)
+            if stage == 'download':
+                params = partial(get_download_params, params, sess, study_dir,
+                    subject_cbs_id, args.metadata_ttl * 3600, args.refresh_metadata)
+            force = stage in args.force or 'all' in args.force
+            tasks[(subject_cbs_id, stage)] = partial(cache.run_stage, study_dir, subject_bids_id,
+                stage, func, inputs, outputs, params, force, args.hash_inputs,
+                partial(p.slurm.get_job_status, study_dir))
+
+    # array stages are submitted once for the whole cohort between the scheduled stages
+    array_stages = [m for m in ['fmriprep', 'xcpengine'] if args.array and m in modules]
+    if args.xcp_shard_size and 'xcpengine' in modules and 'xcpengine' not in array_stages:
+        array_stages.append('xcpengine')
+
+    jobs = {'network': args.network_jobs, 'cpu': args.cpu_jobs, 'submit': args.submit_jobs}
+    subjects = list(cbs_ids)
+    done = {}
+    try:
+        for stage_pass in get_passes(modules, array_stages):
+            if stage_pass == 'fmriprep':
+                states = prepare_array_stage(study_dir, subjects, stage_pass, fmriprep_version,
+                    stage_params[stage_pass], args)
+                job_ids = run_fmriprep_array(study_dir, list(states), fmriprep_version,
+                    container_dir, omp_nthreads, nthreads, args.fd_spike_threshold,
+                    args.fs_license, args.cifti, args.output_spaces, args.array_max,
+                    resources['fmriprep'], args.local_work_dir,
+                    not args.no_fs_reuse) if states else {}
+                finish_array_stage(study_dir, stage_pass, fmriprep_version, states, job_ids)
+                done.update({(s, stage_pass): s not in states or s in job_ids for s in subjects})
+
+            elif stage_pass == 'xcpengine' and args.xcp_shard_size:
+                force = 'xcpengine' in args.force or 'all' in args.force
+                job_id = run_xcpengine_shards(study_dir, subjects, fmriprep_version,
+                    xcpengine_version, container_dir, ants_path, args.xcp_shard_size, args.array,
+                    args.array_max, args, resources['xcpengine'], force)
+                done.update({(s, stage_pass): job_id is not None for s in subjects})
+
+            elif stage_pass == 'xcpengine':
+                states = prepare_array_stage(study_dir, subjects, stage_pass, fmriprep_version,
+                    stage_params[stage_pass], args)
+                job_ids = run_xcpengine_array(study_dir, list(states), fmriprep_version,
+                    xcpengine_version, container_dir, ants_path, args.array_max, args,
+                    resources['xcpengine']) if states else {}
+                finish_array_stage(study_dir, stage_pass, fmriprep_version, states, job_ids)
+                done.update({(s, stage_pass): s not in states or s in job_ids for s in subjects})
+
+            else:
+                graph = scheduler.build_graph(subjects, stage_pass)
+                done.update(scheduler.run_graph(graph, tasks, jobs))
+
+            subjects = [s for s in subjects if all(done.get((s, m), True) for m in modules)]
+
+    finally:
+        if sess is not None:
+            f.xnat.close(sess)
+        if os.path.exists(trace_path):
+            u.metrics.report(trace_path)
+
+    failed = [node for node, ok in done.items() if not ok]
+    if failed:
+        logger.error('{} of {} stages did not complete.'.format(len(failed), len(done)))
+
+    if args.wait:
+        p.slurm.track(study_dir, [get_subject_bids_id(s) for s in cbs_ids] + ['cohort'],
+            args.poll_interval)
+
+def get_stage_resources(study_dir, args):
+    overrides = p.profiles.parse_overrides(args.resources)
+    defaults = {'fmriprep': p.fmriprep.RESOURCES, 'xcpengine': p.xcpengine.RESOURCES}
+    resources = {}
+
+    for stage, stage_defaults in defaults.items():
+        resources[stage] = dict(stage_defaults, **overrides.get(stage, {}))
+        if args.autotune == 'off' or stage not in args.run:
+            continue
+
+        profile = p.profiles.update_profile(study_dir, stage)
+        recommended = p.profiles.recommend(profile, stage_defaults, args.autotune_percentile,
+            args.autotune_margin, overrides=overrides.get(stage))
+        logger.info(f'{stage} resources from {len(profile)} past jobs: {recommended}')
+
+        if args.autotune == 'apply':
+            resources[stage] = recommended
+
+    return resources
+
+def get_passes(modules, array_stages):
+    passes, current = [], []
+    for m in ['download', 'behavioral', 'fmriprep', 'confounds', 'xcpengine']:
+        if m not in modules:
+            continue
+        if m in array_stages:
+            passes += [current, m]
+            current = []
+        else:
+            current.append(m)
+    return [x for x in passes + [current] if x]
 
 def get_study_dir(path):
     if not os.path.exists(path):
@@ -97,11 +328,11 @@ def get_subject_cbs_id(cbs_ids):
             logger.exception(e)
             logger.error(f'Could not parse {i}')
             continue
-        if not c[1] == 'STAR':
+        if len(c) < 2 or not c[1] == 'STAR':
             logger.error(f'{i} is not a STAR subject.')
             continue
         elif len(c) != 4:
-            err = f'{i} is invalid CBS ID. The format must be {YYMMDD}_STAR_{BIDSID}_{num}'
+            err = f'{i} is invalid CBS ID. The format must be {{YYMMDD}}_STAR_{{BIDSID}}_{{num}}'
             logger.error(err)
             continue
         arr.append(i)
@@ -146,50 +377,379 @@ def get_subject_bids_id(subject_cbs_id):
         logger.critical(f'Could not get bids id for {subject_cbs_id}.')
         raise
 
-def download(study_dir, subject_cbs_id):
-    auth = f.authenticate()
+def get_stage_files(study_dir, subject_bids_id, stage, fmriprep_version):
+    source_path = os.path.join(study_dir, 'sourcedata', subject_bids_id)
+    behavioral_dir = os.path.join(source_path, 'behavioral_files')
+    subject_dir = os.path.join(study_dir, subject_bids_id)
+    fmriprep_dir = p.fmriprep.get_fmriprep_dir(study_dir, fmriprep_version)
+    subject_func_dir = os.path.join(fmriprep_dir, 'fmriprep', subject_bids_id, 'func')
+
+    behavioral_files = os.path.join(behavioral_dir, '*_Run_[0-9]')
+    raw_files = [os.path.join(subject_dir, '**', '*.nii.gz'),
+        os.path.join(subject_dir, '**', '*.json')]
+    xcpengine_dir = os.path.join(p.xcpengine.get_xcpengine_dir(study_dir, fmriprep_version),
+        subject_bids_id)
+
+    # (inputs, outputs) glob patterns; submitted stages record their outputs once their job
+    # has completed, and download is fingerprinted by the XNAT listing in its params
+    stage_files = {
+        'download': ([], [os.path.join(source_path, '*.csv'), behavioral_files] + raw_files),
+        'fmriprep': (raw_files, [os.path.join(fmriprep_dir, 'fmriprep', subject_bids_id + '.html'),
+            os.path.join(subject_func_dir, '*desc-confounds_regressors.tsv'),
+            os.path.join(subject_func_dir, '*desc-preproc_bold.nii.gz')]),
+        'confounds': ([os.path.join(subject_func_dir, '*desc-confounds_regressors.tsv')],
+            [os.path.join(subject_func_dir, '*desc-confounds_regressors-*.txt'),
+            os.path.join(subject_func_dir, '*outliers*.txt'),
+            os.path.join(subject_func_dir, '*scrub_mask.txt')]),
+        'behavioral': ([behavioral_files], [os.path.join(behavioral_dir, '*.txt')]),
+        'xcpengine': ([os.path.join(subject_func_dir, '*desc-preproc_bold.nii.gz')],
+            [os.path.join(xcpengine_dir, '*', '*_quality.csv')])
+    }
+    return stage_files[stage]
+
+def get_download_params(params, sess, study_dir, subject_cbs_id, metadata_ttl=None,
+    refresh_metadata=False):
+    # scans and behavioral files added on XNAT change the fingerprint; the listings are cached,
+    # so an unchanged subject costs no request until they expire. XNAT lists no byte size for a
+    # scan, so its frame count stands in for one.
+    if refresh_metadata:
+        f.invalidate_experiment(study_dir, subject_cbs_id)
+
+    scans = f.get_scan_metadata(sess, subject_cbs_id, study_dir, metadata_ttl)
+    behavioral_data = f.get_behavioral_data(sess, subject_cbs_id, study_dir, metadata_ttl)
+    return dict(params,
+        scans=sorted([s['id'], s.get('series_description'), s.get('frames')] for s in scans),
+        behavioral_files=sorted([d['Name'], d.get('Size')] for d in behavioral_data))
+
+def download(sess, study_dir, subject_cbs_id, fmriprep_version, scan_jobs=4,
+    convert_jobs=2, scratch_bytes=None, morphometrics_link=None, hash_inputs=False,
+    compression=None, metadata_ttl=None):
     subject_bids_id = get_subject_bids_id(subject_cbs_id)    
 
-    scan_metadata = f.get_scan_metadata(auth, subject_cbs_id)
-    f.save_scan_metadata(study_dir, subject_bids_id, scan_metadata)
+    scan_metadata = f.get_scan_metadata(sess, subject_cbs_id, study_dir, metadata_ttl)
+    scan_metadata = f.save_scan_metadata(study_dir, subject_bids_id, scan_metadata)
 
-    behavioral_data = f.get_behavioral_data(auth, subject_cbs_id)
-    f.save_behavioral_data(auth, study_dir, subject_bids_id, behavioral_data)
+    behavioral_data = f.get_behavioral_data(sess, subject_cbs_id, study_dir, metadata_ttl)
+    f.save_behavioral_data(sess, study_dir, subject_bids_id, behavioral_data)
     
-    f.get_scan_data(auth, subject_cbs_id, subject_bids_id, scan_metadata, study_dir)
-    u.morphometrics(subject_cbs_id, subject_bids_id, study_dir, fmriprep_version)
+    f.get_scan_data(sess, subject_cbs_id, subject_bids_id, scan_metadata.to_dict('records'),
+        study_dir, scan_jobs, convert_jobs, scratch_bytes, compression)
+    u.morphometrics(subject_cbs_id, subject_bids_id, study_dir, fmriprep_version, scan_jobs,
+        hash_inputs, morphometrics_link)
 
 def run_fmriprep(study_dir, subject_cbs_id, fmriprep_version, container_dir,
-    omp_threads_num, threads_num, fd_spike_threshold, fs_license_path, cifti, output_spaces):
+    omp_threads_num, threads_num, fd_spike_threshold, fs_license_path, cifti, output_spaces,
+    resources=None, scratch_dir=None, fs_reuse=True):
 
     subject_bids_id = get_subject_bids_id(subject_cbs_id)
+    work_dir = p.fmriprep.SCRATCH_WORK_DIR if scratch_dir else None
+
+    if fs_reuse:
+        reuse_freesurfer(study_dir, subject_bids_id, fmriprep_version)
 
     fmriprep_command = p.fmriprep.get_singularity_command(study_dir, subject_bids_id, 
         fmriprep_version, container_dir, omp_threads_num, threads_num, fd_spike_threshold, 
-        fs_license_path, cifti, output_spaces)
-    p.fmriprep.run_sbatch(study_dir, subject_bids_id, fmriprep_version, fmriprep_command)
+        fs_license_path, cifti, output_spaces, work_dir)
+    job_id = p.fmriprep.run_sbatch(study_dir, subject_bids_id, fmriprep_version, fmriprep_command,
+        resources, scratch_dir)
+    p.slurm.record_job(study_dir, subject_bids_id, 'fmriprep', job_id)
+    return job_id
+
+def prepare_array_stage(study_dir, subject_cbs_ids, stage, fmriprep_version, params, args):
+    # the same fingerprint check as cache.run_stage, so an array only covers subjects whose
+    # stage would run; returns the cache state of each of them
+    force = stage in args.force or 'all' in args.force
+    states = {}
+    for subject_cbs_id in drop_failed_upstream(study_dir, subject_cbs_ids, stage):
+        subject_bids_id = get_subject_bids_id(subject_cbs_id)
+        inputs, outputs = get_stage_files(study_dir, subject_bids_id, stage, fmriprep_version)
+        skip, state = cache.prepare_stage(study_dir, subject_bids_id, stage, inputs, outputs,
+            dict(params, subject=subject_cbs_id), force, args.hash_inputs,
+            partial(p.slurm.get_job_status, study_dir))
+        if not skip:
+            states[subject_cbs_id] = state
+
+    logger.info(f'{stage}: {len(states)} of {len(subject_cbs_ids)} subjects need to run.')
+    return states
+
+def drop_failed_upstream(study_dir, subject_cbs_ids, stage):
+    # a cohort stage chained with afterany runs after failed upstream jobs too; their subjects
+    # are left out until the upstream stage is run again
+    ready = []
+    for subject_cbs_id in subject_cbs_ids:
+        subject_bids_id = get_subject_bids_id(subject_cbs_id)
+        failed = []
+        for upstream in scheduler.get_upstream_stages(stage):
+            manifest = cache.load_manifest(study_dir, subject_bids_id, upstream)
+            job_id = manifest and manifest.get('job')
+            if job_id and p.slurm.get_job_status(study_dir, job_id) == 'failed':
+                failed.append(f'{upstream} job {job_id}')
+
+        if failed:
+            logger.error(f'Leaving {subject_bids_id} out of {stage}: {", ".join(failed)} failed.')
+        else:
+            ready.append(subject_cbs_id)
+    return ready
+
+def finish_array_stage(study_dir, stage, fmriprep_version, states, job_ids):
+    # every task gets its own manifest, tracked by its own array task id
+    for subject_cbs_id, job_id in job_ids.items():
+        subject_bids_id = get_subject_bids_id(subject_cbs_id)
+        _, outputs = get_stage_files(study_dir, subject_bids_id, stage, fmriprep_version)
+        cache.finish_stage(study_dir, subject_bids_id, stage, states[subject_cbs_id], outputs,
+            job_id)
+
+def run_fmriprep_array(study_dir, subject_cbs_ids, fmriprep_version, container_dir,
+    omp_threads_num, threads_num, fd_spike_threshold, fs_license_path, cifti, output_spaces,
+    max_concurrent=None, resources=None, scratch_dir=None, fs_reuse=True):
+
+    subject_bids_ids = [get_subject_bids_id(s) for s in subject_cbs_ids]
+    work_dir = p.fmriprep.SCRATCH_WORK_DIR if scratch_dir else None
+
+    if fs_reuse:
+        for subject_bids_id in subject_bids_ids:
+            reuse_freesurfer(study_dir, subject_bids_id, fmriprep_version)
+
+    fmriprep_command = p.fmriprep.get_singularity_command(study_dir, p.slurm.ARRAY_SUBJECT,
+        fmriprep_version, container_dir, omp_threads_num, threads_num, fd_spike_threshold,
+        fs_license_path, cifti, output_spaces, work_dir)
+    try:
+        job_id = p.fmriprep.run_sbatch_array(study_dir, subject_bids_ids, fmriprep_version,
+            fmriprep_command, max_concurrent, resources, scratch_dir)
+    except Exception as e:
+        logger.exception(e)
+        logger.error('Could not submit the fMRIprep array job.')
+        return {}
 
-def process_fmriprep_confounds(study_dir, subject_cbs_id, fmriprep_version):
+    logger.info(f'Submitted fMRIprep array job {job_id} for {len(subject_bids_ids)} subjects.')
+
+    # downstream stages depend on their own subject's array task only
+    job_ids = {}
+    for i, (subject_cbs_id, subject_bids_id) in enumerate(zip(subject_cbs_ids, subject_bids_ids)):
+        job_ids[subject_cbs_id] = f'{job_id}_{i}'
+        p.slurm.record_job(study_dir, subject_bids_id, 'fmriprep', job_ids[subject_cbs_id])
+    return job_ids
+
+def reuse_freesurfer(study_dir, subject_bids_id, fmriprep_version):
+    fmriprep_dir = p.fmriprep.get_fmriprep_dir(study_dir, fmriprep_version)
+    try:
+        decision, detail = p.fmriprep.freesurfer.reuse_recon(fmriprep_dir, subject_bids_id)
+    except Exception as e:
+        logger.exception(e)
+        logger.error(f'Could not reuse a FreeSurfer reconstruction for {subject_bids_id}.')
+        return
+
+    if decision == 'complete':
+        logger.info(f'{subject_bids_id}: FreeSurfer reconstruction already complete in {detail}.')
+    elif decision == 'copied':
+        logger.info(f'{subject_bids_id}: reusing a copy of the FreeSurfer reconstruction from '
+            f'{detail}.')
+    elif decision == 'partial':
+        logger.info(f'{subject_bids_id}: resuming partial FreeSurfer reconstruction ({detail}).')
+    else:
+        logger.info(f'{subject_bids_id}: no finished FreeSurfer reconstruction found ({detail}). '
+            'recon-all will run.')
+
+def process_fmriprep_confounds(study_dir, subject_cbs_id, fmriprep_version, strategies=('9p',)):
     subject_bids_id = get_subject_bids_id(subject_cbs_id)
-    p.fmriprep.filter_confounds(study_dir, subject_bids_id, fmriprep_version)
+    p.fmriprep.filter_confounds(study_dir, subject_bids_id, fmriprep_version, strategies)
 
 def process_onsets(study_dir, subject_cbs_id):
     subject_bids_id = get_subject_bids_id(subject_cbs_id)
-    p.behavioral.emotion_onsets(study_dir, subject_bids_id)
-    p.behavioral.guessing_onsets(study_dir, subject_bids_id)
-    p.behavioral.carrit_onsets(study_dir, subject_bids_id)
-    p.behavioral.wm_onsets(study_dir, subject_bids_id)
+    p.behavioral.process_onsets(study_dir, subject_bids_id)
 
 def run_xcpengine(study_dir, subject_cbs_id, fmriprep_version, xcpengine_version, container_dir,
-    ANTS_path):
+    ants_path, resources=None):
 
     subject_bids_id = get_subject_bids_id(subject_cbs_id)   
  
     p.xcpengine.prepare_cohort_file(study_dir, subject_bids_id, fmriprep_version)
     xcpengine_command = p.xcpengine.get_singularity_command(study_dir, subject_bids_id,
         xcpengine_version, fmriprep_version, container_dir)
-    p.xcpengine.run_sbatch(study_dir, subject_bids_id, fmriprep_version, 
-        ANTS_path, xcpengine_command)
+    job_id = p.xcpengine.run_sbatch(study_dir, subject_bids_id, fmriprep_version, 
+        ants_path, xcpengine_command, resources)
+    p.slurm.record_job(study_dir, subject_bids_id, 'xcpengine', job_id)
+    return job_id
+
+def chain_cohort_stage(study_dir, subject_cbs_ids, stage, args):
+    # wait for every subject's upstream jobs, then build the cohort in a dependent job. afterok
+    # would hold the whole cohort forever if one subject's job failed, so the job starts once
+    # they have all ended and leaves out the subjects whose upstream job failed
+    upstream = scheduler.get_upstream_stages(stage)
+    job_ids = []
+    for subject_cbs_id in subject_cbs_ids:
+        subject_bids_id = get_subject_bids_id(subject_cbs_id)
+        job_ids += p.slurm.get_active_jobs(study_dir, subject_bids_id, upstream)
+
+    if not job_ids:
+        return False, None
+
+    cmd = get_chain_command(args, subject_cbs_ids, [stage])
+    try:
+        return True, submit_chained_stage(study_dir, 'cohort', stage, cmd, job_ids,
+            'afterany')
+    except Exception as e:
+        logger.exception(e)
+        logger.error(f'Could not submit the chained {stage} cohort.')
+        return True, None
+
+def run_xcpengine_array(study_dir, subject_cbs_ids, fmriprep_version, xcpengine_version,
+    container_dir, ants_path, max_concurrent=None, args=None, resources=None):
+
+    # returns the job id each subject waits on: its array task, or the chained cohort job
+    if args is not None and not args.no_chain:
+        chained, job_id = chain_cohort_stage(study_dir, subject_cbs_ids, 'xcpengine', args)
+        if chained:
+            return {s: job_id for s in subject_cbs_ids} if job_id else {}
+
+    subject_bids_ids, ready = [], []
+    for subject_cbs_id in subject_cbs_ids:
+        subject_bids_id = get_subject_bids_id(subject_cbs_id)
+        try:
+            p.xcpengine.prepare_cohort_file(study_dir, subject_bids_id, fmriprep_version)
+            subject_bids_ids.append(subject_bids_id)
+            ready.append(subject_cbs_id)
+        except Exception as e:
+            logger.exception(e)
+            logger.error(f'Leaving {subject_bids_id} out of the xcpengine array.')
+
+    if not subject_bids_ids:
+        logger.error('No subjects are ready for xcpengine.')
+        return {}
+
+    xcpengine_command = p.xcpengine.get_singularity_command(study_dir, p.slurm.ARRAY_SUBJECT,
+        xcpengine_version, fmriprep_version, container_dir)
+    try:
+        job_id = p.xcpengine.run_sbatch_array(study_dir, subject_bids_ids, fmriprep_version,
+            ants_path, xcpengine_command, max_concurrent, resources)
+    except Exception as e:
+        logger.exception(e)
+        logger.error('Could not submit the xcpengine array job.')
+        return {}
+
+    logger.info(f'Submitted xcpengine array job {job_id} for {len(subject_bids_ids)} subjects.')
+    job_ids = {}
+    for i, (subject_cbs_id, subject_bids_id) in enumerate(zip(ready, subject_bids_ids)):
+        job_ids[subject_cbs_id] = f'{job_id}_{i}'
+        p.slurm.record_job(study_dir, subject_bids_id, 'xcpengine', job_ids[subject_cbs_id])
+    return job_ids
+
+def run_xcpengine_shards(study_dir, subject_cbs_ids, fmriprep_version, xcpengine_version,
+    container_dir, ants_path, shard_size, array=False, max_concurrent=None, args=None,
+    resources=None, force=False):
+
+    if args is not None and not args.no_chain:
+        chained, job_id = chain_cohort_stage(study_dir, subject_cbs_ids, 'xcpengine', args)
+        if chained:
+            return job_id
+
+    subject_cbs_ids = drop_failed_upstream(study_dir, subject_cbs_ids, 'xcpengine')
+    subject_bids_ids = [get_subject_bids_id(s) for s in subject_cbs_ids]
+    try:
+        shards = p.xcpengine.prepare_cohort_shards(study_dir, subject_bids_ids, fmriprep_version,
+            shard_size, force)
+    except Exception as e:
+        logger.exception(e)
+        logger.error('Could not build the xcpengine cohort shards.')
+        return
+
+    if not shards:
+        logger.info('Every xcpengine run is already finished.')
+        return 'finished'
+
+    runs = sum(len(s['rows']) for s in shards)
+    overrides = p.profiles.parse_overrides(args.resources).get('xcpengine') if args else None
+    logger.info(f'Split {runs} xcpengine runs into {len(shards)} shards of up to {shard_size}.')
+
+    # an array shares one set of resources, so it is sized for its largest shard
+    if array:
+        cohort_files = [s['cohort_file'] for s in shards]
+        xcpengine_command = p.xcpengine.get_singularity_command(study_dir, None,
+            xcpengine_version, fmriprep_version, container_dir, p.xcpengine.ARRAY_COHORT)
+        shard_resources = p.xcpengine.get_shard_resources(resources,
+            max(len(s['rows']) for s in shards), overrides)
+        try:
+            job_id = p.xcpengine.run_sbatch_array(study_dir, cohort_files, fmriprep_version,
+                ants_path, xcpengine_command, max_concurrent, shard_resources, 'COHORT')
+        except Exception as e:
+            logger.exception(e)
+            logger.error('Could not submit the xcpengine shard array.')
+            return
+
+        logger.info(f'Submitted xcpengine array job {job_id} for {len(shards)} shards.')
+        p.slurm.record_job(study_dir, 'cohort', 'xcpengine', job_id)
+        return job_id
+
+    job_ids = []
+    for shard in shards:
+        name = os.path.splitext(os.path.basename(shard['cohort_file']))[0]
+        xcpengine_command = p.xcpengine.get_singularity_command(study_dir, None,
+            xcpengine_version, fmriprep_version, container_dir, shard['cohort_file'])
+        shard_resources = p.xcpengine.get_shard_resources(resources, len(shard['rows']),
+            overrides)
+        try:
+            job_id = p.xcpengine.run_sbatch(study_dir, name, fmriprep_version, ants_path,
+                xcpengine_command, shard_resources)
+        except Exception as e:
+            logger.exception(e)
+            logger.error(f'Could not submit xcpengine shard {name}.')
+            continue
+
+        logger.info(f'Submitted xcpengine shard {name} ({len(shard["rows"])} runs) as job '
+            f'{job_id}.')
+        p.slurm.record_job(study_dir, 'cohort', 'xcpengine', job_id)
+        job_ids.append(job_id)
+
+    return ','.join(job_ids) or None
+
+def get_chain_command(args, subject_cbs_ids, stages):
+    cmd = [sys.executable, os.path.abspath(__file__)]
+
+    for key, value in vars(args).items():
+        # an empty list would leave a bare nargs='+' flag, which argparse rejects
+        if key in ['cbs_ids', 'run', 'force', 'wait'] or value is None or value is False or \
+                value == []:
+            continue
+        elif value is True:
+            cmd.append(f'--{key}')
+        elif isinstance(value, list):
+            cmd += [f'--{key}'] + [str(v) for v in value]
+        else:
+            cmd += [f'--{key}', str(value)]
+
+    cmd += ['--cbs_ids'] + list(subject_cbs_ids) + ['--run'] + list(stages)
+    return ' '.join(shlex.quote(c) for c in cmd)
+
+def submit_chained_stage(study_dir, subject_bids_id, stage, cmd, dependency,
+        dependency_type='afterok'):
+    sbatch_dir = os.path.join(study_dir, 'derivatives', 'pipeline-sbatch')
+    sbatch_file_path = os.path.join(sbatch_dir, f'{subject_bids_id}-{stage}.sbatch')
+    directives = [f'--job-name=star-{stage}',
+        f'--output={sbatch_dir}/%x_%j.out',
+        f'--error={sbatch_dir}/%x_%j.err',
+        '--time=02:00:00',
+        '-n 1',
+        '--cpus-per-task=1',
+        '--mem-per-cpu=4G',
+        '--partition=ncf']
+
+    p.slurm.write_script(sbatch_file_path, directives, [f'cd {shlex.quote(os.getcwd())}', cmd])
+    job_id = p.slurm.submit(sbatch_file_path, dependency=dependency,
+        dependency_type=dependency_type)
+    p.slurm.record_job(study_dir, subject_bids_id, stage, job_id)
+    logger.info(f'Submitted {stage} for {subject_bids_id} as job {job_id} after {dependency}.')
+    return job_id
+
+def run_or_chain(study_dir, subject_cbs_id, stage, func, args):
+    subject_bids_id = get_subject_bids_id(subject_cbs_id)
+    upstream = scheduler.get_upstream_stages(stage)
+    job_ids = p.slurm.get_active_jobs(study_dir, subject_bids_id, upstream)
+
+    if not job_ids:
+        return func()
+
+    cmd = get_chain_command(args, [subject_cbs_id], [stage])
+    return submit_chained_stage(study_dir, subject_bids_id, stage, cmd, job_ids)
 
-if __name__=='__init__':
+if __name__=='__main__':
     main()
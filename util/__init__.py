@@ -5,7 +5,10 @@ import shutil
 import errno
 import glob
 
-def morphometrics(subject_cbs_id, subject_bids_id, study_dir, fmriprep_version):
+from . import cache, sync, metrics
+
+def morphometrics(subject_cbs_id, subject_bids_id, study_dir, fmriprep_version, sync_jobs=8,
+        content_hash=False, link=None):
     nrg_morphometrics = '/ncf/nrg/pipelines/CBSCentral/Morphometrics3/STAR_Study/'
     subject_morphometrics_path = os.path.join(nrg_morphometrics, subject_cbs_id)
     morphometrics_dir = glob.glob(subject_morphometrics_path + '/*/morphometrics')[0]
@@ -14,16 +17,21 @@ def morphometrics(subject_cbs_id, subject_bids_id, study_dir, fmriprep_version):
     freesurfer_path = os.path.join(study_dir, 'derivatives', fmriprep_folder, 'freesurfer')
     subject_morphometrics_dir = os.path.join(freesurfer_path, subject_bids_id, 'morphometrics')
    
-    copy_morphometrics(morphometrics_dir, subject_morphometrics_dir)
+    manifest_path = cache.get_manifest_path(study_dir, subject_bids_id,
+        'morphometrics-{}'.format(fmriprep_version))
+    copy_morphometrics(morphometrics_dir, subject_morphometrics_dir, manifest_path, sync_jobs,
+        content_hash, link)
 
     input_anat_file = os.path.join(subject_morphometrics_dir, 'T1.mgz')
     output_anat_directory = os.path.join(study_dir, subject_bids_id, 'anat')
     output_anat_file = os.path.join(output_anat_directory, subject_bids_id + '_T1w.nii.gz')
     mri_convert(input_anat_file, output_anat_file)
 
-def copy_morphometrics(morphometrics_dir, subject_morphometrics_dir):
+def copy_morphometrics(morphometrics_dir, subject_morphometrics_dir, manifest_path, sync_jobs=8,
+        content_hash=False, link=None):
     try:
-        shutil.copytree(morphometrics_dir, subject_morphometrics_dir, dirs_exist_ok=True)
+        sync.sync_tree(morphometrics_dir, subject_morphometrics_dir, manifest_path, sync_jobs,
+            content_hash, link)
     
     except OSError as e:
         if e.errno == errno.ENOTDIR:
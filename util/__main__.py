@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+import logging
+import argparse as ap
+
+from util import catalog
+
+def main():
+    parser = ap.ArgumentParser(description='STAR pipeline catalog')
+    parser.add_argument('--bids_dir', help='BIDS directory path',
+        default='/mnt/stressdevlab/STAR')
+    parser.add_argument('--catalog_dir', help='catalog directory given to run.py, if any')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    rebuild = commands.add_parser('rebuild', help='repopulate the catalog from the BIDS tree')
+    rebuild.add_argument('--jobs', help='concurrent subject scans', type=int, default=16)
+
+    missing = commands.add_parser('missing', help='list subjects that have not finished a stage')
+    missing.add_argument('stage', choices=['download', 'fmriprep', 'confounds', 'behavioral',
+        'xcpengine'])
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+    catalog.configure(args.catalog_dir)
+
+    if args.command == 'rebuild':
+        catalog.rebuild(args.bids_dir, args.jobs)
+    elif args.command == 'missing':
+        for s in catalog.get_missing(args.bids_dir, args.stage):
+            print(s)
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+import os
+import glob
+import json
+import hashlib
+import logging
+from datetime import datetime
+
+from . import catalog, metrics
+
+logger = logging.getLogger(__name__)
+
+def get_manifest_dir(study_dir):
+    return os.path.join(study_dir, 'derivatives', 'pipeline-manifests')
+
+def get_manifest_path(study_dir, subject_bids_id, stage):
+    return os.path.join(get_manifest_dir(study_dir), subject_bids_id, stage + '.json')
+
+def expand(patterns):
+    files = set()
+    for p in patterns:
+        files.update(f for f in glob.glob(p, recursive=True) if os.path.isfile(f))
+    return sorted(files)
+
+def stat_files(files):
+    stats = {}
+    for f in files:
+        st = os.stat(f)
+        stats[f] = [st.st_size, st.st_mtime_ns]
+    return stats
+
+def hash_file(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def get_fingerprint(inputs, params, content_hash=False):
+    h = hashlib.sha256()
+    h.update(json.dumps(params, sort_keys=True, default=str).encode())
+
+    for f in inputs:
+        if content_hash:
+            key = hash_file(f)
+        else:
+            st = os.stat(f)
+            key = f'{st.st_size}:{st.st_mtime_ns}'
+        h.update(f'{f}\0{key}\0'.encode())
+
+    return h.hexdigest()
+
+def load_manifest(study_dir, subject_bids_id, stage):
+    path = get_manifest_path(study_dir, subject_bids_id, stage)
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.exception(e)
+        logger.warning(f'Ignoring unreadable manifest {path}.')
+        return None
+
+def save_manifest(study_dir, subject_bids_id, stage, fingerprint, inputs, params, outputs,
+        job=None):
+    path = get_manifest_path(study_dir, subject_bids_id, stage)
+    manifest = {
+        'stage': stage,
+        'subject': subject_bids_id,
+        'fingerprint': fingerprint,
+        'params': params,
+        'inputs': stat_files(inputs),
+        'outputs': stat_files(outputs),
+        'completed': datetime.now().isoformat()
+    }
+    if job:
+        manifest['job'] = job
+
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=2, default=str)
+        os.replace(tmp, path)
+
+    except Exception as e:
+        logger.exception(e)
+        logger.error(f'Could not save manifest {path}.')
+        raise
+
+def is_current(manifest, fingerprint):
+    # a submitted stage is only current once its job has completed; see run_stage
+    if manifest is None or manifest['fingerprint'] != fingerprint or manifest.get('job'):
+        return False
+
+    # outputs must still be there and untouched since they were recorded
+    outputs = manifest['outputs']
+    try:
+        return stat_files(outputs) == outputs
+    except FileNotFoundError:
+        return False
+
+def prepare_stage(study_dir, subject_bids_id, stage, inputs=(), outputs=(), params=None,
+        force=False, content_hash=False, job_status=None):
+    # returns (skip, state); a stage that runs hands state to finish_stage afterwards. params
+    # may be a function when building them needs a network call, so it is only made for
+    # stages that are reached; job_status(job_id) returns 'active', 'completed' or 'failed'
+    # for the Slurm job a stage submitted
+    if callable(params):
+        params = params()
+    input_files = expand(inputs)
+    fingerprint = get_fingerprint(input_files, params, content_hash)
+    manifest = load_manifest(study_dir, subject_bids_id, stage)
+
+    # submitted stages finish on Slurm: a queued or running job is not submitted again, a
+    # completed one has its outputs recorded as if it had run here, and a failed or cancelled
+    # one runs the stage again
+    job = manifest and manifest['fingerprint'] == fingerprint and manifest.get('job')
+    status = job_status(job) if job and job_status else None
+    if status == 'active' and not force:
+        logger.info(f'{stage} for subject {subject_bids_id} is still running as job {job}. '
+            'Skipping.')
+        return True, None
+    elif status == 'completed' and expand(outputs):
+        save_manifest(study_dir, subject_bids_id, stage, fingerprint, input_files, params,
+            expand(outputs))
+        manifest = load_manifest(study_dir, subject_bids_id, stage)
+
+    if not force and is_current(manifest, fingerprint):
+        logger.info(f'{stage} is up to date for subject {subject_bids_id}. Skipping.')
+        catalog.record_stage(study_dir, subject_bids_id, stage, 'done', 'up to date')
+        return True, None
+
+    # inputs were just globbed for the fingerprint, so the stage can look them up in the
+    # catalog
+    catalog.record_files(study_dir, input_files)
+    return False, (fingerprint, input_files, params)
+
+def finish_stage(study_dir, subject_bids_id, stage, state, outputs=(), result=None):
+    fingerprint, input_files, params = state
+
+    # submitted stages finish on Slurm; their job state is tracked in preprocessing.slurm
+    submitted = isinstance(result, str)
+    output_files = expand(outputs)
+    save_manifest(study_dir, subject_bids_id, stage, fingerprint, input_files, params,
+        output_files, result if submitted else None)
+    catalog.record_files(study_dir, output_files)
+
+    status = 'submitted' if submitted else 'done'
+    catalog.record_stage(study_dir, subject_bids_id, stage, status, result)
+
+def run_stage(study_dir, subject_bids_id, stage, func, inputs=(), outputs=(), params=None,
+        force=False, content_hash=False, job_status=None):
+    with metrics.span(stage, subject=subject_bids_id) as span:
+        skip, state = prepare_stage(study_dir, subject_bids_id, stage, inputs, outputs, params,
+            force, content_hash, job_status)
+        if skip:
+            span['status'] = 'skipped'
+            return
+
+        try:
+            result = func()
+        except Exception as e:
+            catalog.record_stage(study_dir, subject_bids_id, stage, 'failed', str(e))
+            raise
+
+        finish_stage(study_dir, subject_bids_id, stage, state, outputs, result)
+        return result
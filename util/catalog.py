@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import glob
+import json
+import time
+import sqlite3
+import hashlib
+import pandas as pd
+import fnmatch
+import logging
+import threading
+import contextlib
+import concurrent.futures as cf
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS subjects (
+    bids_id TEXT PRIMARY KEY,
+    cbs_id TEXT,
+    experiment_id TEXT,
+    updated TEXT
+);
+CREATE TABLE IF NOT EXISTS scans (
+    subject TEXT,
+    scan_id TEXT,
+    series_description TEXT,
+    run INTEGER,
+    updated TEXT,
+    PRIMARY KEY (subject, scan_id)
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    subject TEXT,
+    datatype TEXT,
+    suffix TEXT,
+    size INTEGER,
+    mtime_ns INTEGER,
+    metadata TEXT
+);
+CREATE INDEX IF NOT EXISTS files_subject ON files (subject, suffix);
+CREATE INDEX IF NOT EXISTS files_suffix ON files (suffix);
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER,
+    listed_ns INTEGER
+);
+CREATE TABLE IF NOT EXISTS stages (
+    subject TEXT,
+    stage TEXT,
+    status TEXT,
+    detail TEXT,
+    updated TEXT,
+    PRIMARY KEY (subject, stage)
+);
+'''
+
+# layouts scanned by rebuild, relative to the study directory
+SCAN_PATTERNS = [
+    'sub-*',
+    os.path.join('sourcedata', 'sub-*'),
+    os.path.join('derivatives', 'fmriprep-*', 'fmriprep', 'sub-*')
+]
+
+# set by configure and inherited by scheduler worker processes and chained Slurm jobs
+CATALOG_ENV = 'STAR_CATALOG_DIR'
+
+# a directory listed this soon after it changed may change again within the same mtime tick, so
+# its listing is not trusted
+RACY_NS = 2 * 10**9
+
+# catalog paths whose schema this process has already created
+initialized = set()
+initialized_lock = threading.Lock()
+
+def configure(catalog_dir):
+    if catalog_dir:
+        os.environ[CATALOG_ENV] = os.path.abspath(catalog_dir)
+
+def get_catalog_path(study_dir):
+    # one catalog per study shared by every node, so the stages that Slurm jobs record are the
+    # ones `missing` reads; a catalog dir outside the study tree (e.g. where SQLite locking
+    # works better than on NFS) holds a database per study
+    study_dir = os.path.abspath(study_dir)
+    catalog_dir = os.environ.get(CATALOG_ENV)
+    if not catalog_dir:
+        return os.path.join(study_dir, 'derivatives', 'pipeline-catalog.db')
+
+    key = hashlib.md5(study_dir.encode()).hexdigest()[:12]
+    return os.path.join(catalog_dir, f'{os.path.basename(study_dir)}-{key}.db')
+
+@contextlib.contextmanager
+def connect(study_dir):
+    path = get_catalog_path(study_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # every stage process writes here, so wait on locks rather than fail
+    conn = sqlite3.connect(path, timeout=120)
+    try:
+        with initialized_lock:
+            if path not in initialized:
+                conn.executescript(SCHEMA)
+                initialized.add(path)
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+def get_subject(path):
+    m = re.search(r'(?:^|/)(sub-[^/_]+)', path)
+    return m.group(1) if m else None
+
+def get_entities(path):
+    # (datatype, suffix) from BIDS-style paths, e.g. func/sub-1_task-rest_bold.nii.gz
+    parts = path.split(os.sep)
+    datatype = parts[-2] if len(parts) > 1 else None
+    name = parts[-1].split('.')[0]
+    suffix = name.split('_')[-1] if '_' in name else None
+    return datatype, suffix
+
+def get_sidecar(path):
+    for ext in ['.nii.gz', '.nii']:
+        if path.endswith(ext):
+            sidecar = path[:-len(ext)] + '.json'
+            if os.path.exists(sidecar):
+                with open(sidecar) as f:
+                    return json.load(f)
+
+def describe_file(path):
+    st = os.stat(path)
+    datatype, suffix = get_entities(path)
+    try:
+        metadata = get_sidecar(path)
+    except Exception as e:
+        logger.warning(f'Could not read the sidecar of {path}: {e}')
+        metadata = None
+    return (path, get_subject(path), datatype, suffix, st.st_size, st.st_mtime_ns,
+        json.dumps(metadata) if metadata is not None else None)
+
+def insert_files(conn, rows):
+    conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+def record_files(study_dir, paths):
+    # the catalog is an index, so failing to update it never fails a stage
+    try:
+        rows = [describe_file(os.path.abspath(p)) for p in paths if os.path.isfile(p)]
+        with connect(study_dir) as conn:
+            insert_files(conn, rows)
+    except Exception as e:
+        logger.exception(e)
+        logger.warning(f'Could not record {len(paths)} files in the catalog.')
+
+def record_subject(study_dir, subject_bids_id, subject_cbs_id=None, experiment_id=None):
+    try:
+        with connect(study_dir) as conn:
+            conn.execute('INSERT INTO subjects VALUES (?, ?, ?, ?) ON CONFLICT (bids_id) DO '
+                'UPDATE SET cbs_id = coalesce(excluded.cbs_id, cbs_id), experiment_id = '
+                'coalesce(excluded.experiment_id, experiment_id), updated = excluded.updated',
+                (subject_bids_id, subject_cbs_id, experiment_id, datetime.now().isoformat()))
+    except Exception as e:
+        logger.exception(e)
+        logger.warning(f'Could not record subject {subject_bids_id} in the catalog.')
+
+def record_scans(study_dir, subject_bids_id, scans):
+    # scans are (scan_id, series_description, run)
+    now = datetime.now().isoformat()
+    try:
+        with connect(study_dir) as conn:
+            conn.execute('DELETE FROM scans WHERE subject = ?', (subject_bids_id,))
+            conn.executemany('INSERT INTO scans VALUES (?, ?, ?, ?, ?)',
+                [(subject_bids_id, str(s), d, r, now) for s, d, r in scans])
+    except Exception as e:
+        logger.exception(e)
+        logger.warning(f'Could not record scans of {subject_bids_id} in the catalog.')
+
+def record_stage(study_dir, subject_bids_id, stage, status, detail=None):
+    try:
+        now = datetime.now().isoformat()
+        with connect(study_dir) as conn:
+            conn.execute('INSERT OR IGNORE INTO subjects (bids_id, updated) VALUES (?, ?)',
+                (subject_bids_id, now))
+            conn.execute('INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?)',
+                (subject_bids_id, stage, status, detail, now))
+    except Exception as e:
+        logger.exception(e)
+        logger.warning(f'Could not record {stage} of {subject_bids_id} in the catalog.')
+
+def match(path, pattern):
+    # glob semantics: wildcards do not cross directory separators
+    parts, pattern_parts = path.split(os.sep), pattern.split(os.sep)
+    return len(parts) == len(pattern_parts) and all(fnmatch.fnmatchcase(p, q)
+        for p, q in zip(parts, pattern_parts))
+
+def get_prefix(pattern):
+    m = re.search(r'[*?\[]', pattern)
+    return pattern[:m.start()] if m else pattern
+
+def is_stale(row, st):
+    return row is None or (row[0], row[1]) != (st.st_size, st.st_mtime_ns)
+
+def get_listed_dir(conn, pattern):
+    # the directory of a pattern with wildcards only in its file name, if the catalog listed it
+    # after its last change; Slurm jobs add files behind the catalog's back, but adding or
+    # removing one changes the directory's mtime
+    directory = os.path.dirname(pattern)
+    if get_prefix(directory) != directory:
+        return None, None, False
+
+    try:
+        mtime_ns = os.stat(directory).st_mtime_ns
+    except FileNotFoundError:
+        return None, None, False
+
+    row = conn.execute('SELECT mtime_ns, listed_ns FROM dirs WHERE path = ?',
+        (directory,)).fetchone()
+    listed = row is not None and row[0] == mtime_ns and row[1] - mtime_ns > RACY_NS
+    return directory, mtime_ns, listed
+
+def find_files(study_dir, pattern):
+    # indexed lookup of a glob pattern; the filesystem is only globbed when the pattern's
+    # directory changed since the catalog last listed it, and the catalog is then reconciled
+    # with it: rows of deleted files are dropped, new and rewritten files (re)described
+    pattern = os.path.abspath(pattern)
+    prefix = get_prefix(pattern)
+    try:
+        with connect(study_dir) as conn:
+            rows = conn.execute('SELECT path, size, mtime_ns FROM files WHERE path >= ? AND '
+                'path < ?', (prefix, prefix + '\U0010ffff')).fetchall()
+            known = {r[0]: r[1:] for r in rows if match(r[0], pattern)}
+
+            directory, mtime_ns, listed = get_listed_dir(conn, pattern)
+            if listed:
+                return sorted(known)
+
+            listed_ns = time.time_ns()
+            files = sorted(glob.glob(pattern))
+            conn.executemany('DELETE FROM files WHERE path = ?',
+                [(p,) for p in set(known).difference(files)])
+            insert_files(conn, [describe_file(p) for p in files
+                if is_stale(known.get(p), os.stat(p))])
+            if directory:
+                conn.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)',
+                    (directory, mtime_ns, listed_ns))
+            return files
+
+    except Exception as e:
+        logger.exception(e)
+        logger.warning(f'Could not look up {pattern} in the catalog.')
+        return sorted(glob.glob(pattern))
+
+def get_metadata(study_dir, path):
+    path = os.path.abspath(path)
+    try:
+        # a file rewritten since it was catalogued (e.g. converted again) is described again
+        with connect(study_dir) as conn:
+            row = conn.execute('SELECT size, mtime_ns, metadata FROM files WHERE path = ?',
+                (path,)).fetchone()
+            if is_stale(row, os.stat(path)):
+                described = describe_file(path)
+                insert_files(conn, [described])
+                row = described[4:]
+        if row[2]:
+            return json.loads(row[2])
+    except Exception as e:
+        logger.exception(e)
+
+    return get_sidecar(path)
+
+def get_missing(study_dir, stage, status='done'):
+    with connect(study_dir) as conn:
+        rows = conn.execute('SELECT bids_id FROM subjects WHERE bids_id NOT IN (SELECT subject '
+            'FROM stages WHERE stage = ? AND status = ?) ORDER BY bids_id',
+            (stage, status)).fetchall()
+    return [r for r, in rows]
+
+def scan_tree(root):
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        paths += [os.path.join(dirpath, f) for f in filenames]
+
+    rows = []
+    for p in paths:
+        try:
+            rows.append(describe_file(p))
+        except FileNotFoundError:
+            continue
+    return rows
+
+def load_stages(study_dir):
+    # stage completion comes from util.cache manifests
+    stages = []
+    pattern = os.path.join(study_dir, 'derivatives', 'pipeline-manifests', 'sub-*', '*.json')
+    for path in glob.glob(pattern):
+        try:
+            with open(path) as f:
+                manifest = json.load(f)
+            stages.append((manifest['subject'], manifest['stage'], 'done', None,
+                manifest['completed']))
+        except Exception:
+            continue
+    return stages
+
+def load_scans(study_dir, subject_bids_id):
+    path = os.path.join(study_dir, 'sourcedata', subject_bids_id, subject_bids_id + '.csv')
+    if not os.path.exists(path):
+        return []
+
+    data = pd.read_csv(path, dtype=str)
+    runs, scans = {}, []
+    for scan_id, description in zip(data['id'], data['series_description']):
+        runs[description] = runs.get(description, 0) + 1
+        scans.append((subject_bids_id, scan_id, description, runs[description], None))
+    return scans
+
+def rebuild(study_dir, max_workers=16):
+    study_dir = os.path.abspath(study_dir)
+    roots = sorted(r for p in SCAN_PATTERNS for r in glob.glob(os.path.join(study_dir, p))
+        if os.path.isdir(r))
+    subjects = sorted({os.path.basename(r) for r in roots})
+
+    # one walk per subject tree, all in parallel; the database is written in one transaction
+    with cf.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        files = [row for rows in executor.map(scan_tree, roots) for row in rows]
+        scans = [row for rows in executor.map(lambda s: load_scans(study_dir, s), subjects)
+            for row in rows]
+    stages = load_stages(study_dir)
+
+    now = datetime.now().isoformat()
+    with connect(study_dir) as conn:
+        for table in ['subjects', 'scans', 'files', 'dirs', 'stages']:
+            conn.execute(f'DELETE FROM {table}')
+        conn.executemany('INSERT INTO subjects (bids_id, updated) VALUES (?, ?)',
+            [(s, now) for s in subjects])
+        conn.executemany('INSERT OR REPLACE INTO scans VALUES (?, ?, ?, ?, ?)', scans)
+        insert_files(conn, files)
+        conn.executemany('INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?)', stages)
+
+    logger.info(f'Catalogued {len(files)} files and {len(scans)} scans of {len(subjects)} '
+        'subjects.')
+    return len(subjects), len(files)
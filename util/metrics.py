@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import uuid
+import socket
+import inspect
+import logging
+import functools
+import threading
+import contextlib
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# set by configure and inherited by scheduler worker processes
+TRACE_ENV = 'STAR_METRICS_TRACE'
+LABELS_ENV = 'STAR_METRICS_LABELS'
+
+QUANTILES = {'p50': 0.5, 'p95': 0.95}
+
+_local = threading.local()
+_lock = threading.Lock()
+
+def get_metrics_dir(study_dir):
+    return os.path.join(study_dir, 'derivatives', 'pipeline-metrics')
+
+def get_trace_path(study_dir, run_id):
+    return os.path.join(get_metrics_dir(study_dir), run_id + '.jsonl')
+
+def get_textfile_path(trace_path):
+    return os.path.splitext(trace_path)[0] + '.prom'
+
+def configure(trace_path, labels=None):
+    os.makedirs(os.path.dirname(trace_path), exist_ok=True)
+    os.environ[TRACE_ENV] = trace_path
+    os.environ[LABELS_ENV] = json.dumps(labels or {})
+
+def get_labels():
+    return json.loads(os.environ.get(LABELS_ENV) or '{}')
+
+def get_stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+def write_record(record):
+    path = os.environ.get(TRACE_ENV)
+    if not path:
+        return
+
+    # one O_APPEND write per record keeps lines whole across threads and worker processes
+    line = (json.dumps(record, default=str) + '\n').encode()
+    try:
+        with _lock:
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+    except Exception as e:
+        logger.warning(f'Could not write metrics to {path}: {e}')
+
+@contextlib.contextmanager
+def span(name, **labels):
+    stack = get_stack()
+    parent = stack[-1] if stack else None
+
+    # spans inherit the subject (and other labels) of the span they are nested in
+    record = {
+        'span': uuid.uuid4().hex[:16],
+        'parent': parent['span'] if parent else None,
+        'name': name,
+        'labels': dict(parent['labels'] if parent else {}, **{k: v for k, v in labels.items()
+            if v is not None}),
+        'host': socket.gethostname(),
+        'pid': os.getpid(),
+        'thread': threading.current_thread().name,
+        'start': time.time(),
+        'bytes': 0,
+        'files': 0,
+        'status': 'ok'
+    }
+    stack.append(record)
+    t = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record['status'] = 'error'
+        record['error'] = repr(e)
+        raise
+    finally:
+        record['duration'] = time.perf_counter() - t
+        stack.pop()
+        # work counted in a nested span also counts for the spans around it
+        if parent:
+            parent['bytes'] += record['bytes']
+            parent['files'] += record['files']
+        write_record(record)
+
+def add(bytes=0, files=0):
+    # count work against the innermost open span of this thread
+    stack = get_stack()
+    if stack:
+        stack[-1]['bytes'] += int(bytes)
+        stack[-1]['files'] += int(files)
+
+def instrument(name, **label_params):
+    # label_params maps a label to the argument it is read from, e.g. subject='subject_bids_id'
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            labels = {}
+            if label_params:
+                bound = signature.bind_partial(*args, **kwargs).arguments
+                labels = {k: bound.get(p) for k, p in label_params.items()}
+            with span(name, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def load_trace(trace_path):
+    with open(trace_path) as f:
+        return pd.DataFrame([json.loads(line) for line in f if line.strip()])
+
+def summarize(trace_path):
+    trace = load_trace(trace_path)
+    if trace.empty:
+        return trace
+
+    summary = []
+    for name, group in trace.groupby('name', sort=True):
+        # stages skipped as up to date would drag the quantiles towards zero
+        ran = group[group['status'] != 'skipped']
+        durations = ran['duration']
+        moved = ran[ran['bytes'] > 0]
+        seconds = moved['duration'].sum()
+        row = {
+            'stage': name,
+            'count': len(ran),
+            'errors': int((group['status'] == 'error').sum()),
+            'skipped': len(group) - len(ran),
+            'seconds': durations.sum(),
+            'bytes': int(group['bytes'].sum()),
+            'files': int(group['files'].sum()),
+            'mb_per_second': moved['bytes'].sum() / 1024**2 / seconds if seconds else 0.0
+        }
+        row.update({k: durations.quantile(q) for k, q in QUANTILES.items()})
+        summary.append(row)
+
+    return pd.DataFrame(summary)
+
+def format_labels(labels):
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in labels.items()) + '}'
+
+def get_textfile_lines(summary, labels=None):
+    labels = labels or {}
+    metrics = [
+        ('star_stage_errors_total', 'counter', 'errors', 'Pipeline stage spans that raised.'),
+        ('star_stage_skipped_total', 'counter', 'skipped',
+            'Pipeline stages skipped because their outputs were up to date.'),
+        ('star_stage_bytes_total', 'counter', 'bytes',
+            'Bytes transferred or written by stage spans.'),
+        ('star_stage_files_total', 'counter', 'files',
+            'Files transferred or written by stage spans.'),
+        ('star_stage_throughput_mb_per_second', 'gauge', 'mb_per_second',
+            'Throughput of stage spans that moved data, in MB/s.')
+    ]
+    rows = summary.to_dict('records')
+
+    metric = 'star_stage_duration_seconds'
+    lines = [f'# HELP {metric} Wall time of pipeline stage spans.', f'# TYPE {metric} summary']
+    for row in rows:
+        stage_labels = dict(labels, stage=row['stage'])
+        # a stage whose spans were all skipped has no durations to take quantiles of
+        for k, q in QUANTILES.items() if row['count'] else ():
+            lines.append('{}{} {}'.format(metric, format_labels(dict(stage_labels,
+                quantile=str(q))), row[k]))
+        lines.append(f'{metric}_sum{format_labels(stage_labels)} {row["seconds"]}')
+        lines.append(f'{metric}_count{format_labels(stage_labels)} {row["count"]}')
+
+    for metric, kind, key, description in metrics:
+        lines += [f'# HELP {metric} {description}', f'# TYPE {metric} {kind}']
+        lines += [f'{metric}{format_labels(dict(labels, stage=row["stage"]))} {row[key]}'
+            for row in rows]
+    return lines
+
+def write_textfile(trace_path, textfile_path=None, labels=None):
+    # Prometheus textfile-collector format, replaced atomically so a scrape never sees half
+    textfile_path = textfile_path or get_textfile_path(trace_path)
+    summary = summarize(trace_path)
+    labels = get_labels() if labels is None else labels
+
+    tmp = textfile_path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write('\n'.join(get_textfile_lines(summary, labels)) + '\n')
+    os.replace(tmp, textfile_path)
+    return summary
+
+def report(trace_path):
+    try:
+        summary = write_textfile(trace_path)
+    except Exception as e:
+        logger.exception(e)
+        logger.error(f'Could not summarize metrics in {trace_path}.')
+        return
+
+    for row in summary.to_dict('records'):
+        quantiles = ', p50 {p50:.1f}s, p95 {p95:.1f}s'.format(**row) if row['count'] else ''
+        logger.info('{stage}: {count} spans, {errors} failed, {skipped} skipped{quantiles}, '
+            '{mb_per_second:.1f} MB/s'.format(quantiles=quantiles, **row))
+    logger.info(f'Metrics written to {trace_path} and {get_textfile_path(trace_path)}.')
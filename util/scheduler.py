@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+import os
+import logging
+import concurrent.futures as cf
+
+logger = logging.getLogger(__name__)
+
+STAGE_POOLS = {
+    'download': 'network',
+    'fmriprep': 'submit',
+    'confounds': 'cpu',
+    'behavioral': 'cpu',
+    'xcpengine': 'submit'
+}
+
+STAGE_DEPENDENCIES = {
+    'download': [],
+    'fmriprep': ['download'],
+    'confounds': ['fmriprep'],
+    'behavioral': ['download'],
+    'xcpengine': ['confounds']
+}
+
+def get_default_jobs():
+    return {
+        'network': 4,
+        'cpu': os.cpu_count() or 1,
+        'submit': 2
+    }
+
+def get_stage_dependencies(stage, stages):
+    # skip over stages that were not requested but keep their upstream ordering
+    deps = []
+    for d in STAGE_DEPENDENCIES[stage]:
+        if d in stages:
+            deps.append(d)
+        else:
+            deps.extend(get_stage_dependencies(d, stages))
+    return deps
+
+def get_upstream_stages(stage):
+    upstream = []
+    for d in STAGE_DEPENDENCIES[stage]:
+        upstream += [d] + get_upstream_stages(d)
+    return list(dict.fromkeys(upstream))
+
+def build_graph(subjects, stages):
+    graph = {}
+    for s in subjects:
+        for stage in stages:
+            if stage not in STAGE_DEPENDENCIES:
+                logger.warning(f'Stage {stage} is not schedulable. Skipping.')
+                continue
+            graph[(s, stage)] = [(s, d) for d in get_stage_dependencies(stage, stages)]
+    return graph
+
+def get_executor(pool, n):
+    if pool == 'cpu':
+        return cf.ProcessPoolExecutor(max_workers=n)
+    return cf.ThreadPoolExecutor(max_workers=n, thread_name_prefix=pool)
+
+def run_graph(graph, tasks, jobs):
+    executors = {pool: get_executor(pool, n) for pool, n in jobs.items()}
+    pending = dict(graph)
+    running = {}
+    done = {}
+
+    try:
+        while pending or running:
+            for node in list(pending):
+                deps = pending[node]
+
+                if any(done.get(d) is False for d in deps):
+                    logger.error(f'Skipping {node[1]} for subject {node[0]}: upstream stage failed.')
+                    done[node] = False
+                    del pending[node]
+
+                elif all(done.get(d) for d in deps):
+                    logger.info(f'Starting {node[1]} for subject {node[0]}')
+                    pool = STAGE_POOLS[node[1]]
+                    running[executors[pool].submit(tasks[node])] = node
+                    del pending[node]
+
+            if not running:
+                continue
+
+            finished, _ = cf.wait(running, return_when=cf.FIRST_COMPLETED)
+            for fut in finished:
+                node = running.pop(fut)
+                try:
+                    fut.result()
+                    done[node] = True
+                    logger.info(f'Finished {node[1]} for subject {node[0]}')
+                except Exception as e:
+                    logger.exception(e)
+                    logger.error(f'{node[1]} failed for subject {node[0]}.')
+                    done[node] = False
+
+    finally:
+        for e in executors.values():
+            e.shutdown(wait=True)
+
+    return done
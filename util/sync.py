@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import fcntl
+import shutil
+import logging
+import concurrent.futures as cf
+
+from . import cache
+
+logger = logging.getLogger(__name__)
+
+# linux ioctl that clones a file's extents (btrfs, xfs and other copy-on-write filesystems)
+FICLONE = 0x40049409
+
+def load_manifest(manifest_path):
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'dirs': {}, 'files': {}}
+    except Exception as e:
+        logger.exception(e)
+        logger.warning(f'Ignoring unreadable sync manifest {manifest_path}')
+        return {'dirs': {}, 'files': {}}
+
+def save_manifest(manifest_path, manifest):
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    tmp = f'{manifest_path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp, manifest_path)
+
+def list_dir(src_dir, rel, previous):
+    # a directory whose mtime is unchanged has the same entries, so reuse the recorded listing
+    path = os.path.join(src_dir, rel)
+    mtime = os.stat(path).st_mtime_ns
+    entry = previous.get(rel)
+    if entry and entry['mtime'] == mtime:
+        return rel, entry
+
+    files, dirs = [], []
+    with os.scandir(path) as it:
+        for e in it:
+            (dirs if e.is_dir(follow_symlinks=True) else files).append(e.name)
+    return rel, {'mtime': mtime, 'files': sorted(files), 'dirs': sorted(dirs)}
+
+def scan(src_dir, previous, executor):
+    dirs = {}
+    level = ['']
+    while level:
+        listings = executor.map(lambda rel: list_dir(src_dir, rel, previous), level)
+        level = []
+        for rel, entry in listings:
+            dirs[rel] = entry
+            level += [os.path.join(rel, d) for d in entry['dirs']]
+
+    files = [os.path.join(rel, f) for rel, entry in dirs.items() for f in entry['files']]
+    return dirs, files
+
+def stat_file(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+def clone_file(src, dst):
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+def copy_file(src, dst, link=None):
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = f'{dst}.{os.getpid()}.part'
+
+    try:
+        if link == 'hardlink':
+            try:
+                os.link(src, tmp)
+                os.replace(tmp, dst)
+                return
+            except OSError:
+                pass
+
+        elif link == 'reflink':
+            try:
+                clone_file(src, tmp)
+                shutil.copystat(src, tmp)
+                os.replace(tmp, dst)
+                return
+            except OSError:
+                pass
+
+        shutil.copy2(src, tmp)
+        os.replace(tmp, dst)
+
+    finally:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+
+def sync_tree(src_dir, dst_dir, manifest_path, max_workers=8, content_hash=False, link=None):
+    manifest = load_manifest(manifest_path)
+    if manifest.get('source', src_dir) != src_dir:
+        manifest = {'dirs': {}, 'files': {}}
+    previous = manifest['files']
+
+    with cf.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        dirs, files = scan(src_dir, manifest['dirs'], executor)
+        stats = dict(zip(files, executor.map(lambda f: stat_file(os.path.join(src_dir, f)),
+            files)))
+
+        changed, current = [], {}
+        for f, stat in stats.items():
+            old = previous.get(f)
+            current[f] = stat + old[2:] if old and old[:2] == stat else stat
+            if old is None or old[:2] != stat or not os.path.exists(os.path.join(dst_dir, f)):
+                changed.append(f)
+
+        # with content hashing, files that were only touched upstream are not copied again
+        if content_hash and changed:
+            digests = executor.map(lambda f: cache.hash_file(os.path.join(src_dir, f)), changed)
+            touched = []
+            for f, digest in zip(changed, digests):
+                current[f] = stats[f] + [digest]
+                old = previous.get(f)
+                if old and old[2:] == [digest] and os.path.exists(os.path.join(dst_dir, f)):
+                    touched.append(f)
+            changed = [f for f in changed if f not in set(touched)]
+
+        futures = {executor.submit(copy_file, os.path.join(src_dir, f),
+            os.path.join(dst_dir, f), link): f for f in changed}
+        failed = []
+        for fut in cf.as_completed(futures):
+            try:
+                fut.result()
+            except Exception as e:
+                logger.exception(e)
+                failed.append(futures[fut])
+                current.pop(futures[fut], None)
+
+    save_manifest(manifest_path, {'source': src_dir, 'dirs': dirs, 'files': current})
+
+    if failed:
+        logger.error(f'Could not copy {len(failed)} of {len(changed)} changed files to {dst_dir}')
+        raise RuntimeError(f'Could not sync {src_dir}')
+
+    logger.info(f'Synced {len(changed)} of {len(files)} files from {src_dir}')
+    return changed